@@ -62,6 +62,13 @@ def seed_callback(ctx: Context, param: Option, values: str) -> List:
     return [int(s.strip()) for s in seeds]
 
 
+def names_callback(ctx: Context, param: Option, values: str) -> List:
+    # Callback function for --corruptions option.
+    if values is None:
+        return None
+    return [s.strip() for s in values.strip().split(',')]
+
+
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option(
     '-v',
@@ -94,6 +101,18 @@ def seed_callback(ctx: Context, param: Option, values: str) -> List:
     callback=add_arguments_callback,
     help='Usage: --argument_map key1:value1 --argument_map key2:value2'
 )
+# arguments for: fling pack
+@click.option('-i', '--input_path', type=str, help='Root directory of the corrupted images to be packed.')
+@click.option('-o', '--output_path', type=str, help='Root directory of the packed shards.')
+@click.option(
+    '--corruptions',
+    type=str,
+    default=None,
+    callback=names_callback,
+    help='Corruptions to be packed. Usage: --corruptions fog,snow. Default: all.'
+)
+@click.option('--levels', type=str, default='1,2,3,4,5', callback=seed_callback, help='Usage: --levels 1,2,3,4,5')
+@click.option('--num_workers', type=int, default=8, help='Number of threads decoding the images.')
 def cli(
     mode: str,
     seed: List,
@@ -103,6 +122,11 @@ def cli(
     name: str,
     pipeline: str,
     argument_map: Dict,
+    input_path: str,
+    output_path: str,
+    corruptions: List,
+    levels: List,
+    num_workers: int,
 ):
     # fling create xxx
     if mode == 'create':
@@ -120,6 +144,10 @@ def cli(
     if mode == 'info':
         return command_info(name)
 
+    # fling pack
+    if mode == 'pack':
+        return pack_command(input_path, output_path, corruptions, levels, num_workers)
+
     # fling run xxx
     if mode == 'run':
         if config.endswith('.py'):
@@ -171,7 +199,7 @@ def cli(
 def create_command(name: str, add_arguments: Iterable):
     # Create a new command and add it into the command file.
     # Check whether the name is the same as built-in names.
-    if name in ['run', 'remove', 'list', 'create', 'info']:
+    if name in ['run', 'remove', 'list', 'create', 'info', 'pack']:
         raise ValueError(f'You are not supposed to define a command named {name}. Try another one.')
 
     # If the command file database already exists, load the original file and modify it.
@@ -241,6 +269,15 @@ def command_info(name: str):
     click.echo(tb)
 
 
+def pack_command(input_path: str, output_path: str, corruptions: List, levels: List, num_workers: int):
+    # Decode a corrupted test set stored as image files (e.g. Tiny-ImageNet-C) into packed shards.
+    from fling.dataset.corruption_utils import pack_image_folder
+    if input_path is None or output_path is None:
+        raise ValueError('Both -i/--input_path and -o/--output_path are required by: fling pack')
+    index = pack_image_folder(input_path, output_path, corruptions, levels, num_workers)
+    click.echo(f"Packed {len(index['shards'])} shards into {output_path}.")
+
+
 def auto_convert(var: str):
     # Auto conversion.
     try:
@@ -16,3 +16,4 @@ from .fedactmad_client import FedActMADClient
 from .fedthe_client import FedTHEClient
 from .fedmemo_client import FedMEMOClient
 from .fedctta_client import FedCTTAClient
+from .batched_adapter import BatchedAdapter
@@ -0,0 +1,99 @@
+from typing import List, Sequence, Tuple
+
+import torch.nn as nn
+
+
+class AdaptationPlan:
+    r"""
+    Overview:
+        What the test-time adaptation of a client touches in its model, collected once in ``init_weight``.
+        TTA clients used to walk ``named_modules()`` in every round to find the BN layers, toggle ``requires_grad``, \
+    drop the running statistics of BN and collect the trainable parameters. The plan keeps the BN layers and the \
+    parameter lists, so each round only sets the flags on these lists. The modules and parameters of a model are not \
+    replaced after the weights are loaded (weights are copied in place), so the plan stays valid for the whole run.
+    """
+
+    def __init__(
+            self,
+            model: nn.Module,
+            trainable: str = 'all',
+            reset_bn_stats: bool = False,
+            exclude: Sequence[str] = ()
+    ):
+        r"""
+        Overview:
+            Initialization for the plan. Call ``train_mode`` or ``set_trainable`` to apply it.
+        Arguments:
+            model: the model of the client, with its final modules (e.g. after BN layers are replaced).
+            trainable: which parameters are adapted, one of the followings:
+                ``all``: all parameters.
+                ``bn``: only the parameters of BN layers.
+                ``none``: no parameters, e.g. for methods that only collect the statistics of BN layers.
+            reset_bn_stats: whether BN layers normalize with the statistics of each batch, i.e. their running \
+        statistics are removed.
+            exclude: parameters whose names contain any of these strings are not adapted, e.g. ``fc``.
+        """
+        self.model = model
+        # The BN layers, in the order of ``model.modules()``. Forward hooks of methods such as ActMAD are attached to
+        # these layers.
+        self.bn_modules = [m for m in model.modules() if isinstance(m, nn.BatchNorm2d)]
+        # All normalization layers with running statistics, including BN layers of other dimensions.
+        self.norm_modules = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        if trainable == 'all':
+            selected = set(id(p) for p in model.parameters())
+        elif trainable == 'bn':
+            selected = set(id(p) for m in self.bn_modules for p in m.parameters())
+        elif trainable == 'none':
+            selected = set()
+        else:
+            raise ValueError(f'Unrecognized trainable parameters: {trainable}')
+        self.trainable, self.frozen = [], []
+        for name, p in model.named_parameters():
+            if id(p) in selected and not any(e in name for e in exclude):
+                self.trainable.append(p)
+            else:
+                self.frozen.append(p)
+        # The ``weight`` and ``bias`` of each module with their full names, which are the parameters optimized by
+        # CoTTA-style methods and restored stochastically.
+        self.weight_bias = [(f'{nm}.{np}', p) for nm, m in model.named_modules()
+                            for np, p in m.named_parameters(recurse=False) if np in ['weight', 'bias']]
+        self.reset_bn_stats = reset_bn_stats
+
+    def set_trainable(self) -> None:
+        r"""
+        Overview:
+            Turn on the gradients of the trainable parameters only, and remove the running statistics of BN layers \
+        if ``reset_bn_stats``. The mode of the model is not changed.
+        """
+        for p in self.frozen:
+            p.requires_grad_(False)
+        for p in self.trainable:
+            p.requires_grad_(True)
+        if self.reset_bn_stats:
+            for m in self.bn_modules:
+                m.track_running_stats = False
+                m.running_mean = None
+                m.running_var = None
+
+    def train_mode(self) -> None:
+        r"""
+        Overview:
+            Put the model into the adaptation mode: train mode, and the flags of ``set_trainable``.
+        """
+        self.model.train()
+        self.set_trainable()
+
+    def bn_eval(self) -> None:
+        r"""
+        Overview:
+            Put only the BN layers into eval mode, i.e. normalize with their running statistics.
+        """
+        for m in self.norm_modules:
+            m.eval()
+
+    def named_trainable_weight_bias(self) -> List[Tuple[str, nn.Parameter]]:
+        r"""
+        Overview:
+            The ``weight`` and ``bias`` parameters that currently require gradients, with their full names.
+        """
+        return [(name, p) for name, p in self.weight_bias if p.requires_grad]
@@ -0,0 +1,180 @@
+import copy
+from typing import List
+
+import torch
+import torch.nn as nn
+
+from fling.utils.utils import VariableMonitor
+
+
+class BatchedAdapter:
+    r"""
+    Overview:
+        Adapt the models of several TTA clients in one pass.
+        The weights of all clients are stacked along a new leading dimension and a single functional model is mapped
+    over this dimension with ``torch.func.vmap``. Each adaptation step is then one batched forward and one backward
+    for all clients, instead of one forward and one backward for each of them. The loss and the regularizers are
+    computed by ``adapt_loss`` and ``adapt_regularizer`` of the clients, so the results are the same as calling
+    ``client.adapt`` serially.
+        Clients that can not be batched (different classes, methods with extra models such as ditto and moon, or
+    different numbers of test samples) fall back to ``client.adapt``.
+    """
+
+    def __init__(self, args: dict):
+        self.args = args
+        self.device = args.learn.device
+
+    def can_batch(self, clients: List) -> bool:
+        r"""
+        Overview:
+            Check whether all ``clients`` can be adapted in one pass.
+        """
+        if len(clients) < 2:
+            return False
+        try:
+            import torch.func  # noqa: F401
+        except ImportError:
+            return False
+        client_type = type(clients[0])
+        sample_num = len(clients[0].adapt_loader.dataset)
+        for client in clients:
+            if type(client) is not client_type or not getattr(client, 'supports_batched_adapt', False):
+                return False
+            if len(client.adapt_loader.dataset) != sample_num:
+                return False
+        return True
+
+    def adapt(self, clients: List) -> List[dict]:
+        r"""
+        Overview:
+            Adapt all ``clients`` on the data of their ``adapt_loader``.
+        Arguments:
+            clients: clients to be adapted. ``test_source`` must have been called on them.
+        Returns:
+            monitor_variables: the mean monitor variables of each client, the same as returned by ``client.adapt``.
+        """
+        if not self.can_batch(clients):
+            return [client.adapt(test_data=client.adapt_loader.dataset) for client in clients]
+        from torch.func import functional_call, stack_module_state, vmap
+
+        num = len(clients)
+        for client in clients:
+            client.residency.acquire(client.model, self.device)
+            client.adapt_train_mode()
+        models = [self._module(client.model) for client in clients]
+        base = copy.deepcopy(models[0]).to('meta')
+        base.train()
+
+        params, buffers = stack_module_state(models)
+        names = list(params.keys())
+        with torch.no_grad():
+            params_past = {k: v.detach().clone() for k, v in params.items()}
+        # The EMA teacher of methods such as CoTTA and FedCTTA.
+        use_teacher = hasattr(clients[0], 'ema_momentum')
+        teacher = {k: v.detach().clone() for k, v in params.items()} if use_teacher else None
+        optimizer, param_map = self._build_optimizer(clients, params)
+
+        template = clients[0]
+
+        def compute_loss(params, buffers, params_past, teacher, x):
+            outputs = functional_call(base, (params, buffers), (x, ))
+            outputs_teacher = functional_call(base, (teacher, buffers), (x, )) if teacher is not None else None
+            loss, y_pred = template.adapt_loss(outputs, outputs_teacher)
+            reg, reg_grad = template.adapt_regularizer([params[k] for k in names], [params_past[k] for k in names])
+            loss = loss + reg
+            return loss, loss + reg_grad, y_pred
+
+        batched_loss = vmap(compute_loss, in_dims=(0, 0, 0, 0 if use_teacher else None, 0), randomness='different')
+
+        monitors = [VariableMonitor() for _ in range(num)]
+        for batches in zip(*[client.adapt_loader for client in clients]):
+            optimizer.zero_grad()
+            preprocessed = [client.preprocess_data(data) for client, data in zip(clients, batches)]
+            batch_x = torch.stack([data['x'] for data in preprocessed])
+            batch_y = torch.stack([data['y'] for data in preprocessed])
+            loss, total, y_pred = batched_loss(params, buffers, params_past, teacher, batch_x)
+            total.sum().backward()
+            optimizer.step()
+            if use_teacher:
+                with torch.no_grad():
+                    torch._foreach_lerp_(
+                        [teacher[k] for k in names], [params[k].detach() for k in names], 1 - clients[0].ema_momentum
+                    )
+
+            # The metrics stay on the device, see ``VariableMonitor``.
+            acc = torch.mean((y_pred == batch_y).float(), dim=-1)
+            loss = loss.detach()
+            for i in range(num):
+                monitors[i].append({'test_acc': acc[i], 'test_loss': loss[i]}, weight=batch_y.shape[1])
+
+        self._write_back(clients, params, buffers, teacher, optimizer, param_map)
+        for client in clients:
+            client.residency.release(client.model)
+        return [monitor.variable_mean(materialize=False) for monitor in monitors]
+
+    @staticmethod
+    def _module(model: nn.Module) -> nn.Module:
+        # The original module of a model compiled by ``torch.compile``.
+        return getattr(model, '_orig_mod', model)
+
+    def _build_optimizer(self, clients: List, params: dict) -> tuple:
+        # Build an optimizer of the same type and hyper-parameters as the clients over the stacked parameters.
+        # The state of the client optimizers (e.g. the moments of Adam) is stacked in the same way.
+        optimizer = clients[0].optimizer
+        names = {id(p): k for k, p in self._module(clients[0].model).named_parameters()}
+        param_map, param_groups = [], []
+        for group in optimizer.param_groups:
+            group_names = [names[id(p)] for p in group['params']]
+            param_map.append(group_names)
+            param_groups.append(
+                {
+                    **{k: v
+                       for k, v in group.items() if k != 'params'}, 'params': [params[k] for k in group_names]
+                }
+            )
+        batched_optimizer = type(optimizer)(param_groups, lr=param_groups[0]['lr'])
+
+        for group_names in param_map:
+            for k in group_names:
+                states = [
+                    client.optimizer.state.get(self._module(client.model).get_parameter(k), {}) for client in clients
+                ]
+                if len(states[0]) == 0:
+                    continue
+                state = {}
+                for key, value in states[0].items():
+                    if torch.is_tensor(value) and value.shape == params[k].shape[1:]:
+                        state[key] = torch.stack([s[key] for s in states]).to(params[k].device)
+                    else:
+                        # Scalar states such as ``step`` are the same for all clients.
+                        state[key] = value.clone() if torch.is_tensor(value) else value
+                batched_optimizer.state[params[k]] = state
+        return batched_optimizer, param_map
+
+    def _write_back(
+            self, clients: List, params: dict, buffers: dict, teacher: dict, optimizer: torch.optim.Optimizer,
+            param_map: list
+    ) -> None:
+        # Copy the stacked weights and optimizer states back into each client.
+        with torch.no_grad():
+            for i, client in enumerate(clients):
+                model = self._module(client.model)
+                for k, p in model.named_parameters():
+                    p.copy_(params[k][i])
+                for k, b in model.named_buffers():
+                    b.copy_(buffers[k][i])
+                for group_names in param_map:
+                    for k in group_names:
+                        if params[k] not in optimizer.state:
+                            continue
+                        state = {}
+                        for key, value in optimizer.state[params[k]].items():
+                            if torch.is_tensor(value) and value.shape == params[k].shape:
+                                state[key] = value[i].clone()
+                            else:
+                                state[key] = value.clone() if torch.is_tensor(value) else value
+                        client.optimizer.state[model.get_parameter(k)] = state
+                if teacher is not None:
+                    client.sync_ema_teacher()
+                    for k, p in self._module(client.model_ema).named_parameters():
+                        p.copy_(teacher[k][i])
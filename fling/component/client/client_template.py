@@ -1,10 +1,15 @@
 import copy
-from typing import Callable, Iterable
+import torch
+import torch.nn as nn
+from typing import Callable, Iterable, List, Optional, Tuple
 from torch.optim.optimizer import Optimizer
+from torch.utils.data import DataLoader
 from torch.utils.data.dataset import Dataset
 
 from fling.model import get_model
-from fling.utils import VariableMonitor
+from fling.utils import VariableMonitor, get_residency_manager
+from fling.utils.data_utils import StreamBatch
+from fling.utils.regularizer_utils import ParamRegularizer, regularizer_loss
 
 
 class ClientTemplate:
@@ -12,6 +17,14 @@ class ClientTemplate:
     Overview:
         Template of client in Federated Learning.
     """
+    # Coefficients of the regularizers of the adaptation loss, see ``regularizer_kind``.
+    prox_coef = 0.01
+    graph_coef = 1.
+    # Whether the spatial-temporal aggregation of ``adapt_group`` regularizes the adaptation loss.
+    st_regularized = True
+    # Attributes only used inside the tasks of the client, which a ``MultiProcessLauncher`` does not send back to the
+    # main process. The adapt loader is rebuilt by each ``test_source`` from the test data of the round.
+    launcher_local_attributes = ('adapt_loader', )
 
     def __init__(self, args: dict, client_id: int, train_dataset: Dataset, test_dataset: Dataset = None):
         r"""
@@ -34,6 +47,179 @@ class ClientTemplate:
         # This attribute will not be set until ``self.set_fed_keys(self, keys)`` is called.
         # Only weights in ``self.fed_keys`` will be collaboratively trained using Federated Learning.
         self.fed_keys = []
+        # The parameter arena shared by all clients in the group, and the row of this client in it.
+        # This attribute will not be set until ``self.attach_arena(arena, index)`` is called.
+        self.arena = None
+        self.arena_index = None
+
+    @property
+    def residency(self):
+        r"""
+        Overview:
+            The residency manager shared by all clients in this process. Use ``self.residency.acquire(model)`` \
+        before running a model and ``self.residency.release(model)`` after it.
+        """
+        return get_residency_manager(self.args)
+
+    def get_adapt_loader(self, test_data: Dataset) -> Iterable:
+        r"""
+        Overview:
+            Get the loader over the test data of a TTA round, with batch size ``args.learn.batch_size``.
+            A ``StreamBatch`` is already collated, so it is only sliced into batches instead of being loaded by a \
+        ``DataLoader``.
+        Arguments:
+            - test_data: the test data of this round.
+        Returns:
+            - loader: an iterable of batches, whose attribute ``dataset`` is ``test_data``.
+        """
+        if isinstance(test_data, StreamBatch):
+            return test_data.loader(self.args.learn.batch_size)
+        return DataLoader(test_data, batch_size=self.args.learn.batch_size, shuffle=False)
+
+    def anchor_forward(self, data: dict, batch_x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""
+        Overview:
+            Get the features and logits of the frozen source model ``self.model_anchor`` on a batch.
+            If the batch carries the outputs of an ``AnchorOutputCache`` (see ``RoundBatchLoader``), these are \
+        used instead of running the model.
+        Arguments:
+            - data: the batch yielded by the adapt loader.
+            - batch_x: the input of the batch on ``self.device``.
+        Returns:
+            - feature: the features before the classifier.
+            - out: the logits.
+        """
+        if 'anchor_logit' in data:
+            return data['anchor_feature'].to(self.device), data['anchor_logit'].to(self.device)
+        return self.model_anchor(batch_x, mode='compute-feature-logit')
+
+    def sync_ema_teacher(self) -> nn.Module:
+        r"""
+        Overview:
+            Reset the EMA teacher ``self.model_ema`` to the current weights of ``self.model``, at the start of an \
+        adaptation round.
+            The teacher is allocated once and over-written in place in later rounds. It is only copied from the model \
+        again if the tensors of the model changed, e.g. the running statistics of BN layers were removed.
+        Returns:
+            - model_ema: the EMA teacher, without gradients.
+        """
+        src = self.model.state_dict(keep_vars=True)
+        ema = getattr(self, 'model_ema', None)
+        dst = None if ema is None else ema.state_dict(keep_vars=True)
+        if dst is None or list(dst.keys()) != list(src.keys()) or any(
+                d.shape != s.shape or d.dtype != s.dtype or d.device != s.device
+                for d, s in zip(dst.values(), src.values())):
+            self.model_ema = copy.deepcopy(self.model)
+            for param in self.model_ema.parameters():
+                param.detach_()
+            self.model_ema.requires_grad_(False)
+        else:
+            with torch.no_grad():
+                torch._foreach_copy_(list(dst.values()), list(src.values()))
+            for m_ema, m in zip(self.model_ema.modules(), self.model.modules()):
+                m_ema.training = m.training
+        return self.model_ema
+
+    def update_ema_teacher(self, momentum: float) -> None:
+        r"""
+        Overview:
+            Update the EMA teacher as ``ema = momentum * ema + (1 - momentum) * param`` with one fused op over all \
+        parameters.
+        Arguments:
+            - momentum: the momentum of the teacher.
+        """
+        with torch.no_grad():
+            torch._foreach_lerp_(
+                list(self.model_ema.parameters()), [p.detach() for p in self.model.parameters()], 1 - momentum
+            )
+
+    def regularizer_kind(self) -> Optional[Tuple[str, float]]:
+        r"""
+        Overview:
+            The regularizer of the adaptation loss in this group, by the distance to the weights of the model before \
+        the round: ``proximal`` for FedAMP, ``cosine`` for FedGraph and the spatial-temporal aggregation of \
+        ``adapt_group``, and ``l2_squared`` for FedProx. Clients set their coefficients by ``prox_coef`` and \
+        ``graph_coef``, and turn off the regularizers they do not use by ``prox_coef = None`` and \
+        ``st_regularized = False``.
+        Returns:
+            - kind_and_coef: ``(kind, coef)`` of ``ParamRegularizer``, or ``None`` if the loss is not regularized.
+        """
+        group = self.args.group
+        if group.name == 'fedamp_group':
+            return 'proximal', 0.5
+        elif group.name == 'fedgraph_group':
+            return 'cosine', self.graph_coef
+        elif 'fedprox' in self.args.other.method and self.prox_coef is not None:
+            return 'l2_squared', self.prox_coef
+        elif group.name == 'adapt_group' and group.aggregation_method == 'st' and self.st_regularized:
+            return 'cosine', self.graph_coef
+        return None
+
+    def regularizer_needs_past(self) -> bool:
+        r"""
+        Overview:
+            Whether the regularizer of the adaptation loss uses the weights of the model before the round.
+        """
+        return self.regularizer_kind() is not None
+
+    def get_regularizer(self, params_past: Optional[List[torch.Tensor]]) -> Optional[ParamRegularizer]:
+        r"""
+        Overview:
+            Get the ``ParamRegularizer`` of this round. Call ``reg = regularizer.apply()`` after the backward of \
+        the loss, which adds the gradient of the regularizer to the parameters, and report ``loss + reg``.
+        Arguments:
+            - params_past: the weights before the round, returned by ``snapshot_past``.
+        Returns:
+            - regularizer: the regularizer, or ``None`` if the loss is not regularized.
+        """
+        kind = self.regularizer_kind()
+        if kind is None or params_past is None:
+            return None
+        return ParamRegularizer(*kind, list(self.model.parameters()), params_past)
+
+    def adapt_regularizer(self, params: List[torch.Tensor], params_past: List[torch.Tensor]) -> Tuple:
+        r"""
+        Overview:
+            The differentiable form of the regularizer returned by ``get_regularizer``, used by ``BatchedAdapter``.
+        Returns:
+            - reg: the regularization added to the loss.
+            - reg_grad: the regularization that is only back-propagated.
+        """
+        kind = self.regularizer_kind()
+        if kind is None:
+            return 0, 0
+        return regularizer_loss(*kind, params, params_past)
+
+    def snapshot_past(self) -> Optional[List[torch.Tensor]]:
+        r"""
+        Overview:
+            Copy the parameters of ``self.model`` before an adaptation round, for the regularizer of the loss.
+            Nothing is copied if the regularizer of this group does not use them, see ``regularizer_needs_past``. \
+        Otherwise, the parameters are copied once into a flat vector, and the returned parameters are views of it.
+        Returns:
+            - params_past: the copied parameters in the order of ``self.model.parameters()``, or ``None``.
+        """
+        if not self.regularizer_needs_past():
+            return None
+        params = [p.detach() for p in self.model.parameters()]
+        flat_past = torch.cat([p.reshape(-1) for p in params])
+        return [v.view_as(p) for v, p in zip(flat_past.split([p.numel() for p in params]), params)]
+
+    def attach_arena(self, arena: object, index: int) -> None:
+        r"""
+        Overview:
+            Store the weights of the local model in row ``index`` of a ``ParameterArena``.
+            After that, ``update_model`` and ``get_state_dict`` read and write the arena directly.
+        Arguments:
+            - arena: the parameter arena shared by all clients of the group.
+            - index: the row of this client in ``arena``.
+        Returns:
+            - None
+        """
+        self.arena = arena
+        self.arena_index = index
+        if arena.models[index] is not self.model:
+            arena.bind(index, self.model)
 
     def set_fed_keys(self, keys: Iterable) -> None:
         r"""
@@ -56,6 +242,13 @@ class ClientTemplate:
         Returns:
             - None
         """
+        if self.arena is not None:
+            # Copy the values into the arena row. ``dic`` is not referenced afterwards, so no deep copy is needed.
+            if not self.arena.is_bound(self.arena_index):
+                self.arena.bind(self.arena_index, self.model)
+            self.arena.load(self.arena_index, dic)
+            return
+
         dic = copy.deepcopy(dic)
         state_dict = self.model.state_dict()
         state_dict.update(dic)
@@ -71,6 +264,8 @@ class ClientTemplate:
         Returns:
             - partial_dict: the acquired diction of parameters.
         """
+        if self.arena is not None and self.arena.is_bound(self.arena_index):
+            return self.arena.state_dict(self.arena_index, keys)
         state_dict = self.model.state_dict()
         partial_dict = {k: state_dict[k] for k in keys}
         return partial_dict
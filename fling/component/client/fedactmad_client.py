@@ -1,13 +1,13 @@
-import copy
 import torch
-from torch.utils.data import DataLoader
 import torch.nn as nn
 from typing import Iterable
 
 from fling.utils.registry_utils import CLIENT_REGISTRY
 from .client_template import ClientTemplate
+from .adaptation_plan import AdaptationPlan
 from fling.model import get_model
 from fling.utils.utils import VariableMonitor, SaveEmb
+from fling.utils.anchor_cache_utils import get_anchor_model
 
 
 @CLIENT_REGISTRY.register('fedactmad_client')
@@ -25,13 +25,12 @@ class FedActMADClient(ClientTemplate):
         # load state dict
         self.model.load_state_dict(ckpt)
         self.model_state = ckpt
-        self.model_anchor = copy.deepcopy(self.model)
+        self.model_anchor = get_anchor_model(self.model)
 
+        # All parameters are adapted, and the activations of BN layers are aligned.
+        self.plan = AdaptationPlan(self.model, 'all')
         self.model.requires_grad_(True)
-        self.chosen_layers = []
-        for m in self.model.modules():
-            if isinstance(m, nn.BatchNorm2d):
-                self.chosen_layers.append(m)
+        self.chosen_layers = self.plan.bn_modules
         self.n_chosen_layers = len(self.chosen_layers)
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.learn.optimizer.lr, betas=(0.9, 0.999), weight_decay=0.)
 
@@ -39,7 +38,7 @@ class FedActMADClient(ClientTemplate):
         return {'x': data['input'].to(self.device), 'y': data['class_id'].to(self.device)}
 
     def test_source(self, test_data):
-        self.adapt_loader = DataLoader(test_data, batch_size=self.args.learn.batch_size, shuffle=False)
+        self.adapt_loader = self.get_adapt_loader(test_data)
 
         self.model_anchor.eval()
         self.model_anchor.to(self.device)
@@ -55,7 +54,7 @@ class FedActMADClient(ClientTemplate):
                 # Update total sample number.
                 batch_x, batch_y = preprocessed_data['x'], preprocessed_data['y']
 
-                feature, out = self.model_anchor(batch_x, mode='compute-feature-logit')
+                feature, out = self.anchor_forward(data, batch_x)
                 y_pred = torch.argmax(out, dim=-1)
 
                 feature_mean = feature.mean(dim=0)
@@ -64,14 +63,14 @@ class FedActMADClient(ClientTemplate):
                 loss = criterion(out, batch_y)
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables, feature_indicator
 
     def softmax_entropy(self, x: torch.Tensor) -> torch.Tensor:
@@ -83,18 +82,15 @@ class FedActMADClient(ClientTemplate):
         self.global_feature_var = var
 
     def adapt(self, test_data, device=None, ap=0.72, mt=0.999, rst=0.01):
-        self.model.to(self.device)
-        self.model.train()
-        self.model.requires_grad_(True)
+        self.residency.acquire(self.model, self.device)
+        self.plan.train_mode()
         # adapt_loader = DataLoader(test_data, batch_size=self.args.learn.batch_size, shuffle=False)
         l1_loss = nn.L1Loss(reduction='mean')
         # Load Data
         for eps in range(1):
             monitor = VariableMonitor()
             for _, data in enumerate(self.adapt_loader):
-                for m in self.model.modules():
-                    if isinstance(m, nn.modules.batchnorm._BatchNorm):
-                        m.eval()
+                self.plan.bn_eval()
                 self.optimizer.zero_grad()
                 preprocessed_data = self.preprocess_data(data)
                 batch_x, batch_y = preprocessed_data['x'], preprocessed_data['y']
@@ -129,20 +125,20 @@ class FedActMADClient(ClientTemplate):
 
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
 
     def inference(self, classifier=None, device=None):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
 
         self.model.eval()
         self.model.requires_grad_(False)
@@ -159,14 +155,14 @@ class FedActMADClient(ClientTemplate):
             loss = criterion(outputs, batch_y)
             monitor.append(
                 {
-                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                    'test_loss': loss.item()
+                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                    'test_loss': loss
                 },
                 weight=preprocessed_data['y'].shape[0]
             )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
 
 
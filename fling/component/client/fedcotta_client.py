@@ -1,13 +1,13 @@
-import copy
 import torch
-from torch.utils.data import DataLoader
 import torch.nn as nn
 from typing import Iterable
 
 from fling.utils.registry_utils import CLIENT_REGISTRY
 from .client_template import ClientTemplate
+from .adaptation_plan import AdaptationPlan
 from fling.model import get_model
 from fling.utils.utils import VariableMonitor
+from fling.utils.anchor_cache_utils import get_anchor_model
 
 import torchvision.transforms as transforms
 import fling.component.client.my_transformers as my_transforms
@@ -28,32 +28,17 @@ class FedCoTTAClient(ClientTemplate):
         # load state dict
         self.model.load_state_dict(ckpt)
         self.model_state = ckpt
-        self.model_anchor = copy.deepcopy(self.model)
-        self.model.requires_grad_(False)
-        self.model.requires_grad_(False)
-        for m in self.model.modules():
-            if isinstance(m, nn.BatchNorm2d):
-                m.requires_grad_(True)
-                m.track_running_stats = False
-                m.running_mean = None
-                m.running_var = None
-            else:
-                m.requires_grad_(True)
-        # collect_params
-        names = []
-        params = []
-        for nm, m in self.model.named_modules():
-            if True:
-                for np, p in m.named_parameters():
-                    if np in ['weight', 'bias'] and p.requires_grad:
-                        params.append(p)
-                        names.append(f"{nm}.{np}")
+        self.model_anchor = get_anchor_model(self.model)
+        # All parameters are adapted, and BN layers use the statistics of each batch.
+        self.plan = AdaptationPlan(self.model, 'all', reset_bn_stats=True)
+        self.plan.train_mode()
+        params = [p for _, p in self.plan.named_trainable_weight_bias()]
         self.optimizer = torch.optim.Adam(params, lr=self.args.learn.optimizer.lr, betas=(0.9, 0.999), weight_decay=0.)
     def preprocess_data(self, data):
         return {'x': data['input'].to(self.device), 'y': data['class_id'].to(self.device)}
 
     def test_source(self, test_data):
-        self.adapt_loader = DataLoader(test_data, batch_size=self.args.learn.batch_size, shuffle=False)
+        self.adapt_loader = self.get_adapt_loader(test_data)
 
         self.model_anchor.eval()
         self.model_anchor.to(self.device)
@@ -69,7 +54,7 @@ class FedCoTTAClient(ClientTemplate):
                 # Update total sample number.
                 batch_x, batch_y = preprocessed_data['x'], preprocessed_data['y']
 
-                feature, out = self.model_anchor(batch_x, mode='compute-feature-logit')
+                feature, out = self.anchor_forward(data, batch_x)
                 y_pred = torch.argmax(out, dim=-1)
 
                 feature_mean = feature.mean(dim=0)
@@ -78,14 +63,14 @@ class FedCoTTAClient(ClientTemplate):
                 loss = criterion(out, batch_y)
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables, feature_indicator
 
     def get_tta_transforms(self, gaussian_std: float = 0.005, soft=False, clip_inputs=False):
@@ -125,44 +110,22 @@ class FedCoTTAClient(ClientTemplate):
         """Entropy of softmax distribution from logits."""
         return -(x_ema.softmax(1) * x.log_softmax(1)).sum(1)
 
-    def update_ema_variables(self, ema_model, model, alpha_teacher):
-        for ema_param, param in zip(ema_model.parameters(), model.parameters()):
-            ema_param.data[:] = alpha_teacher * ema_param[:].data[:] + (1 - alpha_teacher) * param[:].data[:]
-        return ema_model
-
     def adapt(self, test_data, device=None, ap=0.72, mt=0.999, rst=0.01):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
         self.model_anchor.to(self.device)
         self.model_anchor.requires_grad_(False)
-        self.model_ema = copy.deepcopy(self.model)
-        for param in self.model_ema.parameters():
-            param.detach_()
-        self.model_ema.to(self.device)
-        self.model_ema.requires_grad_(False)
-        self.model.requires_grad_(False)
-        # enable all params trainable
-        for m in self.model.modules():
-            if isinstance(m, nn.BatchNorm2d):
-                m.requires_grad_(True)
-                m.track_running_stats = False
-                m.running_mean = None
-                m.running_var = None
-            else:
-                m.requires_grad_(True)
-
-        self.model_past = copy.deepcopy(self.model)
-        self.model_past.cuda()
-        flatten_model_past = []
-        for param in self.model_past.parameters():
-            flatten_model_past.append(param.reshape(-1))
-        flatten_model_past = torch.cat(flatten_model_past)
+        # The EMA teacher starts from the current model in each round, and is over-written in place.
+        self.sync_ema_teacher().to(self.device)
+        self.plan.train_mode()
 
-        self.transform = self.get_tta_transforms()
+        # The weights before this round, only if the regularizer of the group uses them.
+        params_past = self.snapshot_past()
+        regularizer = self.get_regularizer(params_past)
 
-        self.model.train()
+        self.transform = self.get_tta_transforms()
 
         for eps in range(1):
             monitor = VariableMonitor()
@@ -173,7 +136,7 @@ class FedCoTTAClient(ClientTemplate):
                 outputs = self.model(batch_x)
 
                 # Teacher Prediction
-                anchor_prob = torch.nn.functional.softmax(self.model_anchor(batch_x), dim=1).max(1)[0]
+                anchor_prob = torch.nn.functional.softmax(self.anchor_forward(data, batch_x)[1], dim=1).max(1)[0]
                 standard_ema = self.model_ema(batch_x)
                 # Augmentation-averaged Prediction
                 N = 32
@@ -190,57 +153,33 @@ class FedCoTTAClient(ClientTemplate):
                 y_pred = torch.argmax(outputs_ema, dim=-1)
                 loss = (self.softmax_entropy_cotta(outputs, outputs_ema)).mean(0)
 
-                if self.args.group.name == 'fedamp_group':
-                    for param_p, param in zip(self.model_past.parameters(), self.model.parameters()):
-                        loss += (1.0 / 2) * torch.norm((param - param_p) ** 2)
-                elif self.args.group.name == 'fedgraph_group':
-                    flatten_model = []
-                    for param in self.model.parameters():
-                        flatten_model.append(param.reshape(-1))
-                    flatten_model = torch.cat(flatten_model)
-                    loss2 = torch.nn.functional.cosine_similarity(flatten_model.unsqueeze(0), flatten_model_past.unsqueeze(0))
-                    loss2.backward()
-                elif 'fedprox' in self.args.other.method:
-                    lambda_1 = 0.01
-                    for param_p, param in zip(self.model_past.parameters(), self.model.parameters()):
-                        loss += ((lambda_1 / 2) * torch.norm((param - param_p)) ** 2)
-                elif self.args.group.name == 'adapt_group' and self.args.group.aggregation_method == 'st':
-                    flatten_model = []
-                    for param in self.model.parameters():
-                        flatten_model.append(param.reshape(-1))
-                    flatten_model = torch.cat(flatten_model)
-                    loss2 = torch.nn.functional.cosine_similarity(flatten_model.unsqueeze(0),
-                                                                  flatten_model_past.unsqueeze(0))
-                    loss2.backward()
-
                 loss.backward()
+                if regularizer is not None:
+                    loss = loss + regularizer.apply()
                 self.optimizer.step()
                 # Teacher update
-                self.model_ema = self.update_ema_variables(ema_model=self.model_ema, model=self.model, alpha_teacher=mt)
+                self.update_ema_teacher(mt)
                 # Stochastic restore
-                if True:
-                    for nm, m in self.model.named_modules():
-                        for npp, p in m.named_parameters():
-                            if npp in ['weight', 'bias'] and p.requires_grad:
-                                mask = (torch.rand(p.shape) < rst).float().cuda()
-                                with torch.no_grad():
-                                    p.data = self.model_state[f"{nm}.{npp}"].cuda() * mask + p * (1. - mask)
+                for name, p in self.plan.named_trainable_weight_bias():
+                    mask = (torch.rand(p.shape) < rst).float().cuda()
+                    with torch.no_grad():
+                        p.data = self.model_state[name].cuda() * mask + p * (1. - mask)
 
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
-            mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+            mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
 
     def inference(self, classifier=None, device=None, ap=0.72, mt=0.999, rst=0.01):
         if device is not None:
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
         # if self.args.other.is_average:
 
 
@@ -277,7 +216,7 @@ class FedCoTTAClient(ClientTemplate):
                 outputs = self.model(batch_x)
 
                 # Teacher Prediction
-                anchor_prob = torch.nn.functional.softmax(self.model_anchor(batch_x), dim=1).max(1)[0]
+                anchor_prob = torch.nn.functional.softmax(self.anchor_forward(data, batch_x)[1], dim=1).max(1)[0]
                 standard_ema = self.model_ema(batch_x)
                 # Augmentation-averaged Prediction
                 N = 32
@@ -296,14 +235,14 @@ class FedCoTTAClient(ClientTemplate):
                 loss = criterion(outputs, batch_y)
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
 
 
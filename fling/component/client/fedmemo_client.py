@@ -1,6 +1,5 @@
 import copy
 import torch
-from torch.utils.data import DataLoader
 import torch.nn as nn
 from typing import Iterable
 
@@ -8,6 +7,7 @@ from fling.utils.registry_utils import CLIENT_REGISTRY
 from .client_template import ClientTemplate
 from fling.model import get_model
 from fling.utils.utils import VariableMonitor
+from fling.utils.anchor_cache_utils import get_anchor_model
 
 import torchvision.transforms as transforms
 from fling.dataset.aug_data import aug
@@ -33,6 +33,8 @@ def get_normalization(data_name):
 
 @CLIENT_REGISTRY.register('fedmemo_client')
 class FedMEMOClient(ClientTemplate):
+    # The spatial-temporal aggregation of ``adapt_group`` does not regularize the adaptation loss.
+    st_regularized = False
 
     def __init__(self, args: dict, client_id: int, train_dataset: Iterable = None, test_dataset: Iterable = None):
         super(FedMEMOClient, self).__init__(args, client_id, train_dataset, test_dataset)
@@ -46,7 +48,7 @@ class FedMEMOClient(ClientTemplate):
         # load state dict
         self.model.load_state_dict(ckpt)
         self.model_state = ckpt
-        self.model_anchor = copy.deepcopy(self.model)
+        self.model_anchor = get_anchor_model(self.model)
 
         self.model.requires_grad_(True)
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.learn.optimizer.lr, betas=(0.9, 0.999), weight_decay=0.)
@@ -55,7 +57,7 @@ class FedMEMOClient(ClientTemplate):
         return {'x': data['input'].to(self.device), 'y': data['class_id'].to(self.device)}
 
     def test_source(self, test_data):
-        self.adapt_loader = DataLoader(test_data, batch_size=self.args.learn.batch_size, shuffle=False)
+        self.adapt_loader = self.get_adapt_loader(test_data)
 
         self.model_anchor.eval()
         self.model_anchor.to(self.device)
@@ -71,7 +73,7 @@ class FedMEMOClient(ClientTemplate):
                 # Update total sample number.
                 batch_x, batch_y = preprocessed_data['x'], preprocessed_data['y']
 
-                feature, out = self.model_anchor(batch_x, mode='compute-feature-logit')
+                feature, out = self.anchor_forward(data, batch_x)
                 y_pred = torch.argmax(out, dim=-1)
 
                 feature_mean = feature.mean(dim=0)
@@ -80,14 +82,14 @@ class FedMEMOClient(ClientTemplate):
                 loss = criterion(out, batch_y)
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables, feature_indicator
 
     def marginal_entropy(self, outputs):
@@ -101,15 +103,12 @@ class FedMEMOClient(ClientTemplate):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
         self.model.requires_grad_(True)
 
-        self.model_past = copy.deepcopy(self.model)
-        self.model_past.cuda()
-        flatten_model_past = []
-        for param in self.model_past.parameters():
-            flatten_model_past.append(param.reshape(-1))
-        flatten_model_past = torch.cat(flatten_model_past)
+        # The weights before this round, only if the regularizer of the group uses them.
+        params_past = self.snapshot_past()
+        regularizer = self.get_regularizer(params_past)
 
         self.model.train()
         # turn on model grads.
@@ -137,22 +136,9 @@ class FedMEMOClient(ClientTemplate):
                     outputs = self.model(inputs)
                     loss, _ = self.marginal_entropy(outputs)
 
-                    if self.args.group.name == 'fedamp_group':
-                        for param_p, param in zip(self.model_past.parameters(), self.model.parameters()):
-                            loss += (1.0 / 2) * torch.norm((param - param_p) ** 2)
-                    elif self.args.group.name == 'fedgraph_group':
-                        flatten_model = []
-                        for param in self.model.parameters():
-                            flatten_model.append(param.reshape(-1))
-                        flatten_model = torch.cat(flatten_model)
-                        loss2 = torch.nn.functional.cosine_similarity(flatten_model.unsqueeze(0), flatten_model_past.unsqueeze(0))
-                        loss2.backward()
-                    elif 'fedprox' in self.args.other.method:
-                        lambda_1 = 0.01
-                        for param_p, param in zip(self.model_past.parameters(), self.model.parameters()):
-                            loss += ((lambda_1 / 2) * torch.norm((param - param_p)) ** 2)
-
                     loss.backward()
+                    if regularizer is not None:
+                        loss = loss + regularizer.apply()
                     self.optimizer.step()
 
                 y_pred = torch.argmax(self.model(batch_x[i]))
@@ -161,20 +147,20 @@ class FedMEMOClient(ClientTemplate):
             monitor.append(
                 {
                     'test_acc': float(correct / float(batch_x.shape[0])),
-                    'test_loss': loss.item()
+                    'test_loss': loss
                 },
                 weight=batch_y.shape[0]
             )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
 
     def inference(self, classifier=None, device=None):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
 
         self.model.eval()
         self.model.requires_grad_(False)
@@ -191,14 +177,14 @@ class FedMEMOClient(ClientTemplate):
             loss = criterion(outputs, batch_y)
             monitor.append(
                 {
-                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                    'test_loss': loss.item()
+                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                    'test_loss': loss
                 },
                 weight=preprocessed_data['y'].shape[0]
             )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
 
 
@@ -1,13 +1,14 @@
 import copy
 import torch
-from torch.utils.data import DataLoader
 import torch.nn as nn
 from typing import Iterable
 
 from fling.utils.registry_utils import CLIENT_REGISTRY
 from .client_template import ClientTemplate
+from .adaptation_plan import AdaptationPlan
 from fling.model import get_model
 from fling.utils.utils import VariableMonitor
+from fling.utils.anchor_cache_utils import get_anchor_model
 import torch.nn.functional as F
 import numpy as np
 from sklearn.decomposition import PCA
@@ -18,6 +19,8 @@ import PIL
 
 @CLIENT_REGISTRY.register('fedpl_client')
 class FedPLClient(ClientTemplate):
+    # Coefficient of the FedProx regularizer of the adaptation loss.
+    prox_coef = 1.
 
     def __init__(self, args: dict, client_id: int, train_dataset: Iterable = None, test_dataset: Iterable = None):
         super(FedPLClient, self).__init__(args, client_id, train_dataset, test_dataset)
@@ -28,6 +31,8 @@ class FedPLClient(ClientTemplate):
         self.model = get_model(args)
         self.feat_ema = None
         self.feat_ema2 = None
+        # Whether this client can be adapted by ``BatchedAdapter`` together with other clients.
+        self.supports_batched_adapt = args.other.method not in ['ditto', 'moon', 'pfedsd']
         if 'tiny' in args.data.dataset:
             self.model.avgpool = nn.AdaptiveAvgPool2d(1)
             num_features = self.model.fc.in_features
@@ -37,8 +42,10 @@ class FedPLClient(ClientTemplate):
         # load state dict
         self.model.load_state_dict(ckpt)
         self.model_state = ckpt
-        self.model_anchor = copy.deepcopy(self.model)
+        self.model_anchor = get_anchor_model(self.model)
 
+        # All parameters are adapted, and BN layers keep their running statistics.
+        self.plan = AdaptationPlan(self.model, 'all')
         self.model.requires_grad_(True)
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.learn.optimizer.lr, betas=(0.9, 0.999), weight_decay=0.)
 
@@ -55,7 +62,7 @@ class FedPLClient(ClientTemplate):
         return {'x': data['input'].to(self.device), 'y': data['class_id'].to(self.device)}
 
     def test_source(self, test_data):
-        self.adapt_loader = DataLoader(test_data, batch_size=self.args.learn.batch_size, shuffle=False)
+        self.adapt_loader = self.get_adapt_loader(test_data)
 
         self.model_anchor.eval()
         self.model_anchor.to(self.device)
@@ -71,7 +78,7 @@ class FedPLClient(ClientTemplate):
                 # Update total sample number.
                 batch_x, batch_y = preprocessed_data['x'], preprocessed_data['y']
 
-                feature, out = self.model_anchor(batch_x, mode='compute-feature-logit')
+                feature, out = self.anchor_forward(data, batch_x)
                 y_pred = torch.argmax(out, dim=-1)
                 
                 if self.args.method.feat_sim == 'pvec':
@@ -95,14 +102,14 @@ class FedPLClient(ClientTemplate):
                 loss = criterion(out, batch_y)
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
 
         if self.args.method.name == 'ours':
             if self.feat_ema2 is None:
@@ -123,25 +130,30 @@ class FedPLClient(ClientTemplate):
             self.prev_models.pop(0)
         self.prev_models.append(copy.deepcopy(model))
 
+    def adapt_train_mode(self):
+        self.plan.train_mode()
+
+    def adapt_loss(self, outputs, outputs_teacher=None):
+        # Returns the adaptation loss and the predicted labels of one batch.
+        y_pred = torch.argmax(outputs, dim=-1)
+        return F.cross_entropy(outputs, y_pred), y_pred
+
     def adapt(self, test_data, device=None, ap=0.72, mt=0.999, rst=0.01):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
         self.model.requires_grad_(True)
 
-        self.model_past = copy.deepcopy(self.model)
-        self.model_past.cuda()
-        flatten_model_past = []
-        for param in self.model_past.parameters():
-            flatten_model_past.append(param.reshape(-1))
-        flatten_model_past = torch.cat(flatten_model_past)
+        # The weights before this round, only if the regularizer of the group uses them.
+        params_past = self.snapshot_past()
+        regularizer = self.get_regularizer(params_past)
 
         if self.args.other.method == 'moon':
             self.glob_model = copy.deepcopy(self.model)
 
         criterion = nn.CrossEntropyLoss()
-        self.model.train()
+        self.adapt_train_mode()
         monitor = VariableMonitor()
         if self.args.other.method == 'ditto':
             self.local_model = copy.deepcopy(self.model)
@@ -165,8 +177,8 @@ class FedPLClient(ClientTemplate):
                         loss += ((lamda / 2) * torch.norm((param - param_p)) ** 2)
                     monitor.append(
                         {
-                            'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                            'test_loss': loss.item()
+                            'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                            'test_loss': loss
                         },
                         weight=preprocessed_data['y'].shape[0]
                     )
@@ -190,31 +202,10 @@ class FedPLClient(ClientTemplate):
                     preprocessed_data = self.preprocess_data(data)
                     batch_x, batch_y = preprocessed_data['x'], preprocessed_data['y']
                     z, outputs = self.model(batch_x, mode='compute-feature-logit')
-                    y_pred = torch.argmax(outputs, dim=-1)
-                    loss = criterion(outputs, y_pred)
+                    loss, y_pred = self.adapt_loss(outputs)
 
-                    if self.args.group.name == 'fedamp_group':
-                        for param_p, param in zip(self.model_past.parameters(), self.model.parameters()):
-                            loss += (1.0 / 2) * torch.norm((param - param_p) ** 2)
-                    elif self.args.group.name == 'fedgraph_group':
-                        flatten_model = []
-                        for param in self.model.parameters():
-                            flatten_model.append(param.reshape(-1))
-                        flatten_model = torch.cat(flatten_model)
-                        loss2 = torch.nn.functional.cosine_similarity(flatten_model.unsqueeze(0), flatten_model_past.unsqueeze(0))
-                        loss2.backward()
-                    elif 'fedprox' in self.args.other.method:
-                        lambda_1 = 1.
-                        for param_p, param in zip(self.model_past.parameters(), self.model.parameters()):
-                            loss += ((lambda_1 / 2) * torch.norm((param - param_p)) ** 2)
-                    elif self.args.group.name == 'adapt_group' and self.args.group.aggregation_method == 'st':
-                        flatten_model = []
-                        for param in self.model.parameters():
-                            flatten_model.append(param.reshape(-1))
-                        flatten_model = torch.cat(flatten_model)
-                        loss2 = torch.nn.functional.cosine_similarity(flatten_model.unsqueeze(0), flatten_model_past.unsqueeze(0))
-                        loss2.backward()
-                    elif self.args.other.method == 'pfedsd' and self.past_per_model is not None:
+                    # With a regularizer, its gradient is added after the backward of the loss instead, see below.
+                    if regularizer is None and self.args.other.method == 'pfedsd' and self.past_per_model is not None:
                         v_outputs = self.past_per_model(batch_x)
                         KL_temperature = 1.0
                         divergence = F.kl_div(
@@ -223,7 +214,7 @@ class FedPLClient(ClientTemplate):
                             reduction="batchmean",
                         )  # forward KL
                         loss += KL_temperature * KL_temperature * divergence
-                    elif self.args.other.method == 'moon' :
+                    elif regularizer is None and self.args.other.method == 'moon':
                         temperature = 0.5
                         mu = 1.0
                         # Calculate fedmoon loss.
@@ -246,12 +237,14 @@ class FedPLClient(ClientTemplate):
                         loss += mu * fedmoon_loss
 
                     loss.backward()
+                    if regularizer is not None:
+                        loss = loss + regularizer.apply()
                     self.optimizer.step()
 
                     monitor.append(
                         {
-                            'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                            'test_loss': loss.item()
+                            'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                            'test_loss': loss
                         },
                         weight=preprocessed_data['y'].shape[0]
                     )
@@ -262,8 +255,8 @@ class FedPLClient(ClientTemplate):
         elif self.args.other.method == 'moon':
             self._store_prev_model(self.model)
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
 
         return mean_monitor_variables
 
@@ -271,7 +264,7 @@ class FedPLClient(ClientTemplate):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
 
         self.model.eval()
         self.model.requires_grad_(False)
@@ -288,21 +281,21 @@ class FedPLClient(ClientTemplate):
             loss = criterion(outputs, batch_y)
             monitor.append(
                 {
-                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                    'test_loss': loss.item()
+                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                    'test_loss': loss
                 },
                 weight=preprocessed_data['y'].shape[0]
             )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
     
     def get_logits(self, test_data, classifier=None, device=None):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
 
         self.model.eval()
         self.model.requires_grad_(False)
@@ -324,7 +317,7 @@ class FedPLClient(ClientTemplate):
         else:
             self.feat_ema = self.args.other.alpha * self.feat_ema +  (1-self.args.other.alpha) * feature_indicator
 
-        self.model.to('cpu')
+        self.residency.release(self.model)
 
         return self.feat_ema
 
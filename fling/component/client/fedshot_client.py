@@ -1,18 +1,24 @@
 import copy
 import torch
-from torch.utils.data import DataLoader
 import torch.nn as nn
 from typing import Iterable
 
 from fling.utils.registry_utils import CLIENT_REGISTRY
 from .client_template import ClientTemplate
+from .adaptation_plan import AdaptationPlan
 from fling.model import get_model
 from fling.utils.utils import VariableMonitor
+from fling.utils.anchor_cache_utils import get_anchor_model
 
 import torch.nn.functional as F
 
 @CLIENT_REGISTRY.register('fedshot_client')
 class FedSHOTClient(ClientTemplate):
+    # Coefficients of the regularizers of the adaptation loss. The spatial-temporal aggregation of ``adapt_group`` does
+    # not regularize it.
+    prox_coef = 1.
+    graph_coef = -0.01
+    st_regularized = False
 
     def __init__(self, args: dict, client_id: int, train_dataset: Iterable = None, test_dataset: Iterable = None):
         super(FedSHOTClient, self).__init__(args, client_id, train_dataset, test_dataset)
@@ -30,10 +36,16 @@ class FedSHOTClient(ClientTemplate):
         # load state dict
         self.model.load_state_dict(ckpt)
         self.model_state = ckpt
-        self.model_anchor = copy.deepcopy(self.model)
+        self.model_anchor = get_anchor_model(self.model)
 
         self.model.requires_grad_(True)
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.learn.optimizer.lr, betas=(0.9, 0.999), weight_decay=0.)
+        if 'abc' in self.args.data.dataset:
+            # Only the affine parameters of BN layers are adapted, and BN layers use the statistics of each batch.
+            self.plan = AdaptationPlan(self.model, 'bn', reset_bn_stats=True)
+        else:
+            # All parameters except the classifier are adapted.
+            self.plan = AdaptationPlan(self.model, 'all', exclude=('fc', ))
 
         self.past_per_model = None
         if self.args.other.method == 'moon':
@@ -51,7 +63,7 @@ class FedSHOTClient(ClientTemplate):
         return -(x.softmax(1) * x.log_softmax(1)).sum(1)
 
     def test_source(self, test_data):
-        self.adapt_loader = DataLoader(test_data, batch_size=self.args.learn.batch_size, shuffle=False)
+        self.adapt_loader = self.get_adapt_loader(test_data)
 
         self.model_anchor.eval()
         self.model_anchor.to(self.device)
@@ -67,7 +79,7 @@ class FedSHOTClient(ClientTemplate):
                 # Update total sample number.
                 batch_x, batch_y = preprocessed_data['x'], preprocessed_data['y']
 
-                feature, out = self.model_anchor(batch_x, mode='compute-feature-logit')
+                feature, out = self.anchor_forward(data, batch_x)
                 y_pred = torch.argmax(out, dim=-1)
 
                 
@@ -86,14 +98,14 @@ class FedSHOTClient(ClientTemplate):
                 loss = criterion(out, batch_y)
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables, feature_indicator
 
     def _store_prev_model(self, model: nn.Module) -> None:
@@ -109,28 +121,8 @@ class FedSHOTClient(ClientTemplate):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
-        if 'abc' in self.args.data.dataset:
-            self.model.requires_grad_(False)
-            params, names = [], []
-            for nm, m in self.model.named_modules():
-                if isinstance(m, nn.BatchNorm2d):
-                    m.requires_grad_(True)
-                    m.track_running_stats = False
-                    m.running_mean = None
-                    m.running_var = None
-                    for np, p in m.named_parameters():
-                        if np in ['weight', 'bias']:
-                            params.append(p)
-                            names.append(f"{nm}.{np}")
-        else:
-            self.model.requires_grad_(False)
-            params, names = [], []
-            for np, p in self.model.named_parameters():
-                if 'fc' not in np:
-                    p.requires_grad_(True)
-                    params.append(p)
-                    names.append(f"{np}")
+        self.residency.acquire(self.model, self.device)
+        self.plan.set_trainable()
 
         # self.adapt_loader = DataLoader(test_data, batch_size=self.args.learn.batch_size, shuffle=False)
         self.sample_num = len(test_data)
@@ -138,12 +130,9 @@ class FedSHOTClient(ClientTemplate):
         if self.args.other.method == 'moon':
             self.glob_model = copy.deepcopy(self.model)
 
-        self.model_past = copy.deepcopy(self.model)
-        self.model_past.cuda()
-        flatten_model_past = []
-        for param in self.model_past.parameters():
-            flatten_model_past.append(param.reshape(-1))
-        flatten_model_past = torch.cat(flatten_model_past)
+        # The weights before this round, only if the regularizer of the group uses them.
+        params_past = self.snapshot_past()
+        regularizer = self.get_regularizer(params_past)
 
         self.model.train()
         criterion = nn.CrossEntropyLoss()
@@ -174,30 +163,8 @@ class FedSHOTClient(ClientTemplate):
                 clf_loss = 0
                 loss = ent_loss + theta * clf_loss
 
-                if self.args.group.name == 'fedamp_group':
-                    for param_p, param in zip(self.model_past.parameters(), self.model.parameters()):
-                        loss += (1.0 / 2) * torch.norm((param - param_p) ** 2)
-                elif self.args.group.name == 'fedgraph_group':
-                    flatten_model = []
-                    for param in self.model.parameters():
-                        flatten_model.append(param.reshape(-1))
-                    flatten_model = torch.cat(flatten_model)
-                    loss2 = -0.01 * torch.nn.functional.cosine_similarity(flatten_model.unsqueeze(0),
-                                                                  flatten_model_past.unsqueeze(0))
-                    loss2.backward()
-                elif 'fedprox' in self.args.other.method:
-                    lambda_1 = 1.
-                    for param_p, param in zip(self.model_past.parameters(), self.model.parameters()):
-                        loss += ((lambda_1 / 2) * torch.norm((param - param_p)) ** 2)
-                # elif self.args.group.name == 'adapt_group' and self.args.group.aggregation_method == 'st':
-                #     flatten_model = []
-                #     for param in self.model.parameters():
-                #         flatten_model.append(param.reshape(-1))
-                #     flatten_model = torch.cat(flatten_model)
-                #     loss2 = -0.01 * torch.nn.functional.cosine_similarity(flatten_model.unsqueeze(0),
-                #                                                   flatten_model_past.unsqueeze(0))
-                #     loss2.backward()
-                elif self.args.other.method == 'pfedsd' and self.past_per_model is not None:
+                # With a regularizer, its gradient is added after the backward of the loss instead, see below.
+                if regularizer is None and self.args.other.method == 'pfedsd' and self.past_per_model is not None:
                     v_outputs = self.past_per_model(batch_x)
                     KL_temperature = 1.0
                     divergence = F.kl_div(
@@ -206,7 +173,7 @@ class FedSHOTClient(ClientTemplate):
                         reduction="batchmean",
                     )  # forward KL
                     loss += KL_temperature * KL_temperature * divergence
-                elif self.args.other.method == 'moon':
+                elif regularizer is None and self.args.other.method == 'moon':
                     temperature = 0.5
                     mu = 1.0
                     # Calculate fedmoon loss.
@@ -229,14 +196,16 @@ class FedSHOTClient(ClientTemplate):
                     loss += mu * fedmoon_loss
 
                 loss.backward()
+                if regularizer is not None:
+                    regularizer.apply()
                 self.optimizer.step()
 
                 y_pred = torch.argmax(outputs, dim=-1)
                 loss = criterion(outputs, batch_y)
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
@@ -254,15 +223,15 @@ class FedSHOTClient(ClientTemplate):
         #                 with torch.no_grad():
         #                     p.data = self.model_state[f"{nm}.{npp}"].cuda() * mask + p * (1. - mask)
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
 
     def inference(self, classifier=None, device=None):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
 
         self.model.eval()
         self.model.requires_grad_(False)
@@ -280,12 +249,12 @@ class FedSHOTClient(ClientTemplate):
             loss = criterion(outputs, batch_y)
             monitor.append(
                 {
-                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                    'test_loss': loss.item()
+                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                    'test_loss': loss
                 },
                 weight=preprocessed_data['y'].shape[0]
             )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
@@ -1,18 +1,21 @@
-import copy
 import torch
-from torch.utils.data import DataLoader
 import torch.nn as nn
 from typing import Iterable
 
 from fling.utils.registry_utils import CLIENT_REGISTRY
 from .client_template import ClientTemplate
+from .adaptation_plan import AdaptationPlan
 from fling.model import get_model
 from fling.utils.utils import VariableMonitor
+from fling.utils.anchor_cache_utils import get_anchor_model
 from sklearn.decomposition import PCA
 
 
 @CLIENT_REGISTRY.register('fedtent_client')
 class FedTentClient(ClientTemplate):
+    # Only the regularizers of FedAMP and FedGraph are used.
+    prox_coef = None
+    st_regularized = False
 
     def __init__(self, args: dict, client_id: int, train_dataset: Iterable = None, test_dataset: Iterable = None):
         super(FedTentClient, self).__init__(args, client_id, train_dataset, test_dataset)
@@ -21,31 +24,25 @@ class FedTentClient(ClientTemplate):
         self.class_number = args.data.class_number
         self.adapt_iters = 1
         self.model = get_model(args)
+        # Whether this client can be adapted by ``BatchedAdapter`` together with other clients.
+        self.supports_batched_adapt = True
 
     def init_weight(self, ckpt):
         # load state dict
         self.model.load_state_dict(ckpt)
         self.model_state = ckpt
-        self.model_anchor = copy.deepcopy(self.model)
-        self.model.requires_grad_(False)
-        params, names = [], []
-        for nm, m in self.model.named_modules():
-            if isinstance(m, nn.BatchNorm2d):
-                m.requires_grad_(True)
-                m.track_running_stats = False
-                m.running_mean = None
-                m.running_var = None
-                for np, p in m.named_parameters():
-                    if np in ['weight', 'bias']:
-                        params.append(p)
-                        names.append(f"{nm}.{np}")
+        self.model_anchor = get_anchor_model(self.model)
+        # Only the affine parameters of BN layers are adapted, and BN layers use the statistics of each batch.
+        self.plan = AdaptationPlan(self.model, 'bn', reset_bn_stats=True)
+        self.plan.train_mode()
+        params = [p for _, p in self.plan.named_trainable_weight_bias()]
         self.optimizer = torch.optim.Adam(params, lr=self.args.learn.optimizer.lr, betas=(0.9, 0.999), weight_decay=0.)
 
     def preprocess_data(self, data):
         return {'x': data['input'].to(self.device), 'y': data['class_id'].to(self.device)}
 
     def test_source(self, test_data):
-        self.adapt_loader = DataLoader(test_data, batch_size=self.args.learn.batch_size, shuffle=False)
+        self.adapt_loader = self.get_adapt_loader(test_data)
 
         self.model_anchor.eval()
         self.model_anchor.to(self.device)
@@ -61,7 +58,7 @@ class FedTentClient(ClientTemplate):
                 # Update total sample number.
                 batch_x, batch_y = preprocessed_data['x'], preprocessed_data['y']
 
-                feature, out = self.model_anchor(batch_x, mode='compute-feature-logit')
+                feature, out = self.anchor_forward(data, batch_x)
                 y_pred = torch.argmax(out, dim=-1)
 
                 # feature_mean = feature.mean(dim=0)
@@ -85,48 +82,40 @@ class FedTentClient(ClientTemplate):
                 loss = criterion(out, batch_y)
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables, feature_indicator
 
     def softmax_entropy(self, x: torch.Tensor) -> torch.Tensor:
         """Entropy of softmax distribution from logits."""
         return -(x.softmax(1) * x.log_softmax(1)).sum(1)
 
+    def adapt_train_mode(self):
+        # Turn on grads of BN layers and normalize with batch statistics.
+        self.plan.train_mode()
+
+    def adapt_loss(self, outputs, outputs_teacher=None):
+        # Returns the adaptation loss and the predicted labels of one batch.
+        return self.softmax_entropy(outputs).mean(0), torch.argmax(outputs, dim=-1)
+
     def adapt(self, test_data, device=None):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
         self.sample_num = len(test_data)
 
-        self.model_past = copy.deepcopy(self.model)
-        self.model_past.cuda()
-        flatten_model_past = []
-        for param in self.model_past.parameters():
-            flatten_model_past.append(param.reshape(-1))
-        flatten_model_past = torch.cat(flatten_model_past)
+        # The weights before this round, only if the regularizer of the group uses them.
+        params_past = self.snapshot_past()
 
-        # Turn on model grads. collect_params
-        self.model.requires_grad_(False)
-        params, names = [], []
-        for nm, m in self.model.named_modules():
-            if isinstance(m, nn.BatchNorm2d):
-                m.requires_grad_(True)
-                m.track_running_stats = False
-                m.running_mean = None
-                m.running_var = None
-                for np, p in m.named_parameters():
-                    if np in ['weight', 'bias']:
-                        params.append(p)
-                        names.append(f"{nm}.{np}")
-        self.model.train()
+        self.adapt_train_mode()
+        regularizer = self.get_regularizer(params_past)
         # Get Local TTA
         monitor = VariableMonitor()
 
@@ -137,40 +126,29 @@ class FedTentClient(ClientTemplate):
                 batch_x, batch_y = preprocessed_data['x'], preprocessed_data['y']
 
                 out = self.model(batch_x)
-                y_pred = torch.argmax(out, dim=-1)
-
-                loss = self.softmax_entropy(out).mean(0)
-
-                if self.args.group.name == 'fedamp_group':
-                    for param_p, param in zip(self.model_past.parameters(), self.model.parameters()):
-                        loss += (1.0 / 2) * torch.norm((param - param_p) ** 2)
-                elif self.args.group.name == 'fedgraph_group':
-                    flatten_model = []
-                    for param in self.model.parameters():
-                        flatten_model.append(param.reshape(-1))
-                    flatten_model = torch.cat(flatten_model)
-                    loss2 = torch.nn.functional.cosine_similarity(flatten_model.unsqueeze(0), flatten_model_past.unsqueeze(0))
-                    loss2.backward()
+                loss, y_pred = self.adapt_loss(out)
+                loss.backward()
+                if regularizer is not None:
+                    loss = loss + regularizer.apply()
 
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
-                loss.backward()
                 self.optimizer.step()
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
 
     def inference(self, classifier=None, device=None):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
 
         self.model.eval()
         self.model.requires_grad_(False)
@@ -187,14 +165,14 @@ class FedTentClient(ClientTemplate):
             loss = criterion(outputs, batch_y)
             monitor.append(
                 {
-                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                    'test_loss': loss.item()
+                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                    'test_loss': loss
                 },
                 weight=preprocessed_data['y'].shape[0]
             )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
 
 
@@ -1,13 +1,13 @@
-import copy
 import torch
-from torch.utils.data import DataLoader
 import torch.nn as nn
 from typing import Iterable
 
 from fling.utils.registry_utils import CLIENT_REGISTRY
 from .client_template import ClientTemplate
+from .adaptation_plan import AdaptationPlan
 from fling.model import get_model
 from fling.utils.utils import VariableMonitor
+from fling.utils.anchor_cache_utils import get_anchor_model
 
 from fling.model.GlobalBatchNorm import CustomResNeXt
 
@@ -32,21 +32,20 @@ class FedTTAClient(ClientTemplate):
         # load state dict
         self.model.load_state_dict(ckpt)
         self.model_state = ckpt
-        self.model_anchor = copy.deepcopy(self.model)
+        self.model_anchor = get_anchor_model(self.model)
         # replace Custom Batch Normalization with Self-defined BN
         self.model = CustomResNeXt(self.model)
 
-        self.chosen_layers = []
-        for m in self.model.modules():
-            if isinstance(m, nn.BatchNorm2d):
-                self.chosen_layers.append(m)
+        # No parameters are adapted, only the statistics of BN layers are collected.
+        self.plan = AdaptationPlan(self.model, 'none')
+        self.chosen_layers = self.plan.bn_modules
         self.n_chosen_layers = len(self.chosen_layers)
 
     def preprocess_data(self, data):
         return {'x': data['input'].to(self.device), 'y': data['class_id'].to(self.device)}
 
     def test_source(self, test_data):
-        self.adapt_loader = DataLoader(test_data, batch_size=self.args.learn.batch_size, shuffle=False)
+        self.adapt_loader = self.get_adapt_loader(test_data)
 
         self.model_anchor.eval()
         self.model_anchor.to(self.device)
@@ -62,7 +61,7 @@ class FedTTAClient(ClientTemplate):
                 # Update total sample number.
                 batch_x, batch_y = preprocessed_data['x'], preprocessed_data['y']
 
-                feature, out = self.model_anchor(batch_x, mode='compute-feature-logit')
+                feature, out = self.anchor_forward(data, batch_x)
                 y_pred = torch.argmax(out, dim=-1)
 
                 # feature_mean = feature.mean(dim=0)
@@ -89,14 +88,14 @@ class FedTTAClient(ClientTemplate):
                 loss = criterion(out, batch_y)
                 monitor.append(
                     {
-                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                        'test_loss': loss.item()
+                        'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                        'test_loss': loss
                     },
                     weight=preprocessed_data['y'].shape[0]
                 )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
 
         if self.args.method.name == 'ours':
             if self.feat_ema2 is None:
@@ -111,23 +110,19 @@ class FedTTAClient(ClientTemplate):
     def update_bnstatistics(self, clean_mean, clean_var):
         self.global_mean = clean_mean
         self.global_var = clean_var
-        idx = 0
-        for nm, m in self.model.named_modules():
-            if isinstance(m, nn.BatchNorm2d):
-                m.weighted_mean = clean_mean[idx]
-                m.weighted_var = clean_var[idx]
-                idx += 1
+        for idx, m in enumerate(self.plan.bn_modules):
+            m.weighted_mean = clean_mean[idx]
+            m.weighted_var = clean_var[idx]
 
     def adapt(self, test_data, device=None):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
         self.sample_num = len(test_data)
 
-        # Turn on model grads. collect_params
-        self.model.requires_grad_(False)
-        self.model.train()
+        # Turn off model grads, BN layers collect the statistics of the batches.
+        self.plan.train_mode()
         # Get Local TTA
         criterion = nn.CrossEntropyLoss()
         monitor = VariableMonitor()
@@ -144,25 +139,24 @@ class FedTTAClient(ClientTemplate):
                     loss = criterion(out, batch_y)
                     monitor.append(
                         {
-                            'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                            'test_loss': loss.item()
+                            'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                            'test_loss': loss
                         },
                         weight=preprocessed_data['y'].shape[0]
                     )
 
-                for nm, m in self.model.named_modules():
-                    if isinstance(m, nn.BatchNorm2d):
-                        self.clean_mean.append(torch.cat([m.batch_mean, m.batch_var], dim=0))
+                for m in self.plan.bn_modules:
+                    self.clean_mean.append(torch.cat([m.batch_mean, m.batch_var], dim=0))
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return self.clean_mean, mean_monitor_variables
 
     def inference(self, classifier=None, device=None):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
 
         self.model.eval()
         self.model.requires_grad_(False)
@@ -179,21 +173,21 @@ class FedTTAClient(ClientTemplate):
             loss = criterion(outputs, batch_y)
             monitor.append(
                 {
-                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                    'test_loss': loss.item()
+                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                    'test_loss': loss
                 },
                 weight=preprocessed_data['y'].shape[0]
             )
 
-        mean_monitor_variables = monitor.variable_mean()
-        self.model.to('cpu')
+        mean_monitor_variables = monitor.variable_mean(materialize=False)
+        self.residency.release(self.model)
         return mean_monitor_variables
 
     def get_logits(self, test_data, classifier=None, device=None):
         if device is not None:
             device_bak = self.device
             self.device = device
-        self.model.to(self.device)
+        self.residency.acquire(self.model, self.device)
 
         self.model.eval()
         self.model.requires_grad_(False)
@@ -216,7 +210,7 @@ class FedTTAClient(ClientTemplate):
         else:
             self.feat_ema = self.args.other.alpha * self.feat_ema +  (1-self.args.other.alpha) * feature_indicator
 
-        self.model.to('cpu')
+        self.residency.release(self.model)
 
         return self.feat_ema
 
@@ -5,7 +5,7 @@ import matplotlib.pyplot as plt
 from fling.utils import get_params_number
 from fling.utils.compress_utils import *
 from fling.utils.registry_utils import GROUP_REGISTRY
-from fling.utils import VariableMonitor
+from fling.utils import VariableMonitor, RingHistory
 from fling.component.client import ClientTemplate
 import torch
 from functools import reduce
@@ -28,11 +28,21 @@ class TTAServerGroup(ParameterServerGroup):
             Implementation of the group in FedTTA
         """
         super(TTAServerGroup, self).__init__(args, logger)
+        # Histories of the BN statistics of each chosen layer, and of the feature indicators.
+        # Only the last ``time_slide`` steps are kept, see ``RingHistory``.
         self.history_feature = []
         self.history_weight = [[] for _ in range(args.client.client_num)]
-        self.indicator = torch.tensor([])
+        self.indicator = None
         self.time_slide = 10
         self.collaboration_graph = []
+        # The ``ST_block`` kept across rounds by ``ST_attention``, see ``get_st_model``.
+        self.st_model = None
+        self.st_optimizer = None
+        self.st_rounds = 0
+        if args.group.aggregation_engine == 'flat':
+            self.flat_aggregator = FlatAggregator(device=args.learn.device)
+        elif args.group.aggregation_engine != 'state_dict':
+            raise ValueError(f'Unrecognized aggregation engine: {args.group.aggregation_engine}')
 
 
     def initialize(self) -> None:
@@ -82,6 +92,7 @@ class TTAServerGroup(ParameterServerGroup):
         self.set_fed_keys()
 
         # Step 3.
+        self.build_arena()
         if not self.args.other.resume:
             self.sync()
 
@@ -93,6 +104,15 @@ class TTAServerGroup(ParameterServerGroup):
         )
 
     def st_agg_grad(self, time_att=None, space_att=None, wotime=False):
+        if self.arena is not None:
+            # The weights of all clients are already rows of the arena.
+            self.arena.mix(space_att)
+            return
+        if self.args.group.aggregation_engine == 'flat':
+            # Weights of client ``cidx`` become ``sum_s space_att[cidx, s] * W[s]``, computed as one matmul.
+            self.flat_aggregator.mix([client.model for client in self.clients], space_att)
+            return
+
         client_num = self.args.client.client_num
         # time_att = torch.mean(time_att, dim=1)
         weight_list = []
@@ -227,6 +247,12 @@ class TTAServerGroup(ParameterServerGroup):
             time_att, space_att = self.ST_attention(feature_indicator)
             self.st_agg_grad(time_att, space_att)
 
+        elif self.args.group.aggregation_method == 'avg' and self.arena is not None:
+            self.arena.average()
+
+        elif self.args.group.aggregation_method == 'avg' and self.args.group.aggregation_engine == 'flat':
+            self.flat_aggregator.average([client.model for client in self.clients])
+
         elif self.args.group.aggregation_method == 'avg':
             total_samples = float(sum([client.sample_num for client in self.clients]))
             w_avg = copy.deepcopy(self.clients[0].model.state_dict())
@@ -255,17 +281,32 @@ class TTAServerGroup(ParameterServerGroup):
         if self.args.group.aggregation_method != 'avg':
             self.collaboration_graph.append(space_att)
 
+    def history_capacity(self):
+        # Only the last ``time_slide`` steps of the histories are read.
+        return max(self.time_slide, self.args.other.time_slide)
+
+    def append_indicator(self, feature_indicator):
+        if self.indicator is None:
+            self.indicator = RingHistory(self.history_capacity())
+        self.indicator.append(torch.stack(feature_indicator, dim=0))
+
+    def append_history_feature(self, global_mean):
+        # global_mean[ cidx ][ chosen_layer ][ D(mean) ]
+        n_chosen_layer = len(global_mean[0])
+        client_num = self.args.client.client_num
+        if len(self.history_feature) == 0:
+            self.history_feature = [RingHistory(self.history_capacity()) for _ in range(n_chosen_layer)]
+        for chosen_layer in range(n_chosen_layer):
+            feature_t = torch.stack([global_mean[cidx][chosen_layer] for cidx in range(client_num)], dim=0)
+            self.history_feature[chosen_layer].append(feature_t)
+
     def st_agg_bn(self, time_att=None, space_att=None, global_mean=None, wotime=False):
         n_chosen_layer = len(global_mean[0])
         client_num = self.args.client.client_num
         sum_mean = [[[] for _ in range(n_chosen_layer)] for _ in range(client_num)]
         sum_var = [[[] for _ in range(n_chosen_layer)] for _ in range(client_num)]
         for chosen_layer in range(n_chosen_layer):
-            if self.history_feature[0].shape[1] < self.time_slide:
-                feature_input = self.history_feature[chosen_layer][:, :, :]
-            else:
-                T_all = self.history_feature[chosen_layer].shape[1]
-                feature_input = self.history_feature[chosen_layer][:, T_all - self.time_slide:, :]
+            feature_input = self.history_feature[chosen_layer].last(self.time_slide)
             N, T, D = feature_input.shape
             heads = 1
             if not wotime:
@@ -290,21 +331,7 @@ class TTAServerGroup(ParameterServerGroup):
         # Store feature mean and variance
         n_chosen_layer = len(global_mean[0])
         client_num = self.args.client.client_num
-        if len(self.history_feature) == 0:
-            self.history_feature = [[] for _ in range(n_chosen_layer)]
-            for chosen_layer in range(n_chosen_layer):
-                feature_t = []
-                for cidx in range(client_num):
-                    feature_t.append(global_mean[cidx][chosen_layer])
-                feature_t = torch.stack(feature_t, dim=0)
-                self.history_feature[chosen_layer] = feature_t.unsqueeze(1)
-        else:
-            for chosen_layer in range(n_chosen_layer):
-                feature_t = []
-                for cidx in range(client_num):
-                    feature_t.append(global_mean[cidx][chosen_layer])
-                feature_t = torch.stack(feature_t, dim=0)
-                self.history_feature[chosen_layer] = torch.cat([self.history_feature[chosen_layer], feature_t.unsqueeze(1)], dim=1)
+        self.append_history_feature(global_mean)
 
         # calculate aggregation rate & aggregate model weight
         sum_mean = [[[] for _ in range(n_chosen_layer)] for _ in range(client_num)]
@@ -343,21 +370,7 @@ class TTAServerGroup(ParameterServerGroup):
         # Store feature mean and variance
         n_chosen_layer = len(global_mean[0])
         client_num = self.args.client.client_num
-        if len(self.history_feature) == 0:
-            self.history_feature = [[] for _ in range(n_chosen_layer)]
-            for chosen_layer in range(n_chosen_layer):
-                feature_t = []
-                for cidx in range(client_num):
-                    feature_t.append(global_mean[cidx][chosen_layer])
-                feature_t = torch.stack(feature_t, dim=0)
-                self.history_feature[chosen_layer] = feature_t.unsqueeze(1)
-        else:
-            for chosen_layer in range(n_chosen_layer):
-                feature_t = []
-                for cidx in range(client_num):
-                    feature_t.append(global_mean[cidx][chosen_layer])
-                feature_t = torch.stack(feature_t, dim=0)
-                self.history_feature[chosen_layer] = torch.cat([self.history_feature[chosen_layer], feature_t.unsqueeze(1)], dim=1)
+        self.append_history_feature(global_mean)
 
         # calculate aggregation rate & aggregate model weight
         sum_mean = [[[] for _ in range(n_chosen_layer)] for _ in range(client_num)]
@@ -408,24 +421,18 @@ class TTAServerGroup(ParameterServerGroup):
         :return: weight1, weight2
         '''
 
-        feature_indicator = torch.stack(feature_indicator, dim=0)
-        if self.indicator.shape[0] == 0:
-            self.indicator = feature_indicator.unsqueeze(1)
-        else:
-            self.indicator = torch.cat([self.indicator, feature_indicator.unsqueeze(1)], dim=1)
+        self.append_indicator(feature_indicator)
 
         # print(self.indicator.shape)
 
         # Get Aggregate Weights with Trainable Modules
         self.time_slide = self.args.other.time_slide
-        if self.indicator.shape[1] < self.time_slide:
-            feature_input = self.indicator[:, :, :]
-        else:
-            feature_input = self.indicator[:, self.indicator.shape[1]-self.time_slide:, :]
-        ST_model = ST_block(args=self.args, dim=feature_input.shape[2])
-        ST_model.cuda()
-        opt = torch.optim.Adam(ST_model.parameters(), lr=self.args.other.st_lr)
+        feature_input = self.indicator.last(self.time_slide)
+        cached = self.args.other.st_mode == 'cached'
+        ST_model, opt = self.get_st_model(dim=feature_input.shape[2], device=feature_input.device)
         loss_min = 1000000
+        # Number of epochs since the loss was last improved by more than ``st_tol``, used for early stopping.
+        stall = 0
         epoch_num = self.args.other.st_epoch
         for epoch in range(epoch_num):
             # print('Epoch {}'.format(epoch))
@@ -437,10 +444,14 @@ class TTAServerGroup(ParameterServerGroup):
 
             loss = (loss_reg + self.args.other.robust_weight * loss_robust)
 
-            if loss.item() < loss_min:
+            loss_value = loss.item()
+            stall = 0 if loss_value < loss_min - self.args.other.st_tol * abs(loss_min) else stall + 1
+            if loss_value < loss_min:
                 time_att = t_sim
                 space_att = s_sim
-                loss_min = loss.item()
+                loss_min = loss_value
+            if cached and 0 < self.args.other.st_patience <= stall:
+                break
 
             opt.zero_grad()
             loss.backward()
@@ -449,9 +460,42 @@ class TTAServerGroup(ParameterServerGroup):
             # print('loss = {:.4f} + {:.4f} + {:.4f} = {:.4f}(min {:.4f})'.format(loss_reg.item(), loss_consist.item(),
             #                                                                     loss_robust.item(), loss.item(),
             #                                                                     loss_min))
-        torch.cuda.empty_cache()
+        if not cached:
+            torch.cuda.empty_cache()
         return time_att, space_att
 
+    def get_st_model(self, dim, device):
+        r"""
+        Overview:
+            Get the ``ST_block`` and its optimizer used by ``ST_attention`` in this round.
+            If ``args.other.st_mode`` is ``'scratch'``, a new model is built from the identity initialization in \
+        every round. If it is ``'cached'``, the model and the state of its optimizer are kept across rounds, so \
+        the training of each round starts from the result of the last round, whose input only differs by one time \
+        step. The cached model is built again when the feature dimension changes, or every \
+        ``args.other.st_refresh_interval`` rounds if it is positive.
+        Arguments:
+            dim: the dimension of the feature indicators.
+            device: the device of the feature indicators.
+        Returns:
+            ST_model: the ``ST_block`` model.
+            opt: the Adam optimizer of ``ST_model``.
+        """
+        mode = self.args.other.st_mode
+        if mode not in ['cached', 'scratch']:
+            raise ValueError(f'Unrecognized ST training mode: {mode}')
+        refresh_interval = self.args.other.st_refresh_interval
+        if mode == 'scratch' or self.st_model is None or self.st_model.dim != dim or \
+                (refresh_interval > 0 and self.st_rounds >= refresh_interval):
+            self.st_model = ST_block(args=self.args, dim=dim).to(device)
+            self.st_optimizer = torch.optim.Adam(self.st_model.parameters(), lr=self.args.other.st_lr)
+            self.st_rounds = 0
+        self.st_rounds += 1
+        ST_model, opt = self.st_model, self.st_optimizer
+        if mode == 'scratch':
+            # Do not keep the model, so that it is released after this round as in the original implementation.
+            self.st_model, self.st_optimizer = None, None
+        return ST_model, opt
+
     # def ST_attention(self, feature_indicator, wotime=False):
     #     '''
     #     :param feature_indicator: global_mean[ cidx ][ chosen_layer ][ D(mean) ]
@@ -513,17 +557,10 @@ class TTAServerGroup(ParameterServerGroup):
     #     return time_att, space_att
 
     def ST_similarity(self, feature_indicator):
-        feature_indicator = torch.stack(feature_indicator, dim=0)
-        if self.indicator.shape[0] == 0:
-            self.indicator = feature_indicator.unsqueeze(1)
-        else:
-            self.indicator = torch.cat([self.indicator, feature_indicator.unsqueeze(1)], dim=1)
+        self.append_indicator(feature_indicator)
 
         self.time_slide = self.args.other.time_slide
-        if self.indicator.shape[1] < self.time_slide:
-            feature_input = self.indicator[:, :, :]
-        else:
-            feature_input = self.indicator[:, self.indicator.shape[1] - self.time_slide:, :]
+        feature_input = self.indicator.last(self.time_slide)
         ST_model = ST_block(args=self.args, dim=feature_input.shape[2])
         ST_model.cuda()
         logits, mask_logits, aug_logits, t_sim, s_sim = ST_model(feature_input)
@@ -534,16 +571,9 @@ class TTAServerGroup(ParameterServerGroup):
         return time_att, space_att
 
     def S_similarity(self, feature_indicator):
-        feature_indicator = torch.stack(feature_indicator, dim=0)
-        if self.indicator.shape[0] == 0:
-            self.indicator = feature_indicator.unsqueeze(1)
-        else:
-            self.indicator = torch.cat([self.indicator, feature_indicator.unsqueeze(1)], dim=1)
+        self.append_indicator(feature_indicator)
         self.time_slide = self.args.other.time_slide
-        if self.indicator.shape[1] < self.time_slide:
-            feature_input = self.indicator[:, :, :]
-        else:
-            feature_input = self.indicator[:, self.indicator.shape[1] - self.time_slide:, :]
+        feature_input = self.indicator.last(self.time_slide)
         SA = SpatialAttention(dim=feature_input.shape[2], heads=1)
         SA.requires_grad_(False)
         SA.cuda()
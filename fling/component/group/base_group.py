@@ -4,7 +4,7 @@ import torch
 from fling.utils import get_params_number
 from fling.utils.compress_utils import fed_avg
 from fling.utils.registry_utils import GROUP_REGISTRY
-from fling.utils import Logger, get_weights
+from fling.utils import Logger, get_weights, ParameterArena
 from fling.component.client import ClientTemplate
 
 
@@ -32,6 +32,9 @@ class ParameterServerGroup:
         self.args = args
         self.logger = logger
         self._time = time.time()
+        # The parameter arena shared by all clients. It is built in ``self.initialize()`` if
+        # ``args.group.parameter_arena`` is ``True``.
+        self.arena = None
 
     def initialize(self) -> None:
         r"""
@@ -64,6 +67,7 @@ class ParameterServerGroup:
         self.set_fed_keys()
 
         # Step 3.
+        self.build_arena()
         self.sync()
 
         # Logging model information.
@@ -104,7 +108,7 @@ class ParameterServerGroup:
                 client.set_fed_keys(new_fed_keys)
 
         if self.args.group.aggregation_method == 'avg':
-            trans_cost = fed_avg(self.clients, self.server)
+            trans_cost = fed_avg(self.clients, self.server, engine=self.args.group.fed_avg_engine)
             self.sync()
         else:
             raise KeyError('Unrecognized compression method: ' + self.args.group.aggregation_method)
@@ -121,6 +125,20 @@ class ParameterServerGroup:
 
         return trans_cost
 
+    def build_arena(self) -> None:
+        r"""
+        Overview:
+            If ``args.group.parameter_arena`` is enabled, store the weights of all clients as rows of one
+        ``ParameterArena``, so that synchronization and aggregation operate on a single tensor.
+        Returns:
+            - None
+        """
+        if not self.args.group.parameter_arena:
+            return
+        self.arena = ParameterArena([client.model for client in self.clients], device=self.args.learn.device)
+        for i, client in enumerate(self.clients):
+            client.attach_arena(self.arena, i)
+
     def flush(self) -> None:
         r"""
         Overview:
@@ -130,6 +148,7 @@ class ParameterServerGroup:
         """
         self.clients = []
         self.server = None
+        self.arena = None
 
     def sync(self) -> None:
         r"""
@@ -4,7 +4,7 @@ import torch
 
 from fling.utils.compress_utils import *
 from fling.utils.registry_utils import GROUP_REGISTRY
-from fling.utils import Logger
+from fling.utils import Logger, SimilarityMatrix
 from fling.component.group import ParameterServerGroup
 
 import numpy as np
@@ -24,6 +24,10 @@ class CFLServerGroup(ParameterServerGroup):
         self.epoch = -1
         self.client_num = self.args.client.client_num
         self.dw = []
+        # Flattened updates of all clients with shape ``[N, D]``.
+        self.dw_flat = None
+        # Pairwise cosine similarities of the updates, only the rows of changed clients are computed again.
+        self.similarity = SimilarityMatrix(metric='cosine')
         self.n_parties = 4
 
     def initialize(self) -> None:
@@ -101,32 +105,17 @@ class CFLServerGroup(ParameterServerGroup):
         return params
 
     def cal_model_cosine_difference(self, model_weight_past):
-        model_similarity_matrix = torch.zeros((self.client_num, self.client_num))
-        for i in range(self.client_num):
-            self.dw.append({key: torch.zeros_like(value) for key, value in self.clients[0].model.named_parameters()})
-        for cidx in range(self.client_num):
-            model_i = self.clients[cidx].model.state_dict()
-            for key in model_i.keys():
-                self.dw[cidx][key] = model_i[key] - model_weight_past[cidx][key]
-
-        for i in range(self.client_num):
-            for j in range(i, self.client_num):
-                simi = torch.nn.functional.cosine_similarity(
-                    self.weight_flatten_all(self.dw[i]).unsqueeze(0),
-                    self.weight_flatten_all(self.dw[j]).unsqueeze(0))
-
-                model_similarity_matrix[i, j] = simi
-                model_similarity_matrix[j, i] = simi
+        # Each model is flattened once, instead of once for every pair of clients.
+        self.dw_flat = torch.stack([
+            self.weight_flatten_all(self.clients[cidx].model.state_dict()) -
+            self.weight_flatten_all(model_weight_past[cidx]) for cidx in range(self.client_num)
+        ])
+        model_similarity_matrix = self.similarity.update(self.dw_flat).cpu().clone()
         torch.cuda.empty_cache()
         return model_similarity_matrix
 
     def compute_max_update_norm(self, cluster):
-        norm_list = []
-        for client_dw in cluster:
-            weight = self.weight_flatten_all(client_dw)
-            norm_list.append(torch.norm(weight).item())
-        norm_list = np.array(norm_list)
-        return np.max(norm_list)
+        return torch.norm(cluster, dim=1).max().item()
         # return np.max([torch.norm(self.weight_flatten(client_dw)).item() for client_dw in cluster])
 
     def compute_mean_update_norm(self, cluster):
@@ -161,7 +150,7 @@ class CFLServerGroup(ParameterServerGroup):
 
         cluster_indices_new = []
         for idc in self.cluster_indices:
-            max_norm = self.compute_max_update_norm([self.dw[i] for i in idc])
+            max_norm = self.compute_max_update_norm(self.dw_flat[idc])
             # mean_norm = self.compute_mean_update_norm([self.dw[i] for i in idc])
             alpha = self.compute_max_simi(similarity, idc)
             print(alpha, max_norm, eps2)
@@ -188,7 +177,7 @@ class CFLServerGroup(ParameterServerGroup):
 
         cluster_indices_new = []
         for idc in self.cluster_indices:
-            max_norm = self.compute_max_update_norm([self.dw[i] for i in idc])
+            max_norm = self.compute_max_update_norm(self.dw_flat[idc])
             # mean_norm = self.compute_mean_update_norm([self.dw[i] for i in idc])
             alpha = self.compute_max_simi(similarity, idc)
             print(alpha, max_norm, eps2)
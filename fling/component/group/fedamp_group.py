@@ -4,7 +4,7 @@ import torch
 
 from fling.utils.compress_utils import *
 from fling.utils.registry_utils import GROUP_REGISTRY
-from fling.utils import Logger
+from fling.utils import Logger, SimilarityMatrix, pairwise_similarity
 from fling.component.group import ParameterServerGroup
 
 import numpy as np
@@ -26,6 +26,8 @@ class FedAMPServerGroup(ParameterServerGroup):
         self.graph_matrix[range(self.client_num), range(self.client_num)] = 0
         self.dw = []
         self.collaboration_graph = []
+        # Pairwise distances of the feature indicators, only the rows of changed clients are computed again.
+        self.distance = SimilarityMatrix(metric='euclidean')
 
     def weight_flatten(self, model):
         params = []
@@ -43,24 +45,12 @@ class FedAMPServerGroup(ParameterServerGroup):
         return params
 
     def cal_model_cosine_difference(self, ckpt):
-        model_similarity_matrix = torch.zeros((self.client_num, self.client_num))
-        for i in range(self.client_num):
-            self.dw.append({key: torch.zeros_like(value) for key, value in self.clients[0].model.named_parameters()})
+        self.dw = []
         for cidx in range(self.client_num):
             model_i = self.clients[cidx].model.state_dict()
-            for key in model_i.keys():
-                self.dw[cidx][key] = model_i[key] - ckpt[key]
-
-        for i in range(self.client_num):
-            for j in range(i, self.client_num):
-                if i == j:
-                    similarity = 0
-                else:
-                    similarity = torch.norm((self.weight_flatten_all(self.dw[i]).unsqueeze(0)-
-                                             self.weight_flatten_all(self.dw[j]).unsqueeze(0)), p=2)
-                model_similarity_matrix[i, j] = similarity
-                model_similarity_matrix[j, i] = similarity
-        return model_similarity_matrix
+            self.dw.append({key: model_i[key] - ckpt[key] for key in model_i.keys()})
+        dw = torch.stack([self.weight_flatten_all(self.dw[cidx]) for cidx in range(self.client_num)])
+        return pairwise_similarity(dw, metric='euclidean').cpu()
 
     # def update_graph_matrix_neighbor(self, ckpt):
     #     model_difference_matrix = self.cal_model_cosine_difference(ckpt)
@@ -84,15 +74,7 @@ class FedAMPServerGroup(ParameterServerGroup):
         return graph_matrix
 
     def update_graph_matrix_neighbor(self, feature_indicator):
-        model_similarity_matrix = torch.zeros((self.client_num, self.client_num))
-        for i in range(self.client_num):
-            for j in range(i, self.client_num):
-                if i == j:
-                    similarity = 0
-                else:
-                    similarity = torch.norm((feature_indicator[i].unsqueeze(0) - feature_indicator[j].unsqueeze(0)), p=2)
-                model_similarity_matrix[i, j] = similarity
-                model_similarity_matrix[j, i] = similarity
+        model_similarity_matrix = self.distance.update(torch.stack(list(feature_indicator[:self.client_num]))).cpu()
 
         graph_matrix = self.calculate_graph_matrix(model_similarity_matrix)
         print(f'Model difference: {model_similarity_matrix[0]}')
@@ -103,6 +85,10 @@ class FedAMPServerGroup(ParameterServerGroup):
         # self.graph_matrix = self.update_graph_matrix_neighbor(self.server.glob_dict)
         self.graph_matrix = self.update_graph_matrix_neighbor(feature_indicator)
         self.collaboration_graph.append(self.graph_matrix)
+        if self.arena is not None:
+            self.arena.mix(self.graph_matrix)
+            return
+
         tmp_client_state_dict = {}
         for cidx in range(self.client_num):
             tmp_client_state_dict[cidx] = copy.deepcopy(self.clients[0].model.state_dict())
@@ -132,16 +118,7 @@ class FedAMPServerGroup(ParameterServerGroup):
                     tmp_bn = torch.cat([tmp_bn, global_mean[cidx][n_chosen_layer]], dim=0)
             dw.append(tmp_bn)
 
-        model_similarity_matrix = torch.zeros((self.client_num, self.client_num))
-        for i in range(self.client_num):
-            for j in range(i, self.client_num):
-                if i == j:
-                    similarity = 0
-                else:
-                    similarity = torch.norm((dw[i].unsqueeze(0) -
-                                             dw[j].unsqueeze(0)), p=2)
-                model_similarity_matrix[i, j] = similarity
-                model_similarity_matrix[j, i] = similarity
+        model_similarity_matrix = pairwise_similarity(torch.stack(dw), metric='euclidean').cpu()
 
         graph_matrix = self.calculate_graph_matrix(model_similarity_matrix)
         print(f'Model difference: {model_similarity_matrix[0]}')
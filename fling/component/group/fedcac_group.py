@@ -111,7 +111,7 @@ class FedCACServerGroup(ParameterServerGroup):
             - trans_cost: uplink communication cost.
         """
         if self.args.group.aggregation_method == 'avg':
-            trans_cost = fed_avg(self.clients, self.server)
+            trans_cost = fed_avg(self.clients, self.server, engine=self.args.group.fed_avg_engine)
             trans_cost += self.get_customized_global_models()
             self.sync()
         else:
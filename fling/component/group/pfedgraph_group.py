@@ -4,11 +4,10 @@ import torch
 
 from fling.utils.compress_utils import *
 from fling.utils.registry_utils import GROUP_REGISTRY
-from fling.utils import Logger
+from fling.utils import Logger, SimilarityMatrix, SimplexQPSolver, pairwise_similarity
 from fling.component.group import ParameterServerGroup
 
 import numpy as np
-import cvxpy as cp
 
 @GROUP_REGISTRY.register('fedgraph_group')
 class FedGraphServerGroup(ParameterServerGroup):
@@ -26,6 +25,10 @@ class FedGraphServerGroup(ParameterServerGroup):
         self.graph_matrix[range(self.client_num), range(self.client_num)] = 0
         self.dw = []
         self.collaboration_graph = []
+        # Pairwise cosine similarities of the feature indicators, only the rows of changed clients are computed again.
+        self.similarity = SimilarityMatrix(metric='cosine')
+        # Solver of the collaboration weights. It is rebuilt when ``lamba`` or the number of clients changes.
+        self.qp_solver = None
 
 
     def weight_flatten(self, model):
@@ -44,31 +47,21 @@ class FedGraphServerGroup(ParameterServerGroup):
         return params
 
     def cal_model_cosine_difference(self, ckpt, similarity_matric):
-        model_similarity_matrix = torch.zeros((self.client_num, self.client_num))
-        for i in range(self.client_num):
-            self.dw.append({key: torch.zeros_like(value) for key, value in self.clients[0].model.named_parameters()})
+        self.dw = []
         for cidx in range(self.client_num):
             model_i = self.clients[cidx].model.state_dict()
-            for key in model_i.keys():
-                self.dw[cidx][key] = model_i[key] - ckpt[key]
-
-        for i in range(self.client_num):
-            for j in range(i, self.client_num):
-                if similarity_matric == "all":
-                    diff = - torch.nn.functional.cosine_similarity(
-                        self.weight_flatten_all(self.dw[i]).unsqueeze(0),
-                        self.weight_flatten_all(self.dw[j]).unsqueeze(0))
-                    if diff < - 0.9:
-                        diff = - 1.0
-                    model_similarity_matrix[i, j] = diff
-                    model_similarity_matrix[j, i] = diff
-                elif similarity_matric == "fc":
-                    diff = - torch.nn.functional.cosine_similarity(self.weight_flatten(self.dw[i]).unsqueeze(0),
-                                                                   self.weight_flatten(self.dw[j]).unsqueeze(0))
-                    if diff < - 0.9:
-                        diff = - 1.0
-                    model_similarity_matrix[i, j] = diff
-
+            self.dw.append({key: model_i[key] - ckpt[key] for key in model_i.keys()})
+
+        if similarity_matric == "all":
+            dw = torch.stack([self.weight_flatten_all(self.dw[cidx]) for cidx in range(self.client_num)])
+            model_similarity_matrix = -pairwise_similarity(dw, metric='cosine').cpu()
+        elif similarity_matric == "fc":
+            dw = torch.stack([self.weight_flatten(self.dw[cidx]) for cidx in range(self.client_num)])
+            # Only the upper triangular part is filled.
+            model_similarity_matrix = torch.triu(-pairwise_similarity(dw, metric='cosine').cpu())
+        else:
+            return torch.zeros((self.client_num, self.client_num))
+        model_similarity_matrix[model_similarity_matrix < -0.9] = -1.0
         return model_similarity_matrix
 
     # def update_graph_matrix_neighbor(self, ckpt, similarity_matric, lamba=0.8):
@@ -100,43 +93,25 @@ class FedGraphServerGroup(ParameterServerGroup):
     #         self.graph_matrix[i, :] = torch.Tensor(x.value)
     #
     #     return self.graph_matrix
-    def update_graph_matrix_neighbor(self, feature_indicator, lamba=0.8):
+    def get_qp_solver(self, n, lamba):
+        if self.qp_solver is None or self.qp_solver.n != n or self.qp_solver.lamba != lamba:
+            self.qp_solver = SimplexQPSolver(lamba * np.identity(n))
+        return self.qp_solver
 
-        model_similarity_matrix = torch.zeros((self.client_num, self.client_num))
+    def update_graph_matrix_neighbor(self, feature_indicator, lamba=0.8):
 
-        for i in range(self.client_num):
-            for j in range(i, self.client_num):
-                diff = - torch.nn.functional.cosine_similarity(feature_indicator[i].unsqueeze(0),
-                                                               feature_indicator[j].unsqueeze(0))
-                if diff < - 0.9:
-                    diff = - 1.0
-                model_similarity_matrix[i, j] = diff
-                model_similarity_matrix[j, i] = diff
+        model_similarity_matrix = -self.similarity.update(torch.stack(list(feature_indicator[:self.client_num]))).cpu()
+        model_similarity_matrix[model_similarity_matrix < -0.9] = -1.0
 
         total_data_points = sum([self.clients[k].sample_num for k in range(self.client_num)])
         fed_avg_freqs = {k: self.clients[k].sample_num / total_data_points for k in range(self.client_num)}
 
         # n = model_difference_matrix.shape[0]
         n = model_similarity_matrix.shape[0]
-        p = np.array(list(fed_avg_freqs.values()))
-        P = lamba * np.identity(n)
-        P = cp.atoms.affine.wraps.psd_wrap(P)
-        G = - np.identity(n)
-        h = np.zeros(n)
-        A = np.ones((1, n))
-        b = np.ones(1)
-        for i in range(model_similarity_matrix.shape[0]):
-            model_difference_vector = model_similarity_matrix[i]
-            d = model_difference_vector.numpy()
-            q = d - 2 * lamba * p
-            x = cp.Variable(n)
-            prob = cp.Problem(cp.Minimize(cp.quad_form(x, P) + q.T @ x),
-                              [G @ x <= h,
-                               A @ x == b]
-                              )
-            prob.solve()
-
-            self.graph_matrix[i, :] = torch.Tensor(x.value)
+        p = torch.as_tensor(list(fed_avg_freqs.values()), dtype=torch.float64)
+        # Solve the QP of all clients together, see ``SimplexQPSolver``.
+        q = model_similarity_matrix.double() - 2 * lamba * p.unsqueeze(0)
+        self.graph_matrix = self.get_qp_solver(n, lamba).solve(q).float()
         print(self.graph_matrix)
         return self.graph_matrix
 
@@ -144,6 +119,10 @@ class FedGraphServerGroup(ParameterServerGroup):
         # self.graph_matrix = self.update_graph_matrix_neighbor(self.server.glob_dict, similarity_matric='all')
         self.graph_matrix = self.update_graph_matrix_neighbor(feature_indicator)
         self.collaboration_graph.append(self.graph_matrix)
+        if self.arena is not None:
+            self.arena.mix(self.graph_matrix)
+            return
+
         tmp_client_state_dict = {}
         for cidx in range(self.client_num):
             tmp_client_state_dict[cidx] = copy.deepcopy(self.clients[0].model.state_dict())
@@ -173,38 +152,17 @@ class FedGraphServerGroup(ParameterServerGroup):
                     tmp_bn = torch.cat([tmp_bn, global_mean[cidx][n_chosen_layer]], dim=0)
             dw.append(tmp_bn)
 
-        model_difference_matrix = torch.zeros([self.client_num, self.client_num])
-        for i in range(self.client_num):
-            for j in range(i, self.client_num):
-                diff = - torch.nn.functional.cosine_similarity(dw[i].unsqueeze(0), dw[j].unsqueeze(0))
-                # if diff < -0.9:
-                #     diff = -1.0
-                model_difference_matrix[i, j] = diff
-                model_difference_matrix[j, i] = diff
+        model_difference_matrix = -pairwise_similarity(torch.stack(dw), metric='cosine').cpu()
+        # model_difference_matrix[model_difference_matrix < -0.9] = -1.0
 
         total_data_points = sum([self.clients[k].sample_num for k in range(self.client_num)])
         fed_avg_freqs = {k: self.clients[k].sample_num / total_data_points for k in range(self.client_num)}
 
         n = model_difference_matrix.shape[0]
-        p = np.array(list(fed_avg_freqs.values()))
-        P = lamba * np.identity(n)
-        P = cp.atoms.affine.wraps.psd_wrap(P)
-        G = - np.identity(n)
-        h = np.zeros(n)
-        A = np.ones((1, n))
-        b = np.ones(1)
-        for i in range(model_difference_matrix.shape[0]):
-            model_difference_vector = model_difference_matrix[i]
-            d = model_difference_vector.numpy()
-            q = d - 2 * lamba * p
-            x = cp.Variable(n)
-            prob = cp.Problem(cp.Minimize(cp.quad_form(x, P) + q.T @ x),
-                              [G @ x <= h,
-                               A @ x == b]
-                              )
-            prob.solve()
-
-            self.graph_matrix[i, :] = torch.Tensor(x.value)
+        p = torch.as_tensor(list(fed_avg_freqs.values()), dtype=torch.float64)
+        # Solve the QP of all clients together, see ``SimplexQPSolver``.
+        q = model_difference_matrix.double() - 2 * lamba * p.unsqueeze(0)
+        self.graph_matrix = self.get_qp_solver(n, lamba).solve(q).float()
 
         return self.graph_matrix
 
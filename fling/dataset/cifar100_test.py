@@ -3,8 +3,7 @@ from torchvision.datasets import CIFAR100
 
 from fling.utils import get_data_transform
 from fling.utils.registry_utils import DATASET_REGISTRY
-
-import numpy as np
+from .corruption_utils import load_corruption_split, get_tensor_store_dir
 
 common_corruptions = ['gaussian_noise', 'shot_noise', 'impulse_noise', 'defocus_blur', 'glass_blur',
                       'motion_blur', 'zoom_blur', 'snow', 'frost', 'fog',
@@ -28,6 +27,11 @@ class CIFAR100_TestDataset(Dataset):
     def __getitem__(self, item):
         return {'input': self.dataset[item][0], 'class_id': self.dataset[item][1]}
 
+    @property
+    def targets(self):
+        # The labels of all samples, read without loading the images. See ``get_targets``.
+        return self.dataset.targets
+
     def _prepare_test_data(self, train, transform):
         tesize = 10000
         if self.cfg.data.corruption is None or train:
@@ -35,10 +39,18 @@ class CIFAR100_TestDataset(Dataset):
             self.dataset = CIFAR100(self.cfg.data.data_path, train=train, transform=transform, download=True)
         elif self.cfg.data.corruption in common_corruptions:
             print('Test on %s level %d' % (self.cfg.data.corruption, self.cfg.data.level))
-            teset_raw = np.load(self.cfg.data.data_path + '/CIFAR-100-C/%s.npy' % (self.cfg.data.corruption))
-            teset_raw = teset_raw[(self.cfg.data.level - 1) * tesize: self.cfg.data.level * tesize]
-            self.dataset = CIFAR100(self.cfg.data.data_path, train=train, transform=transform, download=True)
-            self.dataset.data = teset_raw
+            corruption_dir = self.cfg.data.data_path + '/CIFAR-100-C'
+            self.dataset = load_corruption_split(
+                CIFAR100,
+                self.cfg.data.data_path,
+                corruption_dir,
+                self.cfg.data.corruption,
+                self.cfg.data.level,
+                transform,
+                tesize,
+                store_dir=get_tensor_store_dir(self.cfg, corruption_dir),
+                shared_memory=self.cfg.other.tensor_store_shared
+            )
         else:
             raise "Don't have this type of data!"
 
@@ -49,9 +61,9 @@ class CIFAR100_TestDataset(Dataset):
             self.dataset_strong = CIFAR100(self.cfg.data.data_path, train=train, download=True)
         elif self.cfg.data.corruption in common_corruptions:
             print('Test on %s level %d' % (self.cfg.data.corruption, self.cfg.data.level))
-            teset_raw = np.load(self.cfg.data.data_path + '/CIFAR-100-C/%s.npy' % (self.cfg.data.corruption))
-            teset_raw = teset_raw[(self.cfg.data.level - 1) * tesize: self.cfg.data.level * tesize]
-            self.dataset_strong = CIFAR100(self.cfg.data.data_path, train=train, download=True)
-            self.dataset_strong.data = teset_raw
+            self.dataset_strong = load_corruption_split(
+                CIFAR100, self.cfg.data.data_path, self.cfg.data.data_path + '/CIFAR-100-C', self.cfg.data.corruption,
+                self.cfg.data.level, None, tesize
+            )
         else:
             raise "Don't have this type of data!"
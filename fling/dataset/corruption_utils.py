@@ -0,0 +1,388 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+from torchvision import transforms
+
+# Arrays loaded in this process, keyed by the absolute path of the ``.npy`` file.
+_npy_cache: Dict[str, np.ndarray] = {}
+# Labels of the original test sets, keyed by (dataset class, root).
+_targets_cache: Dict[tuple, np.ndarray] = {}
+_cache_lock = threading.Lock()
+
+
+def load_npy(path: str) -> np.ndarray:
+    r"""
+    Overview:
+        Load a ``.npy`` file with ``mmap_mode='r'``, only once in each process.
+        The array is not read into memory. Only the pages of the accessed samples are read, and these pages are \
+    shared by all processes (e.g. the workers of a launcher) through the page cache of the OS.
+    Arguments:
+        path: path of the ``.npy`` file.
+    Returns:
+        array: the read-only memory-mapped array.
+    """
+    path = os.path.abspath(path)
+    with _cache_lock:
+        if path not in _npy_cache:
+            _npy_cache[path] = np.load(path, mmap_mode='r')
+        return _npy_cache[path]
+
+
+def load_test_targets(base_dataset: Callable, root: str, corruption_dir: str, tesize: int = 10000) -> np.ndarray:
+    r"""
+    Overview:
+        Get the labels of the original test set, only once in each process.
+        The corrupted test sets (e.g. CIFAR-10-C) keep the order of the original test set in each severity. If \
+    ``labels.npy`` of the corrupted test set exists, the labels are read from its first severity. Otherwise, they \
+    are read from the original test set.
+    Arguments:
+        base_dataset: the torchvision dataset class of the original dataset, e.g. ``CIFAR10``.
+        root: root path of the dataset.
+        corruption_dir: directory of the corrupted test set, e.g. ``<root>/CIFAR-10-C``.
+        tesize: number of samples in each severity.
+    Returns:
+        targets: the labels with type int64.
+    """
+    key = (base_dataset, os.path.abspath(root))
+    with _cache_lock:
+        if key not in _targets_cache:
+            label_path = os.path.join(corruption_dir, 'labels.npy')
+            if os.path.exists(label_path):
+                targets = np.load(label_path, mmap_mode='r')[:tesize]
+            else:
+                targets = base_dataset(root, train=False, download=True).targets
+            _targets_cache[key] = np.asarray(targets, dtype=np.int64)
+        return _targets_cache[key]
+
+
+class CorruptionSplit(Dataset):
+    r"""
+    Overview:
+        One severity of one corruption type of a corrupted test set such as CIFAR-10-C.
+        The images are a slice of the memory-mapped ``<corruption>.npy``, so creating a split does not read any \
+    image. Samples are returned in the same way as torchvision ``CIFAR10``, i.e. a tuple of the transformed image \
+    and the integer label.
+    """
+
+    def __init__(self, data: np.ndarray, targets: np.ndarray, transform: Optional[Callable] = None):
+        r"""
+        Overview:
+            Initialization for the split.
+        Arguments:
+            data: uint8 images with shape ``[N, H, W, C]``.
+            targets: labels with shape ``[N]``.
+            transform: the transform applied to each ``PIL.Image``.
+        """
+        self.data = data
+        self.targets = targets
+        self.transform = transform
+        self.target_transform = None
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index: int) -> tuple:
+        img, target = Image.fromarray(np.asarray(self.data[index])), int(self.targets[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, target
+
+
+# Tensor stores loaded in this process, keyed by the absolute path of the ``.npy`` file.
+_tensor_cache: Dict[str, torch.Tensor] = {}
+
+
+def transform_normalization(transform: Optional[Callable]) -> Optional[Tuple]:
+    r"""
+    Overview:
+        If ``transform`` is only ``ToTensor``, optionally followed by ``Normalize``, return ``(mean, std)`` of the \
+    normalization as float32 tensors with shape ``[C, 1, 1]`` (or ``(None, None)`` without ``Normalize``). Then the \
+    transform can be applied to a whole batch of uint8 images at once. Otherwise, return ``None``.
+    """
+    ops = transform.transforms if isinstance(transform, transforms.Compose) else [transform]
+    if len(ops) == 0 or not isinstance(ops[0], transforms.ToTensor):
+        return None
+    if len(ops) == 1:
+        return None, None
+    if len(ops) == 2 and isinstance(ops[1], transforms.Normalize) and not ops[1].inplace:
+        return torch.as_tensor(ops[1].mean, dtype=torch.float32).view(-1, 1, 1), \
+            torch.as_tensor(ops[1].std, dtype=torch.float32).view(-1, 1, 1)
+    return None
+
+
+def convert_tensor_store(corruption_dir: str, store_dir: str, corruption: str) -> str:
+    r"""
+    Overview:
+        Convert ``<corruption_dir>/<corruption>.npy`` (uint8 images with shape ``[N, H, W, C]``) into \
+    ``<store_dir>/<corruption>.npy``, the same images with shape ``[N, C, H, W]`` in one contiguous array, i.e. the \
+    layout of ``ToTensor``. Each severity is then a contiguous slice of the array. The file is only written if it \
+    does not exist yet.
+    Arguments:
+        corruption_dir: directory of the corrupted test set, e.g. ``<root>/CIFAR-10-C``.
+        store_dir: directory of the converted arrays.
+        corruption: name of the corruption type.
+    Returns:
+        path: path of the converted array.
+    """
+    path = os.path.join(store_dir, '%s.npy' % corruption)
+    if not os.path.exists(path):
+        data = load_npy(os.path.join(corruption_dir, '%s.npy' % corruption))
+        os.makedirs(store_dir, exist_ok=True)
+        # Write to a temporary file first, so that other runs never read a partial file.
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(data.transpose(0, 3, 1, 2)))
+        os.replace(tmp, path)
+    return path
+
+
+def load_tensor_store(path: str, shared_memory: bool = False) -> torch.Tensor:
+    r"""
+    Overview:
+        Load an array written by ``convert_tensor_store`` into one uint8 tensor, only once in each process.
+    Arguments:
+        path: path of the ``.npy`` file.
+        shared_memory: whether to move the tensor into shared memory, so that it is passed to the workers of a \
+    launcher without a copy.
+    Returns:
+        tensor: the uint8 tensor with shape ``[N, C, H, W]``.
+    """
+    path = os.path.abspath(path)
+    with _cache_lock:
+        if path not in _tensor_cache:
+            tensor = torch.from_numpy(np.load(path))
+            if shared_memory:
+                tensor.share_memory_()
+            _tensor_cache[path] = tensor
+        return _tensor_cache[path]
+
+
+class TensorCorruptionSplit(Dataset):
+    r"""
+    Overview:
+        One severity of one corruption type, stored as one contiguous uint8 tensor with shape ``[N, C, H, W]``, or as \
+    a memory-mapped uint8 array with the same shape (see ``load_packed_split``).
+        ``gather`` returns a collated batch with one ``index_select``, and ``ToTensor`` and ``Normalize`` are applied \
+    to the whole batch in one vectorized op, so no work is done per sample. The results are the same as \
+    ``CorruptionSplit`` with the same transform. ``__getitem__`` is kept for ``DataLoader`` and returns a tuple of \
+    the transformed image and the integer label.
+    """
+
+    def __init__(
+            self,
+            data: Union[torch.Tensor, np.ndarray],
+            targets: np.ndarray,
+            mean: Optional[torch.Tensor] = None,
+            std: Optional[torch.Tensor] = None
+    ):
+        r"""
+        Overview:
+            Initialization for the split.
+        Arguments:
+            data: uint8 images with shape ``[N, C, H, W]``, as a tensor or a memory-mapped array.
+            targets: labels with shape ``[N]``.
+            mean: the mean of ``Normalize`` with shape ``[C, 1, 1]``, or ``None`` without normalization.
+            std: the std of ``Normalize`` with shape ``[C, 1, 1]``.
+        """
+        self.data = data
+        self.targets = targets
+        self.labels = torch.tensor(np.asarray(targets), dtype=torch.int64)
+        self.mean = mean
+        self.std = std
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def _normalize(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.to(torch.float32).div(255)
+        if self.mean is not None:
+            x.sub_(self.mean).div_(self.std)
+        return x
+
+    def _take(self, index: torch.Tensor) -> torch.Tensor:
+        if isinstance(self.data, torch.Tensor):
+            return self.data.index_select(0, index)
+        # Only the pages of the selected samples of a memory-mapped array are read, into one new array.
+        return torch.from_numpy(self.data[index.numpy()])
+
+    def __getitem__(self, index: int) -> tuple:
+        return self._normalize(self._take(torch.tensor([index]))[0]), int(self.targets[index])
+
+    def gather(self, indexes: Sequence[int]) -> Dict[str, torch.Tensor]:
+        r"""
+        Overview:
+            Get the samples with ``indexes`` as one collated batch, with keys ``input`` and ``class_id``.
+        """
+        index = torch.as_tensor(np.asarray(indexes), dtype=torch.int64)
+        return {
+            'input': self._normalize(self._take(index)),
+            'class_id': self.labels.index_select(0, index)
+        }
+
+
+def get_tensor_store_dir(cfg: dict, corruption_dir: str) -> Optional[str]:
+    r"""
+    Overview:
+        The directory of the converted arrays of a corrupted test set, i.e. ``<tensor_store_path>/<name>`` \
+    where ``name`` is the name of ``corruption_dir`` (e.g. ``CIFAR-10-C``), or ``None`` if ``cfg.other.tensor_store`` \
+    is off.
+    """
+    if not cfg.other.tensor_store:
+        return None
+    from fling.utils import get_cache_path
+    return os.path.join(get_cache_path(cfg, 'tensor_store_path'), os.path.basename(os.path.normpath(corruption_dir)))
+
+def load_corruption_split(
+        base_dataset: Callable,
+        root: str,
+        corruption_dir: str,
+        corruption: str,
+        level: int,
+        transform: Optional[Callable],
+        tesize: int = 10000,
+        store_dir: Optional[str] = None,
+        shared_memory: bool = False
+) -> Union[CorruptionSplit, TensorCorruptionSplit]:
+    r"""
+    Overview:
+        Get one severity of one corruption type from the memory-mapped arrays of a corrupted test set.
+        If ``store_dir`` is set and ``transform`` is only ``ToTensor`` and ``Normalize``, the split is a \
+    ``TensorCorruptionSplit`` of the converted array in ``store_dir`` (converted on first use, see \
+    ``convert_tensor_store``). Otherwise, it is a ``CorruptionSplit``, which transforms the samples one by one.
+    Arguments:
+        base_dataset: the torchvision dataset class of the original dataset, e.g. ``CIFAR10``.
+        root: root path of the dataset.
+        corruption_dir: directory of the corrupted test set, e.g. ``<root>/CIFAR-10-C``.
+        corruption: name of the corruption type.
+        level: the severity, from 1 to 5.
+        transform: the transform applied to each image.
+        tesize: number of samples in each severity.
+        store_dir: directory of the converted arrays, or ``None`` to read the original arrays.
+        shared_memory: whether the converted arrays are loaded into shared memory.
+    Returns:
+        split: the dataset of this corruption type and severity.
+    """
+    targets = load_test_targets(base_dataset, root, corruption_dir, tesize)
+    normalization = transform_normalization(transform) if store_dir is not None else None
+    if normalization is not None:
+        data = load_tensor_store(convert_tensor_store(corruption_dir, store_dir, corruption), shared_memory)
+        return TensorCorruptionSplit(data[(level - 1) * tesize:level * tesize], targets, *normalization)
+    data = load_npy(os.path.join(corruption_dir, '%s.npy' % corruption))
+    return CorruptionSplit(data[(level - 1) * tesize:level * tesize], targets, transform)
+
+
+def _decode_image(path: str) -> np.ndarray:
+    # Decode an image file into a uint8 array with shape ``[C, H, W]``, the same pixels as the default loader of
+    # ``ImageFolder``.
+    with open(path, 'rb') as f:
+        return np.asarray(Image.open(f).convert('RGB')).transpose(2, 0, 1)
+
+
+def pack_image_folder(
+        src_dir: str,
+        dst_dir: str,
+        corruptions: Optional[Sequence[str]] = None,
+        levels: Sequence[int] = (1, 2, 3, 4, 5),
+        num_workers: int = 8
+) -> Dict:
+    r"""
+    Overview:
+        Convert a corrupted test set stored as image files, with the layout \
+    ``<src_dir>/<corruption>/<level>/<class>/<image>`` (e.g. Tiny-ImageNet-C and ImageNet-C), into packed shards.
+        Each ``(corruption, level)`` is decoded once and written to ``<dst_dir>/<corruption>/<level>/images.npy``, one \
+    uint8 array with shape ``[N, C, H, W]``, with its labels in ``labels.npy``. The samples are in the order of \
+    ``ImageFolder``. ``<dst_dir>/index.json`` records the classes and the shape of each shard. Shards are written \
+    to a temporary file first, and existing shards are skipped, so an interrupted conversion can be resumed.
+    Arguments:
+        src_dir: root directory of the image files.
+        dst_dir: root directory of the shards.
+        corruptions: the corruptions to convert. If set to ``None``, all sub-directories of ``src_dir``.
+        levels: the severities to convert.
+        num_workers: number of threads decoding the images.
+    Returns:
+        index: the content of ``index.json``.
+    """
+    from torchvision.datasets import ImageFolder
+    if corruptions is None:
+        corruptions = sorted(d for d in os.listdir(src_dir) if os.path.isdir(os.path.join(src_dir, d)))
+    index_path = os.path.join(dst_dir, 'index.json')
+    index = {'classes': None, 'shards': {}}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    for corruption in corruptions:
+        for level in levels:
+            name = '%s/%d' % (corruption, level)
+            shard_dir = os.path.join(dst_dir, corruption, str(level))
+            if name in index['shards'] and os.path.exists(os.path.join(shard_dir, 'images.npy')):
+                continue
+            folder = ImageFolder(os.path.join(src_dir, corruption, str(level)))
+            if index['classes'] is None:
+                index['classes'] = folder.classes
+            elif folder.classes != index['classes']:
+                raise ValueError(f'The classes of {name} are different from the other shards.')
+            paths = [path for path, _ in folder.samples]
+            first = _decode_image(paths[0])
+            os.makedirs(shard_dir, exist_ok=True)
+            tmp = os.path.join(shard_dir, 'images.npy.%d.tmp' % os.getpid())
+            images = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=(len(paths), ) + first.shape)
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                for i, image in enumerate(executor.map(_decode_image, paths)):
+                    if image.shape != first.shape:
+                        raise ValueError(f'Images of {name} have different shapes: {first.shape}, {image.shape}')
+                    images[i] = image
+            images.flush()
+            del images
+            np.save(os.path.join(shard_dir, 'labels.npy'), np.asarray(folder.targets, dtype=np.int64))
+            os.replace(tmp, os.path.join(shard_dir, 'images.npy'))
+            index['shards'][name] = {'num': len(paths), 'shape': list(first.shape)}
+            # The index is updated after each shard, so it only lists complete shards.
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump(index, f)
+            os.replace(index_path + '.tmp', index_path)
+    return index
+
+
+def has_packed_split(packed_dir: str, corruption: str, level: int) -> bool:
+    r"""
+    Overview:
+        Whether ``pack_image_folder`` has written the shard of ``(corruption, level)`` in ``packed_dir``.
+    """
+    index_path = os.path.join(packed_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return False
+    with open(index_path) as f:
+        return '%s/%d' % (corruption, level) in json.load(f)['shards']
+
+
+def load_packed_split(
+        packed_dir: str, corruption: str, level: int, transform: Optional[Callable]
+) -> Union[CorruptionSplit, TensorCorruptionSplit]:
+    r"""
+    Overview:
+        Get one severity of one corruption type from the shards written by ``pack_image_folder``.
+        The images are memory-mapped, so only the pages of the accessed samples are read, and no image is decoded. \
+    If ``transform`` is only ``ToTensor`` and ``Normalize``, the split is a ``TensorCorruptionSplit``, which gathers \
+    and normalizes whole batches. Otherwise, it is a ``CorruptionSplit``, which transforms the samples one by one.
+    Arguments:
+        packed_dir: root directory of the shards.
+        corruption: name of the corruption type.
+        level: the severity.
+        transform: the transform applied to each image.
+    Returns:
+        split: the dataset of this corruption type and severity.
+    """
+    shard_dir = os.path.join(packed_dir, corruption, str(level))
+    data = load_npy(os.path.join(shard_dir, 'images.npy'))
+    targets = np.load(os.path.join(shard_dir, 'labels.npy'))
+    normalization = transform_normalization(transform)
+    if normalization is not None:
+        return TensorCorruptionSplit(data, targets, *normalization)
+    return CorruptionSplit(data.transpose(0, 2, 3, 1), targets, transform)
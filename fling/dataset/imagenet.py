@@ -3,10 +3,11 @@ import pickle
 
 import lmdb
 from torch.utils.data import Dataset
-from torchvision.datasets import ImageNet
+from torchvision.datasets import ImageNet, ImageFolder
 
 from fling.utils import get_data_transform
 from fling.utils.registry_utils import DATASET_REGISTRY
+from .corruption_utils import has_packed_split, load_packed_split
 
 
 @DATASET_REGISTRY.register('imagenet')
@@ -29,8 +30,22 @@ class ImagenetDataset(Dataset):
         self.cfg = cfg
         self.use_lmdb = cfg.data.get("use_lmdb", False)
         self.transform = get_data_transform(cfg.data.transforms, train=train)
+        corruption = cfg.data.get('corruption', None)
 
-        if not self.use_lmdb:
+        if not train and isinstance(corruption, str):
+            # One severity of one corruption type of ImageNet-C. The shards written by ``fling pack`` are read
+            # through mmap if they exist, otherwise the images under ``<data_path>/ImageNet-C`` are decoded.
+            self.use_lmdb = False
+            packed_dir = os.path.join(cfg.data.data_path, 'ImageNet-C-packed')
+            if cfg.other.packed_store and has_packed_split(packed_dir, corruption, cfg.data.level):
+                self.dataset = load_packed_split(packed_dir, corruption, cfg.data.level, self.transform)
+            else:
+                self.dataset = ImageFolder(
+                    os.path.join(cfg.data.data_path, 'ImageNet-C', corruption, str(cfg.data.level)),
+                    transform=self.transform
+                )
+            self.length = len(self.dataset)
+        elif not self.use_lmdb:
             split = 'train' if train else 'val'
             self.dataset = ImageNet(root=cfg.data.data_path, split=split, transform=self.transform)
             self.length = len(self.dataset)
@@ -52,6 +67,26 @@ class ImagenetDataset(Dataset):
     def __len__(self) -> int:
         return self.length
 
+    @property
+    def targets(self) -> list:
+        # The labels of all samples, without decoding or transforming the images. See ``get_targets``.
+        if not self.use_lmdb:
+            return self.dataset.targets
+        if not hasattr(self, '_targets'):
+            # A temporary environment is used, so that ``txn`` is still opened lazily in each data loader worker.
+            env = lmdb.open(self.db_path, subdir=False, readonly=True, lock=False, max_readers=16, create=False)
+            try:
+                with env.begin(write=False) as txn:
+                    stored = txn.get(b'__targets__')
+                    if stored is not None:
+                        self._targets = pickle.loads(stored)
+                    else:
+                        # Databases without the ``__targets__`` key: read the label of each record once.
+                        self._targets = [pickle.loads(txn.get(key))[1] for key in self.keys]
+            finally:
+                env.close()
+        return self._targets
+
     def __getitem__(self, item: int) -> dict:
         if not self.use_lmdb:
             return {'input': self.dataset[item][0], 'class_id': self.dataset[item][1]}
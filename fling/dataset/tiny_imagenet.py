@@ -35,3 +35,8 @@ class TinyImagenetDataset(Dataset):
 
     def __getitem__(self, item: int) -> dict:
         return {'input': self.dataset[item][0], 'class_id': self.dataset[item][1]}
+
+    @property
+    def targets(self) -> list:
+        # The labels of all samples, read from the file list of ``ImageFolder``. See ``get_targets``.
+        return self.dataset.targets
@@ -6,6 +6,7 @@ from torchvision.datasets import ImageFolder
 
 from fling.utils import get_data_transform
 from fling.utils.registry_utils import DATASET_REGISTRY
+from .corruption_utils import has_packed_split, load_packed_split
 import random
 
 
@@ -40,12 +41,29 @@ class TinyImagenetDataset(Dataset):
     def __getitem__(self, item: int) -> dict:
         return {'input': self.dataset[item][0], 'class_id': self.dataset[item][1]}
 
+    @property
+    def targets(self) -> list:
+        # The labels of all samples, read without loading the images. See ``get_targets``.
+        return self.dataset.targets
+
     def _prepare_test_data(self, train, transform):
         if self.cfg.data.corruption is None or train:
             print('Test on the original test set')
             self.dataset = ImageFolder(os.path.join(self.cfg.data.data_path, 'Tiny-ImageNet-200', 'tiny-imagenet-200'), transform=transform)
         elif self.cfg.data.corruption in common_corruptions:
-            self.dataset = ImageFolder(os.path.join(self.cfg.data.data_path, 'Tiny-ImageNet-C', 'Tiny-ImageNet-C', self.cfg.data.corruption, str(self.cfg.data.level)), transform=transform)
+            packed_dir = os.path.join(self.cfg.data.data_path, 'Tiny-ImageNet-C-packed')
+            level = self.cfg.data.level
+            if self.cfg.other.packed_store and has_packed_split(packed_dir, self.cfg.data.corruption, level):
+                # Shards written by ``fling pack``, which are read through mmap without decoding any image.
+                self.dataset = load_packed_split(packed_dir, self.cfg.data.corruption, level, transform)
+            else:
+                self.dataset = ImageFolder(
+                    os.path.join(
+                        self.cfg.data.data_path, 'Tiny-ImageNet-C', 'Tiny-ImageNet-C', self.cfg.data.corruption,
+                        str(self.cfg.data.level)
+                    ),
+                    transform=transform
+                )
         else:
             raise "Don't have this type of data!"
 
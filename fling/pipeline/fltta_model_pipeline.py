@@ -6,12 +6,16 @@ import numpy as np
 import torch
 import torch.nn as nn
 
-from fling.component.client import get_client
+from fling.component.client import get_client, BatchedAdapter
 from fling.component.server import get_server
 from fling.component.group import get_group
 from fling.dataset import get_dataset
-from fling.utils.data_utils import data_sampling
-from fling.utils import Logger, compile_config, client_sampling, VariableMonitor, LRScheduler
+from fling.utils.data_utils import data_sampling, split_name, RoundBatchLoader, compile_round_schedule, \
+    iter_rounds, save_schedule, load_schedule
+from fling.utils.data_utils.schedule import ROUND, LEVEL, LOOP, STEP, EPS, CLIENT, CORRUPTION, OFFSET
+from fling.utils import Logger, compile_config, VariableMonitor, LRScheduler, get_launcher, \
+    AnchorOutputCache, SharedAnchor, get_metrics_sink, get_cache_path, data_digest
+from fling.utils.launcher_utils import SerialLauncher
 
 from fling.model import get_model
 from torch.utils.data import DataLoader
@@ -20,7 +24,6 @@ from fling.utils.data_utils.sampling import NaiveDataset
 import pandas as pd
 from fling.utils.utils import VariableMonitor, SaveEmb
 import pickle
-import wandb
 import matplotlib.pyplot as plt
 from sklearn.manifold import TSNE
 
@@ -53,8 +56,8 @@ def test_origin(net, test_dataloader):
             loss = criterion(out, batch_y)
             monitor.append(
                 {
-                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()).item(),
-                    'test_loss': loss.item()
+                    'test_acc': torch.mean((y_pred == preprocessed_data['y']).float()),
+                    'test_loss': loss
                 },
                 weight=preprocessed_data['y'].shape[0]
             )
@@ -146,31 +149,35 @@ def compute_average_differences(group):
     
     return avg_differences
 
-def compute_differences(features, f_name, mode = 'diff'):
+def compute_differences(features, f_name, mode='diff', sink=None, step=None):
     model_count = len(features)
-    differences = []
-    
+    pairs, values = [], []
+
     # Compute pairwise average differences
     for i in range(model_count):
         for j in range(i, model_count):
             if mode == 'diff':
-                diff = torch.norm(features[i] - features[j]).item()
-                differences.append((f"client_{i+1}_vs_client{j+1}", diff))
+                values.append(torch.norm(features[i] - features[j]))
             elif mode == 'sim':
-                sim = torch.nn.functional.cosine_similarity(features[i].unsqueeze(0), features[j].unsqueeze(0))
-                differences.append((f"client_{i+1}_vs_client{j+1}", sim))
-
+                values.append(
+                    torch.nn.functional.cosine_similarity(features[i].unsqueeze(0), features[j].unsqueeze(0))[0]
+                )
             else:
                 raise NotImplementedError
-
+            pairs.append(f"client_{i+1}_vs_client{j+1}")
 
     print(f"Average Differences Between {f_name}")
-    for model_pair, diff in differences:
-        wandb.log({f"{model_pair}": diff})
-    
+    # All pairs are copied to the host at once, and logged as one record.
+    differences = dict(zip(pairs, torch.stack(values).tolist())) if len(values) > 0 else {}
+    if sink is not None:
+        sink.log_scalars(differences, step=step)
+    return differences
+
 def FedTTA_Pipeline(args: dict, seed: int = 0) -> None:
     start_time = time.time()
-    
+
+    # The launcher is only used if it is set in the experiment config, see below.
+    use_launcher = 'launcher' in args
     # Compile the input arguments first.
     args = compile_config(args, seed)
 
@@ -184,283 +191,372 @@ def FedTTA_Pipeline(args: dict, seed: int = 0) -> None:
         args.data.dataset = args.data.dataset[:pos]
     print(dataset_name, args.data.dataset)
 
-    wandb.login(key="f22f65f9d8ca626c5d8a36d80eee6506d14501c3")
+    # Messages and metrics are written by a background thread, to the backends in ``args.other.metrics_backends``.
+    # wandb is only used if it is one of them, with the credentials configured outside of the code.
     folder_name_split = args.other.logging_path.split('/')
-    wandb.init(project=f"fed_tta_{dataset_name}_{folder_name_split[-2]}_{folder_name_split[-3]}", dir="output", name=folder_name_split[-1])
-    
-    origin_test_set = get_dataset(args, train=False)
-    origin_train_set = get_dataset(args, train=True)
-    train_dataloader = DataLoader(origin_train_set, batch_size=args.learn.batch_size, shuffle=True)
-    test_dataloader = DataLoader(origin_test_set, batch_size=args.learn.batch_size, shuffle=False)
-
-
-    # Corrupted Type & Level Test Data
-    '''
-    corrupt_dict[ corrupt_type ][ corrupt_severity ]
-    '''
-    args.data.dataset = dataset_name
-    corrupt_dict = {}
-    common_corrupt = args.data.corruption
-    common_serverity = args.data.level
-    for corrupt in common_corrupt:
-        corrupt_dict[corrupt] = {}
-        for serv in common_serverity:
-            args.data.corruption = corrupt
-            args.data.level = serv
-            test_set = get_dataset(args, train=False)
-            corrupt_dict[corrupt][serv] = test_set
-    args.data.corruption = common_corrupt
-    args.data.level = common_serverity
-
-    # Split dataset into clients.
-    origin_test_sets = data_sampling(origin_test_set, args, seed, train=False)
-    '''
-    corrupt_test_sets[ client_id ][ corrupt_type ][ corrupt_severity ]
-    '''
-    corrupt_test_sets = [{} for _ in range(args.client.client_num)]
-    for corrupt in common_corrupt:
-        for cidx in range(args.client.client_num):
-            corrupt_test_sets[cidx][corrupt] = {}
-        for serv in common_serverity:
-            test_sets = data_sampling(corrupt_dict[corrupt][serv], args, seed, train=False)
+    sink = get_metrics_sink(
+        args, writer=logger, wandb_project=f"fed_tta_{dataset_name}_{folder_name_split[-2]}_{folder_name_split[-3]}"
+    )
+    logger.set_sink(sink)
+
+    # The workers of the launcher are stopped and the pending records are written also when the run fails.
+    launcher = None
+    try:
+        origin_test_set = get_dataset(args, train=False)
+        origin_train_set = get_dataset(args, train=True)
+        train_dataloader = DataLoader(origin_train_set, batch_size=args.learn.batch_size, shuffle=True)
+        test_dataloader = DataLoader(origin_test_set, batch_size=args.learn.batch_size, shuffle=False)
+
+
+        # Corrupted Type & Level Test Data
+        '''
+        corrupt_dict[ corrupt_type ][ corrupt_severity ]
+        '''
+        args.data.dataset = dataset_name
+        corrupt_dict = {}
+        common_corrupt = args.data.corruption
+        common_serverity = args.data.level
+        for corrupt in common_corrupt:
+            corrupt_dict[corrupt] = {}
+            for serv in common_serverity:
+                args.data.corruption = corrupt
+                args.data.level = serv
+                test_set = get_dataset(args, train=False)
+                corrupt_dict[corrupt][serv] = test_set
+        args.data.corruption = common_corrupt
+        args.data.level = common_serverity
+
+        # Split dataset into clients.
+        # All corruption splits have the same length and labels, so they share one partition, which is also reused by
+        # later runs through the files under ``args.other.partition_cache_path``.
+        partition_cache_path = get_cache_path(args, 'partition_cache_path') if args.other.partition_cache else None
+        origin_test_sets = data_sampling(origin_test_set, args, seed, train=False, cache_path=partition_cache_path)
+        '''
+        corrupt_test_sets[ client_id ][ corrupt_type ][ corrupt_severity ]
+        '''
+        corrupt_test_sets = [{} for _ in range(args.client.client_num)]
+        for corrupt in common_corrupt:
             for cidx in range(args.client.client_num):
-                corrupt_test_sets[cidx][corrupt][serv] = test_sets[cidx]
-
-    # load pre-trained net
-    ckpt = torch.load(args.other.model_path)
-    net = get_model(args)
-    if 'tiny' in args.data.dataset:
-        net.avgpool = nn.AdaptiveAvgPool2d(1)
-        num_features = net.fc.in_features
-        net.fc = nn.Linear(num_features, 200)
-    print(net)
-
-    print(ckpt.keys())
-
-
-    if args.other.pre_trained == 'wideresnet' and args.data.class_number == 10:
-        # ckpt = ckpt['state_dict']
-        net.load_state_dict(ckpt)
-    elif args.other.pre_trained == 'wideresnet28' and args.data.class_number == 100:
-        ckpt = ckpt['model_state_dict']
-        net.load_state_dict(ckpt)
-    elif args.other.pre_trained == 'cifarresnext' and args.data.class_number == 100:
-        ckpt = {key.replace("module.", ""): value for key, value in ckpt.items()}
-        net.load_state_dict(ckpt)
-    elif args.other.pre_trained == 'resnet' and args.data.class_number == 100:
-        del ckpt['mu']
-        del ckpt['sigma']
-        net.load_state_dict(ckpt)
-    else:
-        net.load_state_dict(ckpt)
+                corrupt_test_sets[cidx][corrupt] = {}
+            for serv in common_serverity:
+                test_sets = data_sampling(corrupt_dict[corrupt][serv], args, seed, train=False,
+                                          cache_path=partition_cache_path)
+                for cidx in range(args.client.client_num):
+                    corrupt_test_sets[cidx][corrupt][serv] = test_sets[cidx]
+
+        # load pre-trained net
+        ckpt = torch.load(args.other.model_path)
+        net = get_model(args)
+        if 'tiny' in args.data.dataset:
+            net.avgpool = nn.AdaptiveAvgPool2d(1)
+            num_features = net.fc.in_features
+            net.fc = nn.Linear(num_features, 200)
+        print(net)
+
+        print(ckpt.keys())
+
+
+        if args.other.pre_trained == 'wideresnet' and args.data.class_number == 10:
+            # ckpt = ckpt['state_dict']
+            net.load_state_dict(ckpt)
+        elif args.other.pre_trained == 'wideresnet28' and args.data.class_number == 100:
+            ckpt = ckpt['model_state_dict']
+            net.load_state_dict(ckpt)
+        elif args.other.pre_trained == 'cifarresnext' and args.data.class_number == 100:
+            ckpt = {key.replace("module.", ""): value for key, value in ckpt.items()}
+            net.load_state_dict(ckpt)
+        elif args.other.pre_trained == 'resnet' and args.data.class_number == 100:
+            del ckpt['mu']
+            del ckpt['sigma']
+            net.load_state_dict(ckpt)
+        else:
+            net.load_state_dict(ckpt)
+
+        net.cuda()
+
+        test_origin(net, test_dataloader)
+
+        # Initialize group, clients and server.
+        group = init_tta_state(args, net, ckpt, logger, corrupt_dict, corrupt_test_sets, origin_test_sets, train_dataloader)
+
+        # Training loop
+        test_monitor_list = [VariableMonitor() for _ in range(len(args.data.corruption))]
+        adapt_monitor_list = [VariableMonitor() for _ in range(len(args.data.corruption))]
+        fed_adapt_monitor_list = [VariableMonitor() for _ in range(len(args.data.corruption))]
+
+        # calculate loop
+        all_loop = int(len(corrupt_test_sets[0][args.data.corruption[0]][args.data.level[0]]) /
+                        args.other.ttt_batch)
+        avg_loop = all_loop // args.other.loop
+        last_add = all_loop % args.other.loop
+        global_eps = [avg_loop for _ in range(args.other.loop-1)] + [avg_loop+last_add]
+
+        print(args.client.sample_rate)
+        print(args.other.is_continue)
+        print(args.other.online)
+
+        cnt = 0
+
+        # Launcher of the operations of participated clients in each round. The clients of a group are released from the
+        # launcher when the group is rebuilt.
+        # The default launcher on linux is ``multiprocessing``, which forks after CUDA has been initialized above, so
+        # the clients are run serially unless a launcher is set in the experiment config.
+        # With ``multiprocessing``, client state changed in place by the group (e.g. the BN statistics of
+        # ``method='bn'``) is not seen by the workers, so it can only be used with methods that aggregate the model
+        # weights.
+        launcher = get_launcher(args) if use_launcher else SerialLauncher()
+        if args.other.method == 'bn' and not launcher.shares_client_state:
+            raise ValueError(f'Launcher {args.launcher.name} can not be used with method: {args.other.method}')
+        # Adapt the participated clients together with batched weights, see ``BatchedAdapter``.
+        # The clients of the main process are used, which are not up to date with a multiprocessing launcher.
+        batched_adapter = BatchedAdapter(args) if args.other.batched_adapt and args.other.method != 'bn' and \
+            launcher.shares_client_state else None
+        # Collated test batches of all participating clients in each round, gathered together and prefetched in the
+        # background, see ``RoundBatchLoader``.
+        # The frozen anchor model of the clients, which is not always ``net``: some clients replace layers of their
+        # models, e.g. the pooling of tiny-imagenet. All clients load the same checkpoint, so they share one anchor.
+        anchor_model = getattr(group.clients[0], 'model_anchor', None)
+        anchor_cache = None
+        if args.other.corruption_stream and args.other.anchor_cache and anchor_model is not None:
+            # The outputs of the source model on all test splits, computed once in large batches and shared with later
+            # runs through the files under ``args.other.anchor_cache_path``.
+            anchor_cache = AnchorOutputCache(
+                anchor_model, get_cache_path(args, 'anchor_cache_path'), args.learn.device, data_key=data_digest(args)
+            )
+            for corrupt in args.data.corruption:
+                for level in args.data.level:
+                    anchor_cache.get(split_name(args.data.dataset, corrupt, level), corrupt_dict[corrupt][level])
+        round_loader = RoundBatchLoader(corrupt_test_sets, args, anchor_cache) if args.other.corruption_stream else None
+        # The clients share one frozen anchor model, which is run once for the batches of all participating clients in
+        # each round. With a multiprocessing launcher, the clients run their anchor models in the workers instead.
+        shared_anchor = SharedAnchor(anchor_model, args.learn.device) if round_loader is not None and \
+            anchor_model is not None and args.other.shared_anchor and launcher.shares_client_state else None
+
+        # The participating clients, corruptions and batch offsets of all rounds, compiled before the loop. A schedule
+        # saved by a previous run can be loaded to replay it exactly.
+        if args.other.schedule_path is not None:
+            schedule = load_schedule(args.other.schedule_path)
+        else:
+            corupt_map = non_iid_continual(args=args, is_niid=args.other.niid, client_number=args.client.client_num,
+                                           corupt_number=len(args.data.corruption))
+            schedule = compile_round_schedule(
+                args, corupt_map, len(corrupt_test_sets[0][args.data.corruption[0]][args.data.level[0]]), seed
+            )
+        save_schedule(schedule, os.path.join(args.other.logging_path, 'schedule.npy'))
+        if round_loader is not None:
+            rounds = round_loader.rounds(schedule)
+        else:
+            rounds = ((rows, None) for rows in iter_rounds(schedule))
+        num_rounds = int(schedule[-1, ROUND]) + 1 if len(schedule) > 0 else 0
+
+        for rows, batches in tqdm.tqdm(rounds, total=num_rounds):
+            level, lp, cidx, i = (int(v) for v in rows[0, [LEVEL, LOOP, STEP, EPS]])
+            participated_clients = rows[:, CLIENT].tolist()
+            if i == 0:
+                # determine the corruption
+                logger.logging('Starting Federated Test-Time Adaptation round: ')
 
-    net.cuda()
+                # Random sample participated clients in each communication round.
+                if not args.other.is_continue:
+                    launcher.release(group.clients)
+                    group = init_tta_state(args, net, ckpt, logger, corrupt_dict, corrupt_test_sets, origin_test_sets, train_dataloader)
+                    print('Here in the is continue')
 
-    test_origin(net, test_dataloader)
+            cnt += 1
+            global_feature_indicator = []
+            global_mean = []
+
+            # Update each batch
+            if not args.other.online:
+                launcher.release(group.clients)
+                group = init_tta_state(args, net, ckpt, logger, corrupt_dict, corrupt_test_sets, origin_test_sets)
+                print('Here in the online')
+
+            clients = [group.clients[j] for j in participated_clients]
+            data_kwargs = []
+            for k, row in enumerate(rows):
+                # Collect test data
+                corupt = args.data.corruption[row[CORRUPTION]]
+                if batches is not None:
+                    inference_data = batches[k]
+                else:
+                    dataset = corrupt_test_sets[row[CLIENT]][corupt][level]
+                    indexs = dataset.indexes[row[OFFSET]:row[OFFSET] + args.other.ttt_batch]
+                    inference_data = NaiveDataset(tot_data=dataset.tot_data, indexes=indexs)
+                data_kwargs.append({'test_data': inference_data})
+            if shared_anchor is not None:
+                shared_anchor.attach([kwargs['test_data'] for kwargs in data_kwargs])
+
+            # Test Before Adaptation
+            feature_indicators = []
+            for test_monitor, feature_indicator in launcher.launch(
+                    clients=clients, task_name='test_source', client_kwargs=data_kwargs):
+                test_monitor_list[cidx].append(test_monitor)
+                feature_indicators.append(feature_indicator)
+
+            #  Client Test Along with Adaptation
+            if args.other.method == 'bn':
+                adapt_monitors = []
+                for test_mean, adapt_monitor in launcher.launch(
+                        clients=clients, task_name='adapt', client_kwargs=data_kwargs):
+                    global_mean.append(test_mean)
+                    adapt_monitors.append(adapt_monitor)
+            elif batched_adapter is not None:
+                # Adapt all participated clients in one pass.
+                adapt_monitors = batched_adapter.adapt(clients)
+            else:
+                adapt_monitors = launcher.launch(clients=clients, task_name='adapt', client_kwargs=data_kwargs)
+
+            logits_kwargs = []
+            for j, adapt_monitor in zip(participated_clients, adapt_monitors):
+                adapt_monitor_list[cidx].append(adapt_monitor)
+                # fed_adapt_monitor_list[cidx].append(adapt_monitor)
+
+                if args.method.data_used != "original":
+                    if args.method.data_used == 'random':
+                        test_data = {}
+                        test_data['input'] = torch.rand((64, 3, 32, 32))
+                        test_data['class_id'] = torch.randint(low = 0, high=100, size = (64,))
+
+                    elif args.method.data_used =='cifar':
+                        for _, data in enumerate(test_dataloader):
+                            test_data = data
+                            break
+                    else:
+                        raise NotImplementedError
+                    logits_kwargs.append({'test_data': test_data})
+
+            if args.method.data_used != "original":
+                feature_indicators = launcher.launch(
+                    clients=clients, task_name='get_logits', client_kwargs=logits_kwargs
+                )
+            global_feature_indicator = list(feature_indicators)
+
+            # Aggregate parameters in each client.
+            if args.other.is_average:
+                logger.logging('-' * 10 + ' Average ' + '-' * 10)
+                if args.other.method == 'bn':
+                    if args.method.name == 'ours':
+                        print('Ours')
+                        group.aggregate_bn_ours(i, global_mean, global_feature_indicator)
+                    else:
+                        print(args.method.name)
+                        group.aggregate_bn(i, global_mean, global_feature_indicator)
+                else:
+                    if args.method.name == 'ours':
+                        print('Ours')
+                        group.aggregate_grad_ours(i, global_feature_indicator)
 
-    # Initialize group, clients and server.
-    group = init_tta_state(args, net, ckpt, logger, corrupt_dict, corrupt_test_sets, origin_test_sets, train_dataloader)
+                    else:
+                        print(args.method.name)
+                        group.aggregate_grad(i, global_feature_indicator)
 
-    # Training loop
-    test_monitor_list = [VariableMonitor() for _ in range(len(args.data.corruption))]
-    adapt_monitor_list = [VariableMonitor() for _ in range(len(args.data.corruption))]
-    fed_adapt_monitor_list = [VariableMonitor() for _ in range(len(args.data.corruption))]
+            if 'ft' in args.method.name:
+                fed_results = launcher.launch(clients=clients, task_name='adapt', test_data=inference_data)
+            else:
+                fed_results = launcher.launch(clients=clients, task_name='inference')
+            for adapt_monitor in fed_results:
+                fed_adapt_monitor_list[cidx].append(adapt_monitor)
 
-    # calculate loop
-    all_loop = int(len(corrupt_test_sets[0][args.data.corruption[0]][args.data.level[0]]) /
-                    args.other.ttt_batch)
-    avg_loop = all_loop // args.other.loop
-    last_add = all_loop % args.other.loop
-    global_eps = [avg_loop for _ in range(args.other.loop-1)] + [avg_loop+last_add]
+            # tsne_plot(group, participated_clients)
+            # Compute and log average differences
+            # compute_average_differences(group)
 
-    print(args.client.sample_rate)
-    print(args.other.is_continue)
-    print(args.other.online)
 
-    cnt = 0
+            if args.method.name == 'ours':
+                diff_mode = 'diff'
 
-    for level in args.data.level:
-        for lp in tqdm.tqdm(range(args.other.loop)):
-            for cidx in range(len(args.data.corruption)):
-                # determine the corruption
-                logger.logging('Starting Federated Test-Time Adaptation round: ')
+            #     if args.method.feat_sim == 'feature':
+            #         compute_differences(global_feature_indicator, 'Feature Mean', diff_mode)
 
-                corupt_map = non_iid_continual(args=args, is_niid=args.other.niid, client_number=args.client.client_num,
-                                               corupt_number=len(args.data.corruption))
-                participated_clients = client_sampling(range(args.client.client_num), args.client.sample_rate)
+            #     elif args.method.feat_sim == 'pvec':
+            #         compute_differences(global_feature_indicator, 'Principal Vector', diff_mode)
 
-                # Random sample participated clients in each communication round.
-                if not args.other.is_continue:
-                    group = init_tta_state(args, net, ckpt, logger, corrupt_dict, corrupt_test_sets, origin_test_sets, train_dataloader)
-                    print('Here in the is continue')
+            #     elif args.method.feat_sim == 'output':
+            #         compute_differences(global_feature_indicator, 'Output', diff_mode)
 
-                for i in range(global_eps[lp]):
-                    cnt += 1
-                    global_feature_indicator = []
-                    global_mean = []
+            #     
+                flattened_weights_list = []
+                for client in group.clients:
+                    # Flatten and concatenate all parameters, detaching them from the computation graph
+                    client.model.requires_grad_(True)
+                    flattened_weights = torch.cat([param.view(-1).detach() for param in client.model.parameters() if param.requires_grad])
+                    flattened_weights_list.append(flattened_weights)
 
-                    # Update each batch
-                    if not args.other.online:
-                        group = init_tta_state(args, net, ckpt, logger, corrupt_dict, corrupt_test_sets, origin_test_sets)
-                        print('Here in the online')
+                compute_differences(flattened_weights_list, 'Model Weight', diff_mode, sink=sink, step=cnt)
 
-                    for j in participated_clients:
-                        # Collect test data
-                        corupt = args.data.corruption[corupt_map[j][cidx]]
-                
-                        indexs = corrupt_test_sets[j][corupt][level].indexes[0:  args.other.ttt_batch]
-                        dataset = corrupt_test_sets[j][corupt][level].tot_data
-                        corrupt_test_sets[j][corupt][level].indexes = corrupt_test_sets[j][corupt][level].indexes[args.other.ttt_batch : ]
-                        inference_data = NaiveDataset(tot_data=dataset, indexes=indexs)
-
-                        # Test Before Adaptation
-                        test_monitor, feature_indicator = group.clients[j].test_source(test_data=inference_data)
-                        test_monitor_list[cidx].append(test_monitor)
-                        # logger.logging(
-                        #     f'Client {j} Corupt {corupt}: Old Test Acc {test_monitor["test_acc"]}, Old Test Loss {test_monitor["test_loss"]}'
-                        # )
-                       
-
-                        #  Client Test Along with Adaptation
-                        if args.other.method == 'bn':
-                            test_mean, adapt_monitor = group.clients[j].adapt(test_data=inference_data)
-                            global_mean.append(test_mean)
-                        else:
-                            adapt_monitor = group.clients[j].adapt(test_data=inference_data)
-                        adapt_monitor_list[cidx].append(adapt_monitor)
-                        # fed_adapt_monitor_list[cidx].append(adapt_monitor)
-
-                        if args.method.data_used != "original":
-                            if args.method.data_used == 'random':
-                                test_data = {}
-                                test_data['input'] = torch.rand((64, 3, 32, 32))
-                                test_data['class_id'] = torch.randint(low = 0, high=100, size = (64,))
-                                
-                            elif args.method.data_used =='cifar':
-                                for _, data in enumerate(test_dataloader):
-                                    test_data = data
-                                    break
-                            else:
-                                raise NotImplementedError
-                                
-                            feature_indicator = group.clients[j].get_logits(test_data)
-
-                        global_feature_indicator.append(feature_indicator)
-
-                    # Aggregate parameters in each client.
-                    if args.other.is_average:
-                        logger.logging('-' * 10 + ' Average ' + '-' * 10)
-                        if args.other.method == 'bn':
-                            if args.method.name == 'ours':
-                                print('Ours')
-                                group.aggregate_bn_ours(i, global_mean, global_feature_indicator)
-                            else:
-                                print(args.method.name)
-                                group.aggregate_bn(i, global_mean, global_feature_indicator)
-                        else:
-                            if args.method.name == 'ours':
-                                print('Ours')
-                                group.aggregate_grad_ours(i, global_feature_indicator)
-                  
-                            else:
-                                print(args.method.name)
-                                group.aggregate_grad(i, global_feature_indicator)
-
-                    for j in participated_clients:
-                        if 'ft' in args.method.name:
-                            adapt_monitor = group.clients[j].adapt(test_data=inference_data)
-                        else:
-
-                            adapt_monitor = group.clients[j].inference()
-                        fed_adapt_monitor_list[cidx].append(adapt_monitor)
-                    
-                    # tsne_plot(group, participated_clients)
-                    # Compute and log average differences
-                    # compute_average_differences(group)
-                   
+            #     elif args.method.feat_sim == 'gradient':
+            #         flattened_gradients_list = []
+            #         for client in group.clients:
+            #             flattened_gradients = torch.cat([param.grad.view(-1) for param in client.model.parameters() if param.grad is not None])
+            #             flattened_gradients_list.append(flattened_gradients)
+            #         compute_differences(flattened_gradients_list, 'Gradient', diff_mode)
 
-                    if args.method.name == 'ours':
-                        diff_mode = 'diff'
-
-                    #     if args.method.feat_sim == 'feature':
-                    #         compute_differences(global_feature_indicator, 'Feature Mean', diff_mode)
-
-                    #     elif args.method.feat_sim == 'pvec':
-                    #         compute_differences(global_feature_indicator, 'Principal Vector', diff_mode)
-                        
-                    #     elif args.method.feat_sim == 'output':
-                    #         compute_differences(global_feature_indicator, 'Output', diff_mode)
-                        
-                    #     
-                        flattened_weights_list = []
-                        for client in group.clients:
-                            # Flatten and concatenate all parameters, detaching them from the computation graph
-                            client.model.requires_grad_(True)
-                            flattened_weights = torch.cat([param.view(-1).detach() for param in client.model.parameters() if param.requires_grad])
-                            flattened_weights_list.append(flattened_weights)
-                        
-                        compute_differences(flattened_weights_list, 'Model Weight', diff_mode)
-                    
-                    #     elif args.method.feat_sim == 'gradient':
-                    #         flattened_gradients_list = []
-                    #         for client in group.clients:
-                    #             flattened_gradients = torch.cat([param.grad.view(-1) for param in client.model.parameters() if param.grad is not None])
-                    #             flattened_gradients_list.append(flattened_gradients)
-                    #         compute_differences(flattened_gradients_list, 'Gradient', diff_mode)
-
-                    
-                    # tsne_plot(group, participated_clients, args.other.logging_path)
-                    num_round = cidx * global_eps[lp] + i
-
-                    logger.logging(
-                        f'{num_round} / 750 | Coruption Type: {corupt}{level} | Adapt: {adapt_monitor_list[cidx].variable_mean()["test_acc"]: 0.3f} | Fed Adapt: {fed_adapt_monitor_list[cidx].variable_mean()["test_acc"]: 0.3f}'
-                    )
-    if args.group.name == 'adapt_group' or args.group.name == 'fedamp_group' or args.group.name == 'fedgraph_group':
-        with open(os.path.join(args.other.logging_path, 'collaboration.pkl'), 'wb') as f:
-            pickle.dump(group.collaboration_graph, f)
-    # Print & Save the outcome
-    data_record = np.array([[0. for _ in range(len(args.data.corruption))] for _ in range(3)])
-    for cidx in range(len(args.data.corruption)):
-        corupt = args.data.corruption[cidx]
-        # Origin
-        mean_test_variables = test_monitor_list[cidx].variable_mean()
-        data_record[0][cidx] = mean_test_variables["test_acc"]
-        logger.logging(
-            f'Corruption Type: {corupt}{args.data.level} | Old Test Acc:  {mean_test_variables["test_acc"]: 0.3f} | Old Test Loss {mean_test_variables["test_loss"]: 0.3f}')
-
-        mean_adapt_variables = adapt_monitor_list[cidx].variable_mean()
-        data_record[1][cidx] = mean_adapt_variables["test_acc"]
-        logger.logging(
-            f'Corruption Type: {corupt}{args.data.level} | Adapt Acc: {mean_adapt_variables["test_acc"]: 0.3f} | Adapt Loss {mean_adapt_variables["test_loss"]: 0.3f}')
-
-        mean_fed_variables = fed_adapt_monitor_list[cidx].variable_mean()
-        data_record[2][cidx] = mean_fed_variables["test_acc"]
-        logger.logging(
-            f'Corruption Type: {corupt}{args.data.level} | Fed Acc:  {mean_fed_variables["test_acc"]:0.3f} | Fed Loss: {mean_fed_variables["test_loss"]: 0.3f}')
-
-    dfData = {
-        '序号': ['Before', 'Adapt', 'Fed'],
-    }
-    data_record_mean = np.mean(data_record, axis=1)
-    for cidx in range(len(args.data.corruption)):
-        corupt = args.data.corruption[cidx]
-        dfData[corupt] = data_record[:, cidx]
-    dfData['Avg'] = data_record_mean
-    df = pd.DataFrame(dfData)
-    print(dfData)
-    df.to_excel(os.path.join(args.other.logging_path, 'outcome.xlsx'), index=False)
-
-    logger.logging(f"Test acc: {data_record_mean[0] * 100 : 0.2f}")
-    logger.logging(f"Adapt acc: {data_record_mean[1] * 100 : 0.2f}")
-    logger.logging(f"Fed acc: {data_record_mean[2] * 100 : 0.2f}")
-
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-
-    # Convert to hours, minutes, and seconds
-    hours, rem = divmod(elapsed_time, 3600)
-    minutes, seconds = divmod(rem, 60)
-
-    logger.logging(f"Time elapsed: {int(hours)}h {int(minutes)}m {seconds:.2f}s")
+
+            # tsne_plot(group, participated_clients, args.other.logging_path)
+            num_round = cidx * global_eps[lp] + i
+
+            # The metrics of all clients in this round are accumulated on the device, and copied to the host
+            # once here.
+            adapt_variables, fed_variables = VariableMonitor.reduce(
+                [adapt_monitor_list[cidx], fed_adapt_monitor_list[cidx]]
+            )
+            logger.logging(
+                f'{num_round} / 750 | Coruption Type: {corupt}{level} | Adapt: {adapt_variables["test_acc"]: 0.3f} | Fed Adapt: {fed_variables["test_acc"]: 0.3f}'
+            )
+            sink.log_scalars(adapt_variables, step=cnt, prefix=f'adapt/{corupt}{level}')
+            sink.log_scalars(fed_variables, step=cnt, prefix=f'fed/{corupt}{level}')
+            sink.flush()
+        if args.group.name == 'adapt_group' or args.group.name == 'fedamp_group' or args.group.name == 'fedgraph_group':
+            with open(os.path.join(args.other.logging_path, 'collaboration.pkl'), 'wb') as f:
+                pickle.dump(group.collaboration_graph, f)
+        # Print & Save the outcome
+        data_record = np.array([[0. for _ in range(len(args.data.corruption))] for _ in range(3)])
+        for cidx in range(len(args.data.corruption)):
+            corupt = args.data.corruption[cidx]
+            # Origin
+            mean_test_variables, mean_adapt_variables, mean_fed_variables = VariableMonitor.reduce(
+                [test_monitor_list[cidx], adapt_monitor_list[cidx], fed_adapt_monitor_list[cidx]]
+            )
+            data_record[0][cidx] = mean_test_variables["test_acc"]
+            logger.logging(
+                f'Corruption Type: {corupt}{args.data.level} | Old Test Acc:  {mean_test_variables["test_acc"]: 0.3f} | Old Test Loss {mean_test_variables["test_loss"]: 0.3f}')
+
+            data_record[1][cidx] = mean_adapt_variables["test_acc"]
+            logger.logging(
+                f'Corruption Type: {corupt}{args.data.level} | Adapt Acc: {mean_adapt_variables["test_acc"]: 0.3f} | Adapt Loss {mean_adapt_variables["test_loss"]: 0.3f}')
+
+            data_record[2][cidx] = mean_fed_variables["test_acc"]
+            logger.logging(
+                f'Corruption Type: {corupt}{args.data.level} | Fed Acc:  {mean_fed_variables["test_acc"]:0.3f} | Fed Loss: {mean_fed_variables["test_loss"]: 0.3f}')
+
+        dfData = {
+            '序号': ['Before', 'Adapt', 'Fed'],
+        }
+        data_record_mean = np.mean(data_record, axis=1)
+        for cidx in range(len(args.data.corruption)):
+            corupt = args.data.corruption[cidx]
+            dfData[corupt] = data_record[:, cidx]
+        dfData['Avg'] = data_record_mean
+        df = pd.DataFrame(dfData)
+        print(dfData)
+        df.to_excel(os.path.join(args.other.logging_path, 'outcome.xlsx'), index=False)
+
+        logger.logging(f"Test acc: {data_record_mean[0] * 100 : 0.2f}")
+        logger.logging(f"Adapt acc: {data_record_mean[1] * 100 : 0.2f}")
+        logger.logging(f"Fed acc: {data_record_mean[2] * 100 : 0.2f}")
+
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+
+        # Convert to hours, minutes, and seconds
+        hours, rem = divmod(elapsed_time, 3600)
+        minutes, seconds = divmod(rem, 60)
+
+        logger.logging(f"Time elapsed: {int(hours)}h {int(minutes)}m {seconds:.2f}s")
+    finally:
+        if launcher is not None:
+            launcher.close()
+        sink.close()
 
     # /teamspace/studios/this_studio/FedCTTA/fling/pipeline/fltta_model_pipeline.
\ No newline at end of file
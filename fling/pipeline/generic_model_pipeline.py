@@ -87,3 +87,5 @@ def generic_model_pipeline(args: dict, seed: int = 0) -> None:
 
             # Saving model checkpoints.
             torch.save(group.server.glob_dict, os.path.join(args.other.logging_path, 'model.ckpt'))
+
+    launcher.close()
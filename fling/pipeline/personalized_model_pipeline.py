@@ -127,3 +127,5 @@ def personalized_model_pipeline(args: dict, seed: int = 0) -> None:
             tmp_mean = sum([finetune_results[cid][eid][key]
                             for cid in range(len(finetune_results))]) / len(finetune_results)
             logger.add_scalar(f'finetune/{key}', tmp_mean, eid)
+
+    launcher.close()
@@ -1,6 +1,14 @@
 from .torch_utils import get_optimizer, get_params_number, save_file, load_file,\
     calculate_mean_std, seed_everything, get_weights, LRScheduler, get_activation, get_model_difference
-from .config_utils import save_config_file, compile_config
-from .utils import Logger, client_sampling, VariableMonitor
+from .config_utils import save_config_file, compile_config, get_cache_path
+from .utils import Logger, client_sampling, VariableMonitor, materialize_metrics
 from .data_utils import get_data_transform
+from .arena_utils import ParameterArena
+from .residency_utils import ResidencyManager, get_residency_manager
+from .similarity_utils import pairwise_similarity, SimilarityMatrix
+from .qp_utils import project_simplex, SimplexQPSolver
+from .history_utils import RingHistory
+from .anchor_cache_utils import AnchorOutputCache, SharedAnchor, get_anchor_model, model_hash, data_digest
+from .regularizer_utils import ParamRegularizer, regularizer_loss
+from .metrics_utils import MetricsSink, get_metrics_sink
 from .launcher_utils import get_launcher
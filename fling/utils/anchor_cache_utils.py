@@ -0,0 +1,236 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+
+
+def model_hash(model: nn.Module) -> str:
+    r"""
+    Overview:
+        Hash of the structure of ``model`` and the names and values of all tensors in ``model.state_dict()``, which \
+    identifies a checkpoint loaded into a model. Modules without tensors (e.g. the pooling layers) are part of the hash.
+    """
+    h = hashlib.sha1()
+    h.update(repr(model).encode())
+    for k, v in model.state_dict().items():
+        h.update(k.encode())
+        h.update(str(v.dtype).encode())
+        h.update(v.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def data_digest(args: dict) -> str:
+    r"""
+    Overview:
+        Hash of the data config that the outputs of the source model on a split depend on, besides the checkpoint: \
+    the absolute data path and the transforms (e.g. the normalization).
+    """
+    config = [os.path.abspath(args.data.data_path), args.data.transforms]
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Frozen anchor models in this process, keyed by the type and the hash of the source model.
+_anchor_models: Dict[tuple, nn.Module] = {}
+_anchor_lock = threading.Lock()
+
+
+def get_anchor_model(model: nn.Module) -> nn.Module:
+    r"""
+    Overview:
+        Get the frozen copy of ``model`` used as the ``model_anchor`` of TTA clients.
+        All clients in a process load the same checkpoint, so they share one copy, in eval mode and without \
+    gradients, instead of keeping a ``copy.deepcopy(self.model)`` each. Callers must not modify it.
+    Arguments:
+        model: the source model with the loaded checkpoint.
+    Returns:
+        anchor: the shared frozen model with the same weights as ``model``.
+    """
+    key = (type(model), model_hash(model))
+    with _anchor_lock:
+        if key not in _anchor_models:
+            anchor = copy.deepcopy(model)
+            anchor.eval()
+            anchor.requires_grad_(False)
+            _anchor_models[key] = anchor
+        return _anchor_models[key]
+
+
+class AnchorOutputCache:
+    r"""
+    Overview:
+        Cache of the outputs of the frozen source model (the ``model_anchor`` of TTA clients) on test splits.
+        The outputs of the source model on a sample never change, so the features and logits of a whole split (e.g. one
+    corruption and severity of CIFAR-10-C) are computed once, in large batches, and saved as ``.npy`` files under
+    ``<path>/<checkpoint hash>-<data_key>/``. They are then read through memory maps, so they are reused by all
+    clients, and by later runs with other seeds and methods. A sample is identified by the name of its split and its
+    index in it. Cached files whose length differs from the split, or whose first samples differ from a direct \
+    forward of the model, are computed again.
+    """
+
+    def __init__(
+        self, model: nn.Module, path: str, device: str, batch_size: int = 256, data_key: str = '', check_size: int = 8
+    ):
+        r"""
+        Overview:
+            Initialization for the cache.
+        Arguments:
+            model: the frozen anchor model of the clients, see ``get_anchor_model``. It is called with \
+        ``mode='compute-feature-logit'`` in eval mode.
+            path: the root directory of the cache files. If set to ``None``, the outputs are only kept in memory.
+            device: the device on which the outputs are computed.
+            batch_size: the batch size used when computing the outputs of a split.
+            data_key: identifies the data the splits are read from, e.g. ``data_digest(args)``, so that outputs on \
+        other data or with other transforms are cached separately.
+            check_size: the number of samples of a split compared with a direct forward of the model, when the \
+        outputs of the split are read from the files of the cache.
+        """
+        self.model = model
+        self.device = device
+        self.batch_size = batch_size
+        self.check_size = check_size
+        self.hash = model_hash(model)
+        self.path = None if path is None else os.path.join(path, self.hash + ('-' + data_key if data_key else ''))
+        # Outputs of each split: name -> (features, logits).
+        self.outputs: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self.lock = threading.Lock()
+
+    def _files(self, name: str) -> Tuple[str, str]:
+        return os.path.join(self.path, name + '.feature.npy'), os.path.join(self.path, name + '.logit.npy')
+
+    def _forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Run the source model on a batch of inputs, and get the outputs on the host.
+        self.model.eval()
+        self.model.to(self.device)
+        with torch.no_grad():
+            feature, out = self.model(x.to(self.device), mode='compute-feature-logit')
+        return feature.float().cpu(), out.float().cpu()
+
+    def _compute(self, dataset: Dataset) -> Tuple[np.ndarray, np.ndarray]:
+        # Run the source model on all samples of the split.
+        from fling.utils.data_utils import DecodedSplit
+        split = DecodedSplit(dataset)
+        features, logits = [], []
+        for start in range(0, len(dataset), self.batch_size):
+            batch = split.gather(range(start, min(start + self.batch_size, len(dataset))))
+            feature, out = self._forward(batch.data['input'])
+            features.append(feature)
+            logits.append(out)
+        return torch.cat(features).numpy(), torch.cat(logits).numpy()
+
+    def _matches(self, dataset: Dataset, outputs: Tuple[np.ndarray, np.ndarray]) -> bool:
+        # Whether the cached outputs of the first samples of the split are the outputs of a direct forward of the
+        # model on these samples, which are loaded one by one as in a ``DataLoader``.
+        num = min(self.check_size, len(dataset))
+        if num == 0:
+            return True
+        x = default_collate([dataset[i] for i in range(num)])['input']
+        return all(
+            cached[:num].shape == direct.shape and np.allclose(cached[:num], direct.numpy(), rtol=1e-3, atol=1e-4)
+            for cached, direct in zip(outputs, self._forward(x))
+        )
+
+    def get(self, name: str, dataset: Dataset) -> Tuple[np.ndarray, np.ndarray]:
+        r"""
+        Overview:
+            Get the features and logits of the source model on all samples of a split. They are read from the files \
+        of the cache if they exist, and computed otherwise.
+        Arguments:
+            name: the name of the split, e.g. ``cifar10_test-gaussian_noise-5``.
+            dataset: the dataset of the split.
+        Returns:
+            features: array with shape ``[N, D]``.
+            logits: array with shape ``[N, C]``.
+        """
+        with self.lock:
+            if name not in self.outputs:
+                outputs = None
+                if self.path is not None and all(os.path.exists(f) for f in self._files(name)):
+                    outputs = tuple(np.load(f, mmap_mode='r') for f in self._files(name))
+                    # Files of a split with another size (e.g. another ``tesize``) are computed again.
+                    if any(len(array) != len(dataset) for array in outputs):
+                        outputs = None
+                    # Files that do not match the model on the first samples of the split are computed again.
+                    elif not self._matches(dataset, outputs):
+                        outputs = None
+                if outputs is None:
+                    outputs = self._compute(dataset)
+                    if self.path is not None:
+                        os.makedirs(self.path, exist_ok=True)
+                        for f, array in zip(self._files(name), outputs):
+                            # Write to a temporary file first, so that other runs never read a partial file.
+                            tmp = f + '.%d.tmp' % os.getpid()
+                            with open(tmp, 'wb') as fp:
+                                np.save(fp, array)
+                            os.replace(tmp, f)
+                self.outputs[name] = outputs
+            return self.outputs[name]
+
+    def lookup(self, name: str, dataset: Dataset, indexes: np.ndarray) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""
+        Overview:
+            Get the features and logits of the source model on the samples ``indexes`` of a split.
+        Returns:
+            features: tensor with shape ``[B, D]``.
+            logits: tensor with shape ``[B, C]``.
+        """
+        features, logits = self.get(name, dataset)
+        indexes = np.asarray(indexes)
+        return torch.from_numpy(np.array(features[indexes])), torch.from_numpy(np.array(logits[indexes]))
+
+
+class SharedAnchor:
+    r"""
+    Overview:
+        Run the shared frozen anchor model once for the test batches of all participating clients in a round.
+        The inputs of all batches are concatenated and passed through the model in one forward (or a few if they \
+    exceed ``max_batch_size``). The features and logits are then split back and attached to the batch of each \
+    client as ``anchor_feature`` and ``anchor_logit``, which are read by ``ClientTemplate.anchor_forward``. The model \
+    is in eval mode, so the outputs of a sample do not depend on the other samples of the forward.
+    """
+
+    def __init__(self, model: nn.Module, device: str, max_batch_size: int = 1024):
+        r"""
+        Overview:
+            Initialization for the shared anchor.
+        Arguments:
+            model: the frozen anchor model, see ``get_anchor_model``.
+            device: the device on which the model is run.
+            max_batch_size: the maximum number of samples in one forward.
+        """
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+
+    def attach(self, batches: List) -> None:
+        r"""
+        Overview:
+            Compute the outputs of the anchor model on ``StreamBatch`` es of clients, and attach them to the batches. \
+        Batches that already carry outputs (e.g. from an ``AnchorOutputCache``) are skipped.
+        Arguments:
+            batches: the test batches of the participating clients in this round.
+        """
+        batches = [b for b in batches if 'anchor_logit' not in b.data]
+        if len(batches) == 0:
+            return
+        x = torch.cat([b.data['input'] for b in batches])
+        features, logits = [], []
+        self.model.eval()
+        self.model.to(self.device)
+        with torch.no_grad():
+            for start in range(0, x.shape[0], self.max_batch_size):
+                feature, out = self.model(
+                    x[start:start + self.max_batch_size].to(self.device), mode='compute-feature-logit'
+                )
+                features.append(feature)
+                logits.append(out)
+        sizes = [len(b) for b in batches]
+        for b, feature, out in zip(batches, torch.cat(features).split(sizes), torch.cat(logits).split(sizes)):
+            b.data['anchor_feature'], b.data['anchor_logit'] = feature, out
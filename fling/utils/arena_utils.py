@@ -0,0 +1,173 @@
+from typing import Dict, Iterable, List
+
+import torch
+import torch.nn as nn
+
+
+class ArenaBuffer(torch.Tensor):
+    r"""
+    Overview:
+        Tensor type for module buffers that live inside a ``ParameterArena``.
+        Deep-copying a plain tensor view duplicates the whole underlying storage, i.e. the full ``[N, P]`` arena.
+    This type only clones its own elements, which is the same behavior as ``nn.Parameter``. Results of operations on it
+    are plain tensors.
+    """
+    __torch_function__ = torch._C._disabled_torch_function_impl
+
+    def __deepcopy__(self, memo: dict) -> torch.Tensor:
+        if id(self) not in memo:
+            memo[id(self)] = self.detach().clone()
+        return memo[id(self)]
+
+    def __reduce_ex__(self, proto: int) -> tuple:
+        # Pickle as a plain tensor with its own storage.
+        return self.detach().clone().__reduce_ex__(proto)
+
+
+class ParameterArena:
+    r"""
+    Overview:
+        One preallocated ``[N, P]`` tensor that holds the parameters and floating point buffers of ``N`` client models.
+        Row ``i`` is the flattened weights of client ``i``. After ``bind``, every parameter and buffer of that model is
+    a view of its row, so the group can aggregate all clients with tensor operations on the arena, and clients can read
+    and write weights without building state dicts.
+        A model that is moved to another device (e.g. by ``model.to('cpu')``) no longer shares memory with the arena.
+    ``sync`` detects this and binds the model again.
+    """
+
+    def __init__(self, models: List[nn.Module], device: str):
+        r"""
+        Overview:
+            Build the arena layout from ``models[0]``, allocate the arena and bind all models to it.
+        Arguments:
+            models: models of all clients. They must have the same architecture.
+            device: device of the arena.
+        """
+        state_dict = models[0].state_dict(keep_vars=True)
+        # Integer buffers such as ``num_batches_tracked`` are not stored in the arena.
+        self.keys = [k for k, v in state_dict.items() if torch.is_floating_point(v)]
+        self.shapes = [state_dict[k].shape for k in self.keys]
+        self.numels = [state_dict[k].numel() for k in self.keys]
+        self.key2idx = {k: i for i, k in enumerate(self.keys)}
+        dtype = state_dict[self.keys[0]].dtype
+
+        self.flat = torch.empty(len(models), sum(self.numels), dtype=dtype, device=device)
+        self.scratch = None
+        self.views = [
+            [v.view(shape) for v, shape in zip(torch.split(row, self.numels), self.shapes)]
+            for row in self.flat.unbind(0)
+        ]
+        self.models = [None for _ in range(len(models))]
+        self.ptrs = [[v.data_ptr() for v in views] for views in self.views]
+        for i, model in enumerate(models):
+            self.bind(i, model)
+
+    def __len__(self) -> int:
+        return self.flat.shape[0]
+
+    def bind(self, idx: int, model: nn.Module) -> None:
+        r"""
+        Overview:
+            Copy the current weights of ``model`` into row ``idx`` and make them views of this row.
+        Arguments:
+            idx: the row of the model.
+            model: the model to be bound.
+        """
+        state_dict = model.state_dict(keep_vars=True)
+        with torch.no_grad():
+            for k, view in zip(self.keys, self.views[idx]):
+                tensor = state_dict[k]
+                view.copy_(tensor)
+                if isinstance(tensor, nn.Parameter):
+                    tensor.data = view
+                else:
+                    module_name, _, buffer_name = k.rpartition('.')
+                    module = model.get_submodule(module_name)
+                    module._buffers[buffer_name] = view.as_subclass(ArenaBuffer)
+        self.models[idx] = model
+
+    def is_bound(self, idx: int) -> bool:
+        r"""
+        Overview:
+            Check whether all weights of the model in row ``idx`` are still views of the arena.
+        """
+        state_dict = self.models[idx].state_dict(keep_vars=True)
+        return all(state_dict[k].data_ptr() == ptr for k, ptr in zip(self.keys, self.ptrs[idx]))
+
+    def sync(self) -> None:
+        r"""
+        Overview:
+            Bind again the models whose weights have been moved out of the arena.
+        """
+        for idx, model in enumerate(self.models):
+            if not self.is_bound(idx):
+                self.bind(idx, model)
+
+    def state_dict(self, idx: int, keys: Iterable = None) -> Dict[str, torch.Tensor]:
+        r"""
+        Overview:
+            Get the weights of row ``idx`` as a diction of views. Keys that are not stored in the arena are read from
+        the model.
+        Arguments:
+            idx: the row of the model.
+            keys: keys to be acquired. If set to ``None``, all keys in the arena are returned.
+        Returns:
+            partial_dict: the acquired diction of weights.
+        """
+        if keys is None:
+            keys = self.keys
+        views = self.views[idx]
+        partial_dict, missing = {}, []
+        for k in keys:
+            if k in self.key2idx:
+                partial_dict[k] = views[self.key2idx[k]]
+            else:
+                missing.append(k)
+        if len(missing) > 0:
+            state_dict = self.models[idx].state_dict()
+            partial_dict.update({k: state_dict[k] for k in missing})
+        return partial_dict
+
+    def load(self, idx: int, dic: dict) -> None:
+        r"""
+        Overview:
+            Write the weights in ``dic`` into row ``idx``. For keys not existed in ``dic``, the value will be retained.
+        Arguments:
+            idx: the row of the model.
+            dic: diction of weights.
+        """
+        views = self.views[idx]
+        dst, src, rest = [], [], {}
+        for k, v in dic.items():
+            if k in self.key2idx:
+                dst.append(views[self.key2idx[k]])
+                src.append(v)
+            else:
+                rest[k] = v
+        with torch.no_grad():
+            for d, s in zip(dst, src):
+                d.copy_(s)
+        if len(rest) > 0:
+            self.models[idx].load_state_dict(rest, strict=False)
+
+    def mix(self, weight: torch.Tensor) -> None:
+        r"""
+        Overview:
+            Replace row ``i`` of the arena by ``sum_j weight[i, j] * row_j``.
+        Arguments:
+            weight: the mixing matrix with shape ``[N, N]``.
+        """
+        self.sync()
+        if self.scratch is None:
+            self.scratch = torch.empty_like(self.flat)
+        weight = weight.detach().to(device=self.flat.device, dtype=self.flat.dtype)
+        torch.matmul(weight, self.flat, out=self.scratch)
+        self.flat.copy_(self.scratch)
+
+    def average(self) -> None:
+        r"""
+        Overview:
+            Replace every row of the arena by the plain average of all rows.
+        """
+        self.sync()
+        self.flat.copy_(self.flat.mean(dim=0, keepdim=True).expand_as(self.flat))
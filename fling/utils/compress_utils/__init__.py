@@ -1 +1,2 @@
 from .fed_avg import fed_avg
+from .flat_aggregator import FlatAggregator, foreach_copy_
@@ -1,9 +1,52 @@
 from functools import reduce
+from typing import List
+
+import torch
 
 from fling.component.server import ServerTemplate
+from .flat_aggregator import foreach_copy_
+
+
+def _weighted_sum_reduce(state_dicts: List[dict], weights: List[float], keys: List[str]) -> dict:
+    # The original implementation, which sums the weighted tensors with ``reduce``.
+    return {
+        k: reduce(lambda x, y: x + y, [w * state_dict[k] for state_dict, w in zip(state_dicts, weights)])
+        for k in keys
+    }
+
 
+def _foreach_mul_(tensors: List[torch.Tensor], scalar: float) -> None:
+    # ``torch._foreach_mul_`` rounds differently from ``scalar * tensor`` for reduced precision dtypes such as float16,
+    # so these tensors are multiplied one by one.
+    fused = [t for t in tensors if t.dtype in (torch.float32, torch.float64)]
+    if len(fused) > 0:
+        torch._foreach_mul_(fused, scalar)
+    for t in tensors:
+        if t.dtype not in (torch.float32, torch.float64):
+            t.mul_(scalar)
 
-def fed_avg(clients: list, server: ServerTemplate) -> int:
+
+def _weighted_sum_foreach(state_dicts: List[dict], weights: List[float], keys: List[str]) -> dict:
+    # Accumulate ``sum_i weights[i] * state_dicts[i][k]`` into buffers allocated once, with one foreach op for all
+    # keys. Each term is computed by a separate multiplication and then added, in the order of clients, so the
+    # rounding is the same as ``_weighted_sum_reduce``.
+    if len(keys) == 0:
+        return {}
+    first = [state_dicts[0][k] for k in keys]
+    # The dtype of ``weight * tensor``, e.g. integer buffers become floating point tensors.
+    output = [torch.empty_like(t, dtype=torch.result_type(t, weights[0])) for t in first]
+    scratch = [torch.empty_like(t) for t in output]
+    with torch.no_grad():
+        foreach_copy_(output, first)
+        _foreach_mul_(output, weights[0])
+        for state_dict, w in zip(state_dicts[1:], weights[1:]):
+            foreach_copy_(scratch, [state_dict[k] for k in keys])
+            _foreach_mul_(scratch, w)
+            torch._foreach_add_(output, scratch)
+    return dict(zip(keys, output))
+
+
+def fed_avg(clients: list, server: ServerTemplate, engine: str = 'foreach') -> int:
     r"""
     Overview:
         Use the average method to aggregate parameters in different client models.
@@ -12,6 +55,10 @@ def fed_avg(clients: list, server: ServerTemplate) -> int:
     Arguments:
         clients: a list of clients that is needed to be aggregated in this round.
         server: The parameter server of these clients.
+        engine: how the weighted sum is computed, one of the followings:
+            ``foreach``: the state dict of each client is taken once, and the weighted tensors are accumulated \
+        in place into preallocated buffers with foreach ops. The result is bit-identical to ``reduce``.
+            ``reduce``: the original implementation, which sums a list of weighted tensors for each key.
     Returns:
         trans_cost: the total uplink cost in this communication round.
     """
@@ -19,18 +66,19 @@ def fed_avg(clients: list, server: ServerTemplate) -> int:
     # The ``sample_num`` refers to the number of data in each client.
     # FedAvg will use a weighted-averaging algorithm to average client models according to their ``sample_num``
     total_samples = sum([client.sample_num for client in clients])
+    weights = [client.sample_num / total_samples for client in clients]
+    keys = list(clients[0].fed_keys)
     # Weighted-averaging.
-    server.glob_dict = {
-        k: reduce(
-            lambda x, y: x + y,
-            [client.sample_num / total_samples * client.model.state_dict()[k] for client in clients]
-        )
-        for k in clients[0].fed_keys
-    }
+    state_dicts = [client.model.state_dict() for client in clients]
+    if engine == 'foreach':
+        server.glob_dict = _weighted_sum_foreach(state_dicts, weights, keys)
+    elif engine == 'reduce':
+        server.glob_dict = _weighted_sum_reduce(state_dicts, weights, keys)
+    else:
+        raise ValueError(f'Unrecognized fed_avg engine: {engine}')
     # Calculate the ``trans_cost``.
     trans_cost = 0
-    state_dict = clients[0].model.state_dict()
-    for k in clients[0].fed_keys:
-        trans_cost += len(clients) * state_dict[k].numel()
+    for k in keys:
+        trans_cost += len(clients) * state_dicts[0][k].numel()
     # 1B = 32bit
     return 4 * trans_cost
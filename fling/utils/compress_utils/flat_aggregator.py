@@ -0,0 +1,125 @@
+from typing import Iterable, List
+
+import torch
+import torch.nn as nn
+
+
+def foreach_copy_(dst: List[torch.Tensor], src: List[torch.Tensor]) -> None:
+    r"""
+    Overview:
+        Copy every tensor in ``src`` into the tensor at the same position of ``dst``.
+        A fused ``torch._foreach_copy_`` kernel is used when it is available in the installed torch.
+    Arguments:
+        dst: tensors to be over-written.
+        src: tensors to be copied from.
+    """
+    with torch.no_grad():
+        if hasattr(torch, '_foreach_copy_'):
+            torch._foreach_copy_(dst, src)
+        else:
+            for d, s in zip(dst, src):
+                d.copy_(s)
+
+
+class FlatAggregator:
+    r"""
+    Overview:
+        Aggregate the models of all clients as a single matrix product.
+        The federated tensors of ``N`` clients are packed into one contiguous ``[N, P]`` buffer ``W``. A mixing matrix
+    ``A`` of shape ``[N, N]`` is applied as ``A @ W``, and each row of the result is copied back into the corresponding
+    model through views of the output buffer. Both buffers are kept across rounds, so no state dict is rebuilt or
+    deep-copied during aggregation.
+        Only floating point tensors are aggregated. Integer buffers such as ``num_batches_tracked`` are retained in
+    each client.
+    """
+
+    def __init__(self, device: str, keys: Iterable = None):
+        r"""
+        Overview:
+            Initialization for the aggregator. The buffer layout is built lazily when models are first packed.
+        Arguments:
+            device: device on which the packed buffers are stored and the mixing is performed.
+            keys: keys in ``model.state_dict()`` to be aggregated. If set to ``None``, all keys will be used.
+        """
+        self.device = device
+        self.keys = None if keys is None else list(keys)
+        self.shapes = None
+        self.numels = None
+        self.flat_in = None
+        self.flat_out = None
+        self.in_views = None
+        self.out_views = None
+
+    def _model_tensors(self, model: nn.Module) -> List[torch.Tensor]:
+        # Tensors of ``model`` that are aggregated, in the layout order.
+        state_dict = model.state_dict(keep_vars=True)
+        return [state_dict[k] for k in self.keys]
+
+    def _row_views(self, flat: torch.Tensor) -> List[List[torch.Tensor]]:
+        # For each row of ``flat``, split it into views with the same shapes as the aggregated tensors.
+        return [
+            [v.view(shape) for v, shape in zip(torch.split(row, self.numels), self.shapes)] for row in flat.unbind(0)
+        ]
+
+    def _build(self, models: List[nn.Module]) -> None:
+        # Determine the layout of the flat buffer and allocate it.
+        state_dict = models[0].state_dict(keep_vars=True)
+        keys = state_dict.keys() if self.keys is None else self.keys
+        self.keys = [k for k in keys if torch.is_floating_point(state_dict[k])]
+        self.shapes = [state_dict[k].shape for k in self.keys]
+        self.numels = [state_dict[k].numel() for k in self.keys]
+        dtype = state_dict[self.keys[0]].dtype
+        self.flat_in = torch.empty(len(models), sum(self.numels), dtype=dtype, device=self.device)
+        self.flat_out = torch.empty_like(self.flat_in)
+        self.in_views = self._row_views(self.flat_in)
+        self.out_views = self._row_views(self.flat_out)
+
+    def pack(self, models: List[nn.Module]) -> torch.Tensor:
+        r"""
+        Overview:
+            Copy the aggregated tensors of all ``models`` into the ``[N, P]`` input buffer.
+        Arguments:
+            models: models of all clients, one row for each.
+        Returns:
+            flat: the packed buffer. It is over-written in the next call of ``pack``.
+        """
+        if self.flat_in is None or self.flat_in.shape[0] != len(models):
+            self._build(models)
+        for i, model in enumerate(models):
+            foreach_copy_(self.in_views[i], self._model_tensors(model))
+        return self.flat_in
+
+    def scatter(self, models: List[nn.Module]) -> None:
+        r"""
+        Overview:
+            Copy each row of the output buffer back into the corresponding model.
+        Arguments:
+            models: models of all clients, in the same order as ``pack``.
+        """
+        for i, model in enumerate(models):
+            foreach_copy_(self._model_tensors(model), self.out_views[i])
+
+    def mix(self, models: List[nn.Module], weight: torch.Tensor) -> None:
+        r"""
+        Overview:
+            Replace the parameters of client ``i`` by ``sum_j weight[i, j] * W[j]``.
+        Arguments:
+            models: models of all clients.
+            weight: the mixing matrix with shape ``[N, N]``.
+        """
+        flat = self.pack(models)
+        weight = weight.detach().to(device=flat.device, dtype=flat.dtype)
+        torch.matmul(weight, flat, out=self.flat_out)
+        self.scatter(models)
+
+    def average(self, models: List[nn.Module]) -> None:
+        r"""
+        Overview:
+            Replace the parameters of every client by the plain average of all clients.
+        Arguments:
+            models: models of all clients.
+        """
+        flat = self.pack(models)
+        torch.mean(flat, dim=0, keepdim=True, out=self.flat_out[:1])
+        self.flat_out[1:].copy_(self.flat_out[:1].expand(flat.shape[0] - 1, -1))
+        self.scatter(models)
@@ -64,6 +64,23 @@ def compile_config(new_config: dict, seed: int) -> dict:
     return result_config
 
 
+def get_cache_path(cfg: dict, key: str) -> str:
+    r"""
+    Overview:
+        Get the path of a cache in ``cfg.other``, e.g. ``anchor_cache_path``. A relative path is resolved under \
+    ``cfg.other.cache_root``, while absolute paths and ``None`` are returned as they are.
+    Arguments:
+        cfg: the compiled config.
+        key: the key of the path in ``cfg.other``.
+    Returns:
+        path: the path of the cache.
+    """
+    path = cfg.other.get(key, None)
+    if path is None:
+        return None
+    return os.path.join(cfg.other.get('cache_root', '.'), path)
+
+
 def deep_merge_dicts(original: dict, new_dict: dict) -> dict:
     """
     Overview:
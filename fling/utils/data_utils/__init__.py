@@ -1,2 +1,4 @@
-from .sampling import data_sampling
+from .sampling import data_sampling, get_targets
 from .data_transform import get_data_transform
+from .stream import StreamBatch, DecodedSplit, split_name, RoundBatchLoader
+from .schedule import compile_round_schedule, iter_rounds, save_schedule, load_schedule
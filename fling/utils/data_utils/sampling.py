@@ -1,6 +1,9 @@
+import hashlib
+import json
+import os
 import random
 from copy import deepcopy
-from typing import List
+from typing import Callable, Dict, List, Optional
 import numpy as np
 
 from torch.utils.data.dataset import Dataset
@@ -19,6 +22,40 @@ class NaiveDataset(data.Dataset):
     def __len__(self) -> int:
         return len(self.indexes)
 
+    @property
+    def targets(self) -> Optional[np.ndarray]:
+        # The labels of the selected samples, if the whole dataset exposes its labels. See ``get_targets``.
+        targets = getattr(self.tot_data, 'targets', None)
+        if targets is None:
+            return None
+        return np.asarray(targets)[np.asarray(self.indexes, dtype=np.int64)]
+
+
+def get_targets(dataset: Dataset) -> np.ndarray:
+    r"""
+    Overview:
+        Get the labels of all samples in a dataset.
+        Datasets can expose their labels as a ``targets`` array, with the same values as the ``class_id`` of each \
+    sample (e.g. ``CIFAR10_TestDataset``, ``CIFAR100_TestDataset``, ``TinyImagenetDataset``, ``ImagenetDataset`` \
+    and ``NaiveDataset``). Then no sample is loaded. Otherwise, or if ``targets`` is ``None``, every sample is \
+    loaded to read its ``class_id``.
+    Arguments:
+        dataset: the dataset.
+    Returns:
+        targets: the labels with type int64 and shape ``[len(dataset)]``.
+    """
+    targets = getattr(dataset, 'targets', None)
+    if targets is None:
+        targets = [dataset[i]['class_id'] for i in range(len(dataset))]
+    return np.asarray(targets, dtype=np.int64)
+
+
+def _class_indexes(labels: np.ndarray, num_classes: int) -> List[np.ndarray]:
+    # The indexes of the samples of each class, in ascending order, by one stable sort of the labels.
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels, minlength=num_classes)
+    return np.split(order, np.cumsum(counts)[:-1])
+
 
 def iid_sampling(dataset: Dataset, client_number: int, sample_num: int, seed: int) -> List:
     r"""
@@ -41,7 +78,7 @@ def iid_sampling(dataset: Dataset, client_number: int, sample_num: int, seed: in
 
     random_state = np.random.RandomState(seed)
 
-    dict_users, all_index = {}, [i for i in range(len(dataset))]
+    dict_users, all_index = {}, np.arange(len(dataset))
     for i in range(client_number):
         dict_users[i] = random_state.choice(all_index, sample_num, replace=False)
         random_state.shuffle(dict_users[i])
@@ -64,17 +101,15 @@ def pathological_sampling(dataset: Dataset, client_number: int, sample_num: int,
         A list of datasets for each client.
     """
     num_indices = len(dataset)
-    labels = np.array([dataset[i]['class_id'] for i in range(num_indices)])
+    labels = get_targets(dataset)
     num_classes = len(np.unique(labels))
-    idxs_classes = [[] for _ in range(num_classes)]
 
     # If sample_num is not specified, then the dataset is divided equally among each client
     if sample_num == 0:
         sample_num = num_indices // client_number
 
     # Get samples for each class.
-    for i in range(num_indices):
-        idxs_classes[labels[i]].append(i)
+    idxs_classes = _class_indexes(labels, num_classes)
 
     client_indexes = [[] for _ in range(client_number)]
     random_state = np.random.RandomState(seed)
@@ -92,8 +127,8 @@ def pathological_sampling(dataset: Dataset, client_number: int, sample_num: int,
             # If the number of samples in ``idx_classes[j]`` is more or equal than the required number,
             # set the argument ``replace=False``. Otherwise, set ``replace=True``
             selected = random_state.choice(idxs_classes[j], select_num, replace=(select_num > len(idxs_classes[j])))
-            client_indexes[i] += list(selected)
-        client_indexes[i] = np.array(client_indexes[i])
+            client_indexes[i].append(selected)
+        client_indexes[i] = np.concatenate(client_indexes[i])
     return [NaiveDataset(tot_data=dataset, indexes=client_indexes[i]) for i in range(client_number)]
 
 
@@ -113,17 +148,15 @@ def dirichlet_sampling(dataset: Dataset, client_number: int, sample_num: int, se
         A list of datasets for each client.
     """
     num_indices = len(dataset)
-    labels = np.array([dataset[i]['class_id'] for i in range(num_indices)])
+    labels = get_targets(dataset)
     num_classes = len(np.unique(labels))
-    idxs_classes = [[] for _ in range(num_classes)]
 
     # If ``sample_num`` is not specified, the dataset is divided equally among each client
     if sample_num == 0:
         sample_num = num_indices // client_number
 
     # Get samples for each class.
-    for i in range(num_indices):
-        idxs_classes[labels[i]].append(i)
+    idxs_classes = _class_indexes(labels, num_classes)
 
     client_indexes = [[] for _ in range(client_number)]
     random_state = np.random.RandomState(seed)
@@ -144,8 +177,8 @@ def dirichlet_sampling(dataset: Dataset, client_number: int, sample_num: int, se
             # If the number of samples in ``idx_classes[j]`` is more or equal than the required number,
             # set the argument ``replace=False``. Otherwise, set ``replace=True``
             selected = random_state.choice(idxs_classes[j], select_num, replace=(select_num > len(idxs_classes[j])))
-            client_indexes[i] += list(selected)
-        client_indexes[i] = np.array(client_indexes[i])
+            client_indexes[i].append(selected)
+        client_indexes[i] = np.concatenate(client_indexes[i])
     return [NaiveDataset(tot_data=dataset, indexes=client_indexes[i]) for i in range(client_number)]
 
 
@@ -157,15 +190,76 @@ sampling_methods = {
 }
 
 
-def data_sampling(dataset: Dataset, args: dict, seed: int, train: bool = True) -> List:
+# Client partitions computed or loaded in this process, keyed by ``_partition_key``.
+_partition_cache: Dict[str, List[np.ndarray]] = {}
+
+
+def _partition_key(
+        dataset: Dataset, sampling_name: str, sampling_config: dict, sample_num: int, client_number: int, seed: int
+) -> Optional[str]:
+    # The partition only depends on the sampler and its arguments, the number of samples and their labels. Labels
+    # are not used by ``iid``. Returns ``None`` if the labels are needed but the dataset does not expose them, since
+    # reading them is what the cache avoids.
+    h = hashlib.sha1()
+    h.update(
+        json.dumps([sampling_name, sorted(sampling_config.items()), sample_num, len(dataset), client_number,
+                    seed]).encode()
+    )
+    if sampling_name != 'iid':
+        if getattr(dataset, 'targets', None) is None:
+            return None
+        h.update(get_targets(dataset).tobytes())
+    return h.hexdigest()
+
+
+def _sample_partition(
+        dataset: Dataset, sampling_func: Callable, sampling_name: str, sampling_config: dict, sample_num: int,
+        client_number: int, seed: int, cache_path: Optional[str]
+) -> List[np.ndarray]:
+    # Get the client indexes from the cache of this process, from ``<cache_path>/<key>.npy``, or by sampling.
+    key = _partition_key(dataset, sampling_name, sampling_config, sample_num, client_number, seed)
+    if key is None:
+        return [d.indexes for d in sampling_func(dataset, client_number, sample_num, seed, **sampling_config)]
+    if key not in _partition_cache:
+        path = None if cache_path is None else os.path.join(cache_path, key + '.npy')
+        if path is not None and os.path.exists(path):
+            # The file stores the number of samples of each client, followed by all indexes.
+            array = np.load(path).astype(np.int64)
+            indexes = np.split(array[client_number:], np.cumsum(array[:client_number])[:-1])
+        else:
+            indexes = [
+                np.asarray(d.indexes, dtype=np.int64)
+                for d in sampling_func(dataset, client_number, sample_num, seed, **sampling_config)
+            ]
+            if path is not None:
+                array = np.concatenate([np.array([len(idx) for idx in indexes], dtype=np.int64)] + indexes)
+                if len(array) == 0 or array.max() < np.iinfo(np.int32).max:
+                    array = array.astype(np.int32)
+                os.makedirs(cache_path, exist_ok=True)
+                # Write to a temporary file first, so that other runs never read a partial file.
+                tmp = path + '.%d.tmp' % os.getpid()
+                with open(tmp, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp, path)
+        _partition_cache[key] = indexes
+    return _partition_cache[key]
+
+
+def data_sampling(
+        dataset: Dataset, args: dict, seed: int, train: bool = True, cache_path: Optional[str] = None
+) -> List:
     r"""
     Overview:
         Dirichlet sampling method.
+        The client partition is cached, so datasets with the same length and labels (e.g. all corruptions and \
+    severities of CIFAR-10-C) share one partition for the same sampler and seed, which is computed once. If \
+    ``cache_path`` is set, the partition is also saved there and reused by later runs.
     Arguments:
         dataset: the total dataset to be sampled from.
         args: arguments.
         seed: dynamic seed.
         train: whether this sampling is for training dataset or testing dataset.
+        cache_path: the directory of the saved partitions. If set to ``None``, they are only cached in memory.
     Returns:
         A list of datasets for each client.
     """
@@ -182,4 +276,8 @@ def data_sampling(dataset: Dataset, args: dict, seed: int, train: bool = True) -
         sampling_func = sampling_methods[sampling_name]
     except KeyError:
         raise ValueError(f'Unrecognized sampling method: {args.data.sample_method.name}')
-    return sampling_func(dataset, args.client.client_num, sample_num, seed, **sampling_config)
+    indexes = _sample_partition(
+        dataset, sampling_func, sampling_name, dict(sampling_config), sample_num, args.client.client_num, seed,
+        cache_path
+    )
+    return [NaiveDataset(tot_data=dataset, indexes=idx) for idx in indexes]
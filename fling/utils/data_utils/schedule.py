@@ -0,0 +1,110 @@
+import os
+from typing import Iterator
+
+import numpy as np
+
+from fling.utils.utils import client_sampling
+
+# Columns of a round schedule. Each row is one participating client in one round.
+ROUND, LEVEL, LOOP, STEP, EPS, CLIENT, CORRUPTION, OFFSET = range(8)
+SCHEDULE_COLUMNS = ['round', 'level', 'loop', 'step', 'eps', 'client', 'corruption', 'offset']
+
+
+def compile_round_schedule(args: dict, corrupt_map: np.ndarray, split_len: int, seed: int = 0) -> np.ndarray:
+    r"""
+    Overview:
+        Compile the rounds of continual TTA into one integer array, before the loop starts.
+        The loop of ``FedTTA_Pipeline`` runs, for each severity ``level``, ``args.other.loop`` loops over the \
+    corruption steps. Each step samples the participating clients once, and runs ``eps`` rounds, in which client \
+    ``j`` adapts on the next ``args.other.ttt_batch`` samples of its split ``corrupt_map[j][step]``. The schedule \
+    contains one row for each participating client in each round, with the columns in ``SCHEDULE_COLUMNS``:
+            ``round``: the index of the round, from 0.
+            ``level``: the severity.
+            ``loop``, ``step``, ``eps``: the indexes of the loop, of the corruption step and of the round in this step.
+            ``client``: the id of the client.
+            ``corruption``: the index of the corruption of the client in ``args.data.corruption``.
+            ``offset``: the position of the batch in the dataset of the client in this split.
+        The participating clients of each step are sampled with ``client_sampling`` from a random state of its own, \
+    created from ``seed``. The schedule only depends on the arguments, not on the global numpy random state, which is \
+    also used by the datasets and the clients before and during the loop.
+    Arguments:
+        args: the arguments of the experiment.
+        corrupt_map: ``corrupt_map[j][step]`` is the index of the corruption of client ``j`` in the corruption step \
+    ``step``, see ``non_iid_continual``.
+        split_len: the number of samples of each client in each split.
+        seed: the seed of the sampling of the participating clients.
+    Returns:
+        schedule: int64 array with shape ``[N, len(SCHEDULE_COLUMNS)]``, sorted by round.
+    """
+    ttt_batch = args.other.ttt_batch
+    all_loop = int(split_len / ttt_batch)
+    avg_loop = all_loop // args.other.loop
+    last_add = all_loop % args.other.loop
+    global_eps = [avg_loop for _ in range(args.other.loop - 1)] + [avg_loop + last_add]
+
+    random_state = np.random.RandomState(seed)
+    corrupt_map = np.asarray(corrupt_map, dtype=np.int64)
+    blocks = []
+    # Number of samples already consumed by each client in each split.
+    consumed = np.zeros((args.client.client_num, len(args.data.corruption), max(args.data.level) + 1), dtype=np.int64)
+    num_round = 0
+    for level in args.data.level:
+        for lp in range(args.other.loop):
+            for cidx in range(len(args.data.corruption)):
+                clients = np.asarray(
+                    client_sampling(range(args.client.client_num), args.client.sample_rate, random_state),
+                    dtype=np.int64
+                )
+                corruptions = corrupt_map[clients, cidx]
+                eps = global_eps[lp]
+                if eps == 0 or len(clients) == 0:
+                    continue
+                # The offsets of all rounds of this step at once: each round moves on by one batch.
+                start = consumed[clients, corruptions, level]
+                offsets = start[None, :] + ttt_batch * np.arange(eps)[:, None]
+                consumed[clients, corruptions, level] += ttt_batch * eps
+                block = np.empty((eps, len(clients), len(SCHEDULE_COLUMNS)), dtype=np.int64)
+                block[:, :, ROUND] = num_round + np.arange(eps)[:, None]
+                block[:, :, LEVEL] = level
+                block[:, :, LOOP] = lp
+                block[:, :, STEP] = cidx
+                block[:, :, EPS] = np.arange(eps)[:, None]
+                block[:, :, CLIENT] = clients[None, :]
+                block[:, :, CORRUPTION] = corruptions[None, :]
+                block[:, :, OFFSET] = offsets
+                blocks.append(block.reshape(-1, len(SCHEDULE_COLUMNS)))
+                num_round += eps
+    if len(blocks) == 0:
+        return np.zeros((0, len(SCHEDULE_COLUMNS)), dtype=np.int64)
+    return np.concatenate(blocks)
+
+
+def iter_rounds(schedule: np.ndarray) -> Iterator[np.ndarray]:
+    r"""
+    Overview:
+        Iterate over the rounds of a schedule. Each item is the rows of the participating clients of one round.
+    """
+    if len(schedule) == 0:
+        return iter([])
+    starts = np.flatnonzero(np.diff(schedule[:, ROUND])) + 1
+    return iter(np.split(schedule, starts))
+
+
+def save_schedule(schedule: np.ndarray, path: str) -> None:
+    r"""
+    Overview:
+        Save a schedule as ``.npy``, so that a run can be replayed exactly with ``load_schedule``.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.save(path, schedule)
+
+
+def load_schedule(path: str) -> np.ndarray:
+    r"""
+    Overview:
+        Load a schedule saved by ``save_schedule``.
+    """
+    schedule = np.load(path)
+    if schedule.ndim != 2 or schedule.shape[1] != len(SCHEDULE_COLUMNS):
+        raise ValueError(f'Unrecognized round schedule with shape: {schedule.shape}')
+    return schedule.astype(np.int64)
@@ -0,0 +1,218 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+from torchvision import transforms
+
+from .schedule import LEVEL, CLIENT, CORRUPTION, OFFSET, iter_rounds
+
+
+class StreamBatch(Dataset):
+    r"""
+    Overview:
+        One collated batch of test samples, e.g. the samples of one client in one TTA round.
+        It is still a ``Dataset``, so it can be used wherever the ``NaiveDataset`` of a round was used. Clients
+    iterate it through ``loader`` instead of a ``DataLoader``, which only slices the tensors.
+    """
+
+    def __init__(self, data: dict):
+        r"""
+        Overview:
+            Initialization for the batch.
+        Arguments:
+            data: dict with keys ``input`` and ``class_id``, whose values are tensors with the same first dimension.
+        """
+        self.data = data
+
+    def __len__(self) -> int:
+        return self.data['class_id'].shape[0]
+
+    def __getitem__(self, item: int) -> dict:
+        return {k: v[item] for k, v in self.data.items()}
+
+    def loader(self, batch_size: int) -> 'StreamBatchLoader':
+        r"""
+        Overview:
+            Get a loader over this batch, which yields the same batches as \
+        ``DataLoader(self, batch_size=batch_size, shuffle=False)``.
+        """
+        return StreamBatchLoader(self, batch_size)
+
+
+class StreamBatchLoader:
+    r"""
+    Overview:
+        Split a ``StreamBatch`` into mini-batches of ``batch_size`` by slicing.
+    """
+
+    def __init__(self, dataset: StreamBatch, batch_size: int):
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+    def __len__(self) -> int:
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.dataset), self.batch_size):
+            yield {k: v[start:start + self.batch_size] for k, v in self.dataset.data.items()}
+
+
+def _tensor_normalization(dataset: Dataset) -> Optional[Tuple]:
+    # If the samples of ``dataset`` are uint8 images in ``dataset.dataset.data`` and the transform is only
+    # ``ToTensor`` (and ``Normalize``), return ``(data, targets, mean, std)``. Otherwise return ``None``.
+    inner = getattr(dataset, 'dataset', None)
+    data = getattr(inner, 'data', None)
+    if not isinstance(data, np.ndarray) or data.dtype != np.uint8 or data.ndim != 4:
+        return None
+    if getattr(inner, 'target_transform', None) is not None:
+        return None
+    transform = getattr(inner, 'transform', None)
+    ops = transform.transforms if isinstance(transform, transforms.Compose) else [transform]
+    if len(ops) == 0 or not isinstance(ops[0], transforms.ToTensor):
+        return None
+    if len(ops) == 1:
+        return data, inner.targets, None, None
+    if len(ops) == 2 and isinstance(ops[1], transforms.Normalize) and not ops[1].inplace:
+        return data, inner.targets, ops[1].mean, ops[1].std
+    return None
+
+
+class DecodedSplit:
+    r"""
+    Overview:
+        The samples of one test split (e.g. one corruption and severity of CIFAR-10-C), gathered by index into \
+    collated batches.
+        If the split is stored as uint8 images and only ``ToTensor`` and ``Normalize`` are applied to it, the whole
+    split is converted once into one uint8 tensor with shape ``[N, C, H, W]``, and each batch is gathered by
+    ``index_select`` and normalized in one vectorized op. The result is the same as transforming the samples one by
+    one. Splits read from a tensor store (``TensorCorruptionSplit``) are gathered from the store without a copy.
+    Other datasets fall back to transforming the gathered samples one by one.
+    """
+
+    def __init__(self, dataset: Dataset):
+        r"""
+        Overview:
+            Initialization for the decoded split.
+        Arguments:
+            dataset: the dataset of the whole split.
+        """
+        self.dataset = dataset
+        self.data = None
+        # A ``TensorCorruptionSplit`` already keeps the split as one uint8 tensor, and gathers batches itself.
+        self.store = getattr(getattr(dataset, 'dataset', None), 'gather', None)
+        info = _tensor_normalization(dataset) if self.store is None else None
+        if info is not None:
+            data, targets, mean, std = info
+            # From ``[N, H, W, C]`` to ``[N, C, H, W]``, the same as ``ToTensor``. The array may be a read-only
+            # memory map, so it is copied into a tensor.
+            self.data = torch.tensor(np.asarray(data)).permute(0, 3, 1, 2).contiguous()
+            self.labels = torch.as_tensor(np.asarray(targets), dtype=torch.int64)
+            self.mean = None if mean is None else torch.as_tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+            self.std = None if std is None else torch.as_tensor(std, dtype=torch.float32).view(-1, 1, 1)
+
+    def gather(self, indexes: Sequence[int]) -> StreamBatch:
+        r"""
+        Overview:
+            Get the samples with ``indexes`` as one collated batch.
+        """
+        if self.store is not None:
+            return StreamBatch(self.store(indexes))
+        if self.data is None:
+            return StreamBatch(default_collate([self.dataset[i] for i in indexes]))
+        index = torch.as_tensor(np.asarray(indexes), dtype=torch.int64)
+        x = self.data.index_select(0, index).to(torch.float32).div(255)
+        if self.mean is not None:
+            x.sub_(self.mean).div_(self.std)
+        return StreamBatch({'input': x, 'class_id': self.labels.index_select(0, index)})
+
+
+def split_name(dataset: str, corruption: str, level: int) -> str:
+    r"""
+    Overview:
+        The name of the split ``(corruption, level)`` of a dataset, used as the key of its cached outputs.
+    """
+    return '%s-%s-%d' % (dataset, corruption, level)
+
+
+class RoundBatchLoader:
+    r"""
+    Overview:
+        Gather the test batches of all participating clients of each round of a compiled round schedule, see \
+    ``compile_round_schedule``.
+        The clients of a round that read the same split take their samples in one gather from the shared \
+    ``DecodedSplit`` (and one lookup of the ``AnchorOutputCache``), which is then split into one ``StreamBatch`` per \
+    client. The batches of the next round are gathered in a background thread while the current round runs. The \
+    samples of each client are the same as sliced from the ``indexes`` of its dataset in the original pipeline.
+    """
+
+    def __init__(self, corrupt_test_sets: List[Dict], args: dict, anchor_cache: Optional[object] = None):
+        r"""
+        Overview:
+            Initialization for the loader.
+        Arguments:
+            corrupt_test_sets: ``corrupt_test_sets[client_id][corruption][level]`` is the dataset of the client.
+            args: the arguments of the experiment.
+            anchor_cache: the ``AnchorOutputCache`` of the source model. If not ``None``, its outputs are attached \
+        to each batch.
+        """
+        self.corrupt_test_sets = corrupt_test_sets
+        self.corruptions = list(args.data.corruption)
+        self.batch_size = args.other.ttt_batch
+        self.anchor_cache = anchor_cache
+        self.name = args.data.dataset
+        # ``DecodedSplit`` of each whole dataset, shared by all clients.
+        self.splits = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='round_loader')
+
+    def _split(self, dataset: Dataset) -> DecodedSplit:
+        with self.lock:
+            if id(dataset) not in self.splits:
+                self.splits[id(dataset)] = DecodedSplit(dataset)
+            return self.splits[id(dataset)]
+
+    def gather(self, rows: np.ndarray) -> List[StreamBatch]:
+        r"""
+        Overview:
+            Get the batches of the participating clients of one round.
+        Arguments:
+            rows: the rows of the round in the schedule.
+        Returns:
+            batches: the batch of each row, in the order of ``rows``.
+        """
+        groups = {}
+        for pos, row in enumerate(rows):
+            corruption, level = self.corruptions[row[CORRUPTION]], int(row[LEVEL])
+            dataset = self.corrupt_test_sets[row[CLIENT]][corruption][level]
+            indexes = np.asarray(dataset.indexes[row[OFFSET]:row[OFFSET] + self.batch_size], dtype=np.int64)
+            groups.setdefault(id(dataset.tot_data), (dataset.tot_data, corruption, level, []))[3].append((pos, indexes))
+        batches = [None] * len(rows)
+        for tot_data, corruption, level, members in groups.values():
+            indexes = np.concatenate([idx for _, idx in members])
+            data = dict(self._split(tot_data).gather(indexes).data)
+            if self.anchor_cache is not None:
+                data['anchor_feature'], data['anchor_logit'] = self.anchor_cache.lookup(
+                    split_name(self.name, corruption, level), tot_data, indexes
+                )
+            sizes = [len(idx) for _, idx in members]
+            parts = {k: v.split(sizes) for k, v in data.items()}
+            for m, (pos, _) in enumerate(members):
+                batches[pos] = StreamBatch({k: v[m] for k, v in parts.items()})
+        return batches
+
+    def rounds(self, schedule: np.ndarray) -> Iterator[Tuple[np.ndarray, List[StreamBatch]]]:
+        r"""
+        Overview:
+            Iterate over the rounds of ``schedule``. Each item is the rows of a round and the batches of its \
+        clients. The batches of the next round are gathered in the background.
+        """
+        rounds = list(iter_rounds(schedule))
+        future = None
+        for k, rows in enumerate(rounds):
+            batches = future.result() if future is not None else self.gather(rows)
+            future = self.executor.submit(self.gather, rounds[k + 1]) if k + 1 < len(rounds) else None
+            yield rows, batches
@@ -0,0 +1,60 @@
+import torch
+
+
+class RingHistory:
+    r"""
+    Overview:
+        Fixed-capacity history of per-client vectors, e.g. the feature indicators of all clients in each round.
+        Each appended step is a tensor with shape ``[N, D]``. Only the last ``capacity`` steps are kept, in a buffer
+    allocated once with shape ``[N, 2 * capacity, D]``. Every step is written to two slots that are ``capacity`` apart,
+    so the last ``T`` steps always form one slice of the buffer, and ``last`` returns them without copying.
+    Appending is O(1) and the memory does not grow with the number of rounds.
+    """
+
+    def __init__(self, capacity: int):
+        r"""
+        Overview:
+            Initialization for the history. The buffer is allocated when the first step is appended.
+        Arguments:
+            capacity: the maximum number of steps to keep.
+        """
+        if capacity < 1:
+            raise ValueError(f'Capacity of the history should be positive, but got: {capacity}')
+        self.capacity = capacity
+        self.buffer = None
+        # Number of steps appended so far.
+        self.count = 0
+
+    def __len__(self) -> int:
+        r"""
+        Overview:
+            Number of steps currently kept, which is at most ``capacity``.
+        """
+        return min(self.count, self.capacity)
+
+    def append(self, step: torch.Tensor) -> None:
+        r"""
+        Overview:
+            Append the tensor of a new step with shape ``[N, D]``.
+        """
+        step = step.detach()
+        if self.buffer is None:
+            self.buffer = torch.empty(
+                step.shape[0], 2 * self.capacity, *step.shape[1:], dtype=step.dtype, device=step.device
+            )
+        pos = self.count % self.capacity
+        self.buffer[:, pos] = step
+        self.buffer[:, pos + self.capacity] = step
+        self.count += 1
+
+    def last(self, length: int = None) -> torch.Tensor:
+        r"""
+        Overview:
+            Get the last ``length`` steps in time order, as a view with shape ``[N, T, D]``, where \
+        ``T = min(length, len(self))``. The view is over-written by later calls of ``append``.
+        Arguments:
+            length: the number of steps. If set to ``None``, all kept steps are returned.
+        """
+        length = len(self) if length is None else min(length, len(self))
+        start = (self.count - length) % self.capacity
+        return self.buffer[:, start:start + length]
@@ -1,8 +1,17 @@
+import pickle
+import queue
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from typing import Tuple, List
+from typing import Dict, Tuple, List, Optional
+import torch
+import torch.nn as nn
 import torch.multiprocessing as mp
+from multiprocessing.reduction import ForkingPickler
 
 from fling.component.client import ClientTemplate
+from .anchor_cache_utils import get_anchor_model
+from .utils import materialize_metrics
 
 
 def _client_trainer(client: ClientTemplate, kwargs: dict) -> Tuple:
@@ -26,7 +35,52 @@ def _client_finetuner(client: ClientTemplate, kwargs: dict) -> Tuple:
     return res, client
 
 
-op2func = {'train': _client_trainer, 'test': _client_tester, 'finetune': _client_finetuner}
+def _client_source_tester(client: ClientTemplate, kwargs: dict) -> Tuple:
+    # This is the function that each TTA client will execute test_source function, i.e. test before adaptation.
+    # It will receive a task and its arguments, execute it, and return its result and the updated client.
+    res = client.test_source(**kwargs)
+    return res, client
+
+
+def _client_adapter(client: ClientTemplate, kwargs: dict) -> Tuple:
+    # This is the function that each TTA client will execute adapt function.
+    # It will receive a task and its arguments, execute it, and return its result and the updated client.
+    res = client.adapt(**kwargs)
+    return res, client
+
+
+def _client_inferencer(client: ClientTemplate, kwargs: dict) -> Tuple:
+    # This is the function that each TTA client will execute inference function, i.e. test after aggregation.
+    # It will receive a task and its arguments, execute it, and return its result and the updated client.
+    res = client.inference(**kwargs)
+    return res, client
+
+
+def _client_logits_getter(client: ClientTemplate, kwargs: dict) -> Tuple:
+    # This is the function that each TTA client will execute get_logits function.
+    # It will receive a task and its arguments, execute it, and return its result and the updated client.
+    res = client.get_logits(**kwargs)
+    return res, client
+
+
+op2func = {
+    'train': _client_trainer,
+    'test': _client_tester,
+    'finetune': _client_finetuner,
+    'test_source': _client_source_tester,
+    'adapt': _client_adapter,
+    'inference': _client_inferencer,
+    'get_logits': _client_logits_getter,
+}
+
+
+def _task_kwargs(clients: List, kwargs: dict, client_kwargs: Optional[List[dict]]) -> List[dict]:
+    # Merge the arguments shared by all clients with the arguments of each client.
+    if client_kwargs is None:
+        return [kwargs for _ in clients]
+    if len(client_kwargs) != len(clients):
+        raise ValueError(f'Got {len(client_kwargs)} client_kwargs for {len(clients)} clients')
+    return [{**kwargs, **ckwargs} for ckwargs in client_kwargs]
 
 
 def copy_attributes(src: object, dst: object) -> None:
@@ -47,19 +101,23 @@ class SerialLauncher:
     Overview:
         Use one process to serially execute operations all clients.
     """
+    # Operations are executed on the clients of the main process, so all their attributes are up to date.
+    shares_client_state = True
 
-    def launch(self, clients: ClientTemplate, task_name: str, **kwargs) -> List:
+    def launch(self, clients: ClientTemplate, task_name: str, client_kwargs: List[dict] = None, **kwargs) -> List:
         r"""
         Overview:
             Launch the tasks in each client.
         Arguments:
             clients: Clients to be launched.
             task_name: Task name of the operation in each client.
+            client_kwargs: Arguments of each client, e.g. the test data of each client in TTA. They are merged with \
+        ``kwargs``, which are shared by all clients.
             kwargs: Arguments required by corresponding operations (e.g. train, test, finetune)
         Returns:
             loggers: A list, each element corresponds to the logger generated by one client.
         """
-        tasks = [(client, kwargs) for client in clients]
+        tasks = list(zip(clients, _task_kwargs(clients, kwargs, client_kwargs)))
         results = []
 
         # Get the operation function according to the task name.
@@ -76,60 +134,384 @@ class SerialLauncher:
 
         return loggers
 
+    def release(self, clients: List) -> None:
+        r"""
+        Overview:
+            Forget the clients, e.g. when the group is rebuilt. Nothing is kept for them by this launcher.
+        """
+        pass
 
-class MultiProcessLauncher:
+    def close(self) -> None:
+        r"""
+        Overview:
+            Release the resources of the launcher. Nothing is kept by this launcher.
+        """
+        pass
+
+
+class ThreadLauncher:
     r"""
     Overview:
-        Accelerate the process of operations on each client.
-        Use one process to monitor operations on individual clients.
+        Execute operations of several clients at the same time with a pool of threads in the main process.
+        The CPU threads used by torch are partitioned among the pool threads: each pool thread runs its operations with
+    ``intra_op_threads`` threads, so that ``num_threads`` clients run in parallel without over-subscribing the CPU.
+    As the clients of the main process are used, their attributes are always up to date.
     """
+    shares_client_state = True
 
-    def __init__(self, num_proc: int):
+    def __init__(self, num_threads: int, intra_op_threads: int = None):
         r"""
         Overview:
             Initialization for launcher.
         Arguments:
-            num_proc: Number of processes used.
+            num_threads: Number of clients executed at the same time.
+            intra_op_threads: Number of torch threads used by each of them. If set to ``None``, the torch threads of \
+        this process are divided equally.
         """
-        self.num_proc = num_proc
+        self.num_threads = num_threads
+        self.intra_op_threads = intra_op_threads if intra_op_threads is not None else \
+            max(1, torch.get_num_threads() // num_threads)
+        self.pool = None
 
-    def launch(self, clients: List, task_name: str, **kwargs) -> List:
+    def _init_thread(self) -> None:
+        torch.set_num_threads(self.intra_op_threads)
+
+    def launch(self, clients: List, task_name: str, client_kwargs: List[dict] = None, **kwargs) -> List:
         r"""
         Overview:
             Launch the tasks in each client.
         Arguments:
             clients: Clients to be launched.
             task_name: Task name of the operation in each client.
+            client_kwargs: Arguments of each client. They are merged with ``kwargs``, which are shared by all clients.
             kwargs: Arguments required by corresponding operations (e.g. train, test, finetune)
         Returns:
             loggers: A list, each element corresponds to the logger generated by one client.
         """
-        tasks = [(client, kwargs) for client in clients]
-
-        # Get the operation function according to the task name.
         try:
             op_func = op2func[task_name]
         except KeyError:
             raise ValueError(f'Unrecognized task name: {task_name}')
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(
+                max_workers=self.num_threads, thread_name_prefix='launcher', initializer=self._init_thread
+            )
+        num_threads = torch.get_num_threads()
+        futures = [
+            self.pool.submit(op_func, client, task_kwargs)
+            for client, task_kwargs in zip(clients, _task_kwargs(clients, kwargs, client_kwargs))
+        ]
+        loggers = [future.result()[0] for future in futures]
+        # Setting the threads in the pool threads may change the setting of the main thread.
+        torch.set_num_threads(num_threads)
+        return loggers
 
-        with mp.Pool(self.num_proc) as pool:
-            # Use starmap to apply the worker function to every task
-            # Each task is a tuple that contains the task object and the arguments
-            results = pool.starmap(op_func, tasks)
+    def release(self, clients: List) -> None:
+        r"""
+        Overview:
+            Forget the clients, e.g. when the group is rebuilt. Nothing is kept for them by this launcher.
+        """
+        pass
+
+    def close(self) -> None:
+        r"""
+        Overview:
+            Stop all threads.
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+# Types of client attributes that are synchronized between the main process and the workers in every task.
+_SMALL_TYPES = (bool, int, float, str, type(None))
+# Attributes that are not sent to the workers, because they refer to objects shared by the whole group. The model is
+# not sent either, because its tensors are in shared memory.
+_LOCAL_ATTRIBUTES = ('arena', 'model')
+# Seconds between two checks that the workers are alive, while waiting for their results.
+_POLL_INTERVAL = 1.0
+
+
+def _is_small(value: object) -> bool:
+    # Scalars or lists of scalars, such as ``sample_num`` and ``fed_keys``.
+    if isinstance(value, (list, tuple)):
+        return all(isinstance(v, _SMALL_TYPES) for v in value)
+    return isinstance(value, _SMALL_TYPES)
 
-        # Retrieve the loggers and updated clients respectively.
-        loggers = [results[i][0] for i in range(len(results))]
-        new_clients = [results[i][1] for i in range(len(results))]
 
-        # Copy the attributes of new clients to original clients.
-        for i in range(len(clients)):
-            new_client = new_clients[i]
-            client = clients[i]
-            assert new_client.client_id == client.client_id
-            copy_attributes(src=new_client, dst=client)
+def _changed_attributes(client: ClientTemplate, snapshot: dict) -> dict:
+    # Attributes of ``client`` that are added or rebound since ``snapshot``, the attributes of the last
+    # synchronization, together with all small attributes, which may be changed in place (e.g. lists of scalars).
+    # ``snapshot`` is updated to the current attributes. It holds the objects themselves, so that their ids are not
+    # reused. Client classes can list the attributes that are only used by the process running their tasks in
+    # ``launcher_local_attributes`` (e.g. large loaders), and these are never synchronized.
+    local = _LOCAL_ATTRIBUTES + tuple(getattr(client, 'launcher_local_attributes', ()))
+    changed = {
+        k: v
+        for k, v in client.__dict__.items()
+        if k not in local and (k not in snapshot or snapshot[k] is not v or _is_small(v))
+    }
+    snapshot.clear()
+    snapshot.update(client.__dict__)
+    return changed
 
+
+def share_model(model: nn.Module) -> Dict[str, torch.Tensor]:
+    r"""
+    Overview:
+        Move the parameters and buffers of ``model`` into shared memory.
+        For each dtype, one flat tensor is allocated in shared memory and every tensor of the model becomes a view of
+    it, so that each model only needs one shared memory segment per dtype.
+    Arguments:
+        model: the model to be shared.
+    Returns:
+        shared: the shared tensors of the model, keyed by the names in ``model.state_dict()``.
+    """
+    state_dict = model.state_dict(keep_vars=True)
+    # Tensors used by several keys (e.g. tied weights) get the same view.
+    unique = {}
+    for k, v in state_dict.items():
+        unique.setdefault(id(v), (k, v))
+    numels = {}
+    for _, v in unique.values():
+        numels[v.dtype] = numels.get(v.dtype, 0) + v.numel()
+    flats = {dtype: torch.empty(numel, dtype=dtype).share_memory_() for dtype, numel in numels.items()}
+    offsets = {dtype: 0 for dtype in numels}
+    views = {}
+    for key, (_, v) in unique.items():
+        start = offsets[v.dtype]
+        views[key] = flats[v.dtype][start:start + v.numel()].view(v.shape)
+        offsets[v.dtype] = start + v.numel()
+    shared = {k: views[id(v)] for k, v in state_dict.items()}
+    bind_shared(model, shared)
+    return shared
+
+
+def bind_shared(model: nn.Module, shared: Dict[str, torch.Tensor]) -> None:
+    r"""
+    Overview:
+        Make every parameter and buffer of ``model`` a view of the shared tensors again.
+        A model whose tensors have been replaced (e.g. by ``model.to(device)`` or by assigning a new model) no longer
+    shares memory with the other processes. The current values of such tensors are copied into ``shared``, and the
+    model is made to use ``shared`` again.
+    Arguments:
+        model: the model to be bound.
+        shared: the shared tensors returned by ``share_model``.
+    """
+    with torch.no_grad():
+        for k, tensor in model.state_dict(keep_vars=True).items():
+            view = shared.get(k)
+            if view is None or tensor.shape != view.shape or tensor.dtype != view.dtype:
+                continue
+            if tensor.device == view.device and tensor.data_ptr() == view.data_ptr():
+                continue
+            view.copy_(tensor)
+            if isinstance(tensor, nn.Parameter):
+                tensor.data = view
+            else:
+                module_name, _, buffer_name = k.rpartition('.')
+                model.get_submodule(module_name)._buffers[buffer_name] = view
+
+
+def _worker_loop(task_queue: mp.Queue, result_queue: mp.Queue) -> None:
+    # The loop of a worker of ``MultiProcessLauncher``. The worker keeps its own copies of the clients in its shard,
+    # whose model tensors are in shared memory with the main process. Each message is one of:
+    # ``('register', key, client_type, attributes)``: add a client to this worker.
+    # ``('unregister', key)``: remove a client from this worker.
+    # ``('task', task_id, key, task_name, attributes, kwargs)``: run a task on a client, after updating the attributes
+    # changed in the main process.
+    # ``None``: stop the worker.
+    # The result of a task is sent back pickled, with the attributes added or rebound by the task, so that a result
+    # that can not be pickled is reported as an error of the task.
+    clients, shared, snapshots = {}, {}, {}
+    while True:
+        message = task_queue.get()
+        if message is None:
+            break
+        if message[0] == 'register':
+            _, key, client_type, attributes = message
+            client = client_type.__new__(client_type)
+            client.__dict__.update(attributes)
+            client.arena = None
+            if getattr(client, 'model_anchor', None) is not None:
+                # Each message carries its own copy of the shared anchor model, so the clients of this worker are
+                # bound to one copy again.
+                client.model_anchor = get_anchor_model(client.model_anchor)
+            clients[key] = client
+            shared[key] = {
+                k: v.data if isinstance(v, nn.Parameter) else v
+                for k, v in client.model.state_dict(keep_vars=True).items()
+            }
+            snapshots[key] = dict(client.__dict__)
+            continue
+        if message[0] == 'unregister':
+            _, key = message
+            clients.pop(key, None), shared.pop(key, None), snapshots.pop(key, None)
+            continue
+        _, task_id, key, task_name, attributes, kwargs = message
+        client = clients[key]
+        try:
+            client.__dict__.update(attributes)
+            snapshots[key].update(attributes)
+            res, _ = op2func[task_name](client, kwargs)
+            bind_shared(client.model, shared[key])
+            # The metrics of the client are sent as Python floats instead of tensors.
+            payload = ForkingPickler.dumps((materialize_metrics(res), _changed_attributes(client, snapshots[key])))
+            result_queue.put((task_id, bytes(payload), None))
+        except Exception:
+            result_queue.put((task_id, None, traceback.format_exc()))
+
+
+class MultiProcessLauncher:
+    r"""
+    Overview:
+        Accelerate the process of operations on each client.
+        A pool of long-lived worker processes is started at the first call of ``launch``. Each client is assigned to a
+    fixed worker when it is first launched, and is sent to this worker only once. The parameters and buffers of the
+    client model are moved into shared memory, so they are read and written by the main process and the worker without
+    being copied. In each call of ``launch``, only the task name, its arguments, the returned results and the changed
+    attributes of the clients cross process boundaries: the scalar attributes (e.g. ``sample_num``), and the attributes
+    added or rebound since the last task, on either side (e.g. the masks computed by ``FedCACClient.train`` and read
+    by its group). Attributes changed in place, other than lists of scalars, are not detected.
+        Operations of the same client always run in the same worker. Call ``release`` for clients which are replaced,
+    e.g. when the group is rebuilt, and ``close`` at the end of the experiment.
+    """
+    shares_client_state = False
+
+    def __init__(self, num_proc: int, start_method: str = None):
+        r"""
+        Overview:
+            Initialization for launcher.
+        Arguments:
+            num_proc: Number of processes used.
+            start_method: The start method of the workers, e.g. ``fork`` and ``spawn``. If set to ``None``, the \
+        default method of the platform is used. Use ``spawn`` if CUDA is initialized in the main process before the \
+        first launch.
+        """
+        self.num_proc = num_proc
+        self.start_method = start_method
+        self.workers = None
+        self.task_queues = None
+        self.result_queue = None
+        # For each registered client: id(client) -> (client, worker index, shared tensors, attribute snapshot).
+        # The client is referenced here so that its id is not reused by another object until it is released.
+        self.registry = {}
+        self._next_worker = 0
+        self._task_id = 0
+
+    def _start(self) -> None:
+        ctx = mp.get_context(self.start_method)
+        self.task_queues = [ctx.Queue() for _ in range(self.num_proc)]
+        self.result_queue = ctx.Queue()
+        self.workers = [
+            ctx.Process(target=_worker_loop, args=(queue, self.result_queue), daemon=True)
+            for queue in self.task_queues
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def _register(self, client: ClientTemplate) -> int:
+        # Assign ``client`` to a worker and send it there, with its model in shared memory.
+        key = id(client)
+        if key not in self.registry:
+            worker = self._next_worker
+            self._next_worker = (self._next_worker + 1) % self.num_proc
+            shared = share_model(client.model)
+            attributes = {k: v for k, v in client.__dict__.items() if k != 'arena'}
+            self.task_queues[worker].put(('register', key, type(client), attributes))
+            self.registry[key] = (client, worker, shared, dict(client.__dict__))
+        return key
+
+    def release(self, clients: List) -> None:
+        r"""
+        Overview:
+            Remove the clients from the launcher and from their workers, e.g. when the group is rebuilt. Their shared
+        model tensors are then freed with the clients.
+        """
+        for client in clients:
+            entry = self.registry.pop(id(client), None)
+            if entry is not None and entry[0] is client and self.workers is not None:
+                self.task_queues[entry[1]].put(('unregister', id(client)))
+
+    def _get_result(self) -> Tuple:
+        # Wait for the next result, and fail if a worker has died instead of waiting forever.
+        while True:
+            try:
+                return self.result_queue.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                dead = [i for i, worker in enumerate(self.workers) if not worker.is_alive()]
+                if len(dead) > 0:
+                    codes = [self.workers[i].exitcode for i in dead]
+                    self.close(force=True)
+                    raise RuntimeError(f'Launcher workers {dead} died with exit codes {codes}')
+
+    def launch(self, clients: List, task_name: str, client_kwargs: List[dict] = None, **kwargs) -> List:
+        r"""
+        Overview:
+            Launch the tasks in each client.
+        Arguments:
+            clients: Clients to be launched.
+            task_name: Task name of the operation in each client.
+            client_kwargs: Arguments of each client. They are merged with ``kwargs``, which are shared by all clients.
+            kwargs: Arguments required by corresponding operations (e.g. train, test, finetune)
+        Returns:
+            loggers: A list, each element corresponds to the logger generated by one client.
+        """
+        if task_name not in op2func:
+            raise ValueError(f'Unrecognized task name: {task_name}')
+        if self.workers is None:
+            self._start()
+
+        task_ids = []
+        for client, task_kwargs in zip(clients, _task_kwargs(clients, kwargs, client_kwargs)):
+            key = self._register(client)
+            _, worker, shared, snapshot = self.registry[key]
+            # The model may have been moved or replaced in the main process since the last task.
+            bind_shared(client.model, shared)
+            self._task_id += 1
+            task_ids.append(self._task_id)
+            self.task_queues[worker].put(
+                ('task', self._task_id, key, task_name, _changed_attributes(client, snapshot), task_kwargs)
+            )
+
+        results, errors = {}, []
+        for _ in range(len(task_ids)):
+            task_id, payload, error = self._get_result()
+            if error is not None:
+                errors.append(error)
+            results[task_id] = payload
+        if len(errors) > 0:
+            raise RuntimeError('Task failed in a launcher worker:\n' + errors[0])
+
+        # Retrieve the loggers, and copy the attributes updated by the workers to the clients.
+        loggers = []
+        for client, task_id in zip(clients, task_ids):
+            res, attributes = pickle.loads(results[task_id])
+            client.__dict__.update(attributes)
+            # These attributes are now the same on both sides, so they are not sent back to the worker.
+            self.registry[id(client)][3].update(attributes)
+            loggers.append(res)
         return loggers
 
+    def close(self, force: bool = False) -> None:
+        r"""
+        Overview:
+            Stop all worker processes.
+        Arguments:
+            force: whether to terminate the workers instead of waiting for their pending tasks.
+        """
+        if self.workers is None:
+            return
+        for worker, task_queue in zip(self.workers, self.task_queues):
+            if force:
+                worker.terminate()
+            else:
+                task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = None
+        self.registry = {}
+
 
 def get_launcher(args: dict) -> object:
     r"""
@@ -149,5 +531,7 @@ def get_launcher(args: dict) -> object:
         return SerialLauncher()
     elif launcher_name == 'multiprocessing':
         return MultiProcessLauncher(**launcher_args)
+    elif launcher_name == 'thread':
+        return ThreadLauncher(**launcher_args)
     else:
         raise ValueError(f'Unrecognized launcher type: {launcher_name}')
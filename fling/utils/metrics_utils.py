@@ -0,0 +1,290 @@
+import json
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+import torch
+
+
+class MetricsBackend:
+    r"""
+    Overview:
+        A destination of the records of a ``MetricsSink``. Each record is a dict with a ``type`` in:
+            ``text``: a message, with ``time`` and ``message``.
+            ``scalars``: a dict ``values`` of scalars, with ``time``, ``prefix`` and ``step``.
+        Backends are only called from the writer thread of the sink, with a batch of records at a time.
+    """
+
+    def write(self, records: List[Dict]) -> None:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+class TextBackend(MetricsBackend):
+    r"""
+    Overview:
+        Append the messages to a text file, in the format of ``Logger.logging``. The file is kept open.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, mode='a')
+
+    def write(self, records: List[Dict]) -> None:
+        lines = [
+            '[' + time.asctime(time.localtime(r['time'])) + ']    ' + r['message'] + '\n' for r in records
+            if r['type'] == 'text'
+        ]
+        self.file.writelines(lines)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class TensorBoardBackend(MetricsBackend):
+    r"""
+    Overview:
+        Add the scalars to a tensorboard ``SummaryWriter``, e.g. the ``Logger`` of the experiment.
+    """
+
+    def __init__(self, writer: object):
+        self.writer = writer
+
+    def write(self, records: List[Dict]) -> None:
+        for r in records:
+            if r['type'] == 'scalars':
+                for k, v in r['values'].items():
+                    self.writer.add_scalar(f"{r['prefix']}/{k}" if r['prefix'] else k, v, r['step'])
+
+    def flush(self) -> None:
+        self.writer.flush()
+
+
+class JSONLBackend(MetricsBackend):
+    r"""
+    Overview:
+        Append all records to a local JSON lines file, one record per line.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, mode='a')
+
+    def write(self, records: List[Dict]) -> None:
+        self.file.writelines(json.dumps(r) + '\n' for r in records)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetBackend(MetricsBackend):
+    r"""
+    Overview:
+        Save the scalars to a local parquet file, one row for each scalar. Parquet files can not be appended, so the \
+    rows are kept in memory and the file is written again on each flush. Requires ``pyarrow``.
+    """
+
+    def __init__(self, path: str):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError('The parquet metrics backend requires pyarrow: pip install pyarrow')
+        self.path = path
+        self.rows = []
+        self.dirty = False
+
+    def write(self, records: List[Dict]) -> None:
+        for r in records:
+            if r['type'] == 'scalars':
+                self.rows.extend(
+                    {
+                        'time': r['time'],
+                        'step': r['step'],
+                        'key': f"{r['prefix']}/{k}" if r['prefix'] else k,
+                        'value': v
+                    } for k, v in r['values'].items()
+                )
+                self.dirty = True
+
+    def flush(self) -> None:
+        if self.dirty:
+            import pandas as pd
+            tmp = self.path + '.tmp'
+            pd.DataFrame(self.rows, columns=['time', 'step', 'key', 'value']).to_parquet(tmp, index=False)
+            os.replace(tmp, self.path)
+            self.dirty = False
+
+
+class WandbBackend(MetricsBackend):
+    r"""
+    Overview:
+        Log the scalars to wandb. The credentials are read by wandb itself, e.g. from ``WANDB_API_KEY`` or a \
+    previous ``wandb login``, and ``WANDB_MODE=offline`` keeps the run local. The scalars of a batch with the same \
+    step are sent in one ``wandb.log`` call.
+    """
+
+    def __init__(self, project: str, name: str, dir: str = 'output'):
+        import wandb
+        self.wandb = wandb
+        self.run = wandb.init(project=project, dir=dir, name=name)
+
+    def write(self, records: List[Dict]) -> None:
+        merged, step = {}, None
+        for r in records:
+            if r['type'] != 'scalars':
+                continue
+            if r['step'] != step and len(merged) > 0:
+                self.run.log(merged, step=step)
+                merged = {}
+            step = r['step']
+            merged.update({f"{r['prefix']}/{k}" if r['prefix'] else k: v for k, v in r['values'].items()})
+        if len(merged) > 0:
+            self.run.log(merged, step=step)
+
+    def close(self) -> None:
+        self.run.finish()
+
+
+class MetricsSink:
+    r"""
+    Overview:
+        Asynchronous sink of the messages and metrics of an experiment.
+        ``log_text`` and ``log_scalars`` only put a record into a queue. A background thread takes all pending \
+    records at once and writes them to every backend, so file and network I/O are not on the critical path of the \
+    rounds. ``flush`` asks the backends to flush their outputs, e.g. at the end of each round, without waiting.
+    """
+
+    def __init__(self, backends: List[MetricsBackend]):
+        r"""
+        Overview:
+            Initialization for the sink, which starts the writer thread.
+        Arguments:
+            backends: the backends to which all records are written.
+        """
+        self.backends = backends
+        # Whether the messages are written to the text file by one of the backends, see ``Logger.logging``.
+        self.writes_text = any(isinstance(backend, TextBackend) for backend in backends)
+        self.queue = queue.Queue()
+        self.closed = False
+        # The exception raised in the writer thread, which is raised again in the main thread by the next call.
+        self.error = None
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def _loop(self) -> None:
+        # Take all pending records, and write them to the backends in one batch.
+        # A ``'flush'`` item flushes the backends, and ``None`` stops the thread. The thread also stops when a backend
+        # fails, and the exception is kept in ``error``.
+        stop = False
+        while not stop:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [item for item in items if isinstance(item, dict)]
+            stop = any(item is None for item in items)
+            try:
+                for backend in self.backends:
+                    if len(records) > 0:
+                        backend.write(records)
+                    if stop or 'flush' in items:
+                        backend.flush()
+            except Exception as e:
+                self.error = e
+                stop = True
+
+    def _check_error(self) -> None:
+        # Raise the exception of the writer thread in the caller.
+        if self.error is not None:
+            raise RuntimeError('The writer thread of the metrics sink failed.') from self.error
+
+    def log_text(self, message: str) -> None:
+        r"""
+        Overview:
+            Log a message, with the current time.
+        """
+        self._check_error()
+        self.queue.put({'type': 'text', 'time': time.time(), 'message': message})
+
+    def log_scalars(self, values: Dict[str, object], step: Optional[int] = None, prefix: str = '') -> None:
+        r"""
+        Overview:
+            Log a dict of scalars. 0-dim tensors are converted to Python numbers here.
+        Arguments:
+            values: the scalars, e.g. ``{'test_acc': 0.9}``.
+            step: the step of the scalars, e.g. the round.
+            prefix: the prefix of the names of the scalars, e.g. ``'adapt'``.
+        """
+        self._check_error()
+        values = {k: v.item() if isinstance(v, torch.Tensor) else v for k, v in values.items()}
+        self.queue.put({'type': 'scalars', 'time': time.time(), 'prefix': prefix, 'step': step, 'values': values})
+
+    def flush(self) -> None:
+        r"""
+        Overview:
+            Ask the writer thread to flush the backends after the pending records. It does not wait for the writes.
+        """
+        self._check_error()
+        self.queue.put('flush')
+
+    def close(self) -> None:
+        r"""
+        Overview:
+            Write all pending records, close the backends and stop the writer thread. The exception of the writer \
+        thread, if any, is raised after the backends are closed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        for backend in self.backends:
+            backend.close()
+        self._check_error()
+
+
+def get_metrics_sink(args: dict, writer: object = None, wandb_project: str = 'fling') -> MetricsSink:
+    r"""
+    Overview:
+        Build the metrics sink of an experiment from ``args.other.metrics_backends``, a list of:
+            ``text``: ``txt_logger_output.txt`` in the logging path.
+            ``tensorboard``: the scalars are added to ``writer``, e.g. the ``Logger`` of the experiment.
+            ``jsonl``: ``metrics.jsonl`` in the logging path.
+            ``parquet``: ``metrics.parquet`` in the logging path, which requires ``pyarrow``.
+            ``wandb``: a wandb run named by the logging path, see ``WandbBackend``.
+    Arguments:
+        args: the input configurations.
+        writer: the tensorboard writer, required by ``tensorboard``.
+        wandb_project: the project of the wandb run.
+    Returns:
+        sink: the metrics sink.
+    """
+    path = args.other.logging_path
+    backends = []
+    for name in args.other.metrics_backends:
+        if name == 'text':
+            backends.append(TextBackend(os.path.join(path, 'txt_logger_output.txt')))
+        elif name == 'tensorboard':
+            backends.append(TensorBoardBackend(writer))
+        elif name == 'jsonl':
+            backends.append(JSONLBackend(os.path.join(path, 'metrics.jsonl')))
+        elif name == 'parquet':
+            backends.append(ParquetBackend(os.path.join(path, 'metrics.parquet')))
+        elif name == 'wandb':
+            backends.append(WandbBackend(project=wandb_project, name=path.split('/')[-1]))
+        else:
+            raise ValueError(f'Unrecognized metrics backend: {name}')
+    return MetricsSink(backends)
@@ -0,0 +1,86 @@
+from typing import Union
+
+import numpy as np
+import torch
+
+
+def project_simplex(v: torch.Tensor) -> torch.Tensor:
+    r"""
+    Overview:
+        Euclidean projection of each row of ``v`` onto the probability simplex ``{x | x >= 0, sum(x) = 1}``.
+        All rows are projected together by the sort based algorithm, which is exact.
+    Arguments:
+        v: tensor with shape ``[N, n]``.
+    Returns:
+        x: the projected tensor with shape ``[N, n]``.
+    """
+    n = v.shape[-1]
+    u, _ = torch.sort(v, dim=-1, descending=True)
+    css = torch.cumsum(u, dim=-1) - 1
+    ind = torch.arange(1, n + 1, dtype=v.dtype, device=v.device)
+    # The number of positive entries in the projection of each row.
+    rho = torch.sum((u - css / ind) > 0, dim=-1, keepdim=True)
+    theta = torch.gather(css, -1, rho - 1) / rho.to(v.dtype)
+    return torch.clamp(v - theta, min=0)
+
+
+class SimplexQPSolver:
+    r"""
+    Overview:
+        Solve the quadratic programs ``min_x x^T P x + q^T x, s.t. x >= 0, sum(x) = 1`` for many vectors ``q`` with \
+    the same ``P``, e.g. the collaboration weights of all clients in pFedGraph.
+        If ``P = lambda * I``, the solution is the projection of ``-q / (2 * lambda)`` onto the simplex, and all rows \
+    are solved exactly in one vectorized call. For a general ``P``, one parametrized ``cvxpy`` problem is built and \
+    solved for every row, warm-started from the solution of the last call.
+    """
+
+    def __init__(self, P: Union[np.ndarray, torch.Tensor]):
+        r"""
+        Overview:
+            Initialization for the solver.
+        Arguments:
+            P: the positive semi-definite matrix with shape ``[n, n]``.
+        """
+        P = torch.as_tensor(np.asarray(P), dtype=torch.float64)
+        self.n = P.shape[0]
+        self.P = P
+        # Use the exact solution if ``P`` is a positive multiple of the identity matrix.
+        self.lamba = P[0, 0].item()
+        self.is_scaled_identity = self.lamba > 0 and torch.equal(P, self.lamba * torch.eye(self.n, dtype=P.dtype))
+        self.problem = None
+        self.last_solution = None
+
+    def _build_problem(self) -> None:
+        # Build the problem once, with ``q`` as a parameter, so that it is not constructed again for each row.
+        import cvxpy as cp
+        self.x = cp.Variable(self.n)
+        self.q = cp.Parameter(self.n)
+        P = cp.atoms.affine.wraps.psd_wrap(self.P.numpy())
+        self.problem = cp.Problem(
+            cp.Minimize(cp.quad_form(self.x, P) + self.q.T @ self.x), [self.x >= 0, cp.sum(self.x) == 1]
+        )
+
+    def solve(self, q: Union[np.ndarray, torch.Tensor]) -> torch.Tensor:
+        r"""
+        Overview:
+            Solve the problem for each row of ``q``.
+        Arguments:
+            q: the linear terms with shape ``[N, n]``.
+        Returns:
+            x: the solutions with shape ``[N, n]``.
+        """
+        q = torch.as_tensor(np.asarray(q), dtype=torch.float64)
+        if self.is_scaled_identity:
+            x = project_simplex(-q / (2 * self.lamba))
+        else:
+            if self.problem is None:
+                self._build_problem()
+            x = torch.zeros_like(q)
+            for i in range(q.shape[0]):
+                if self.last_solution is not None and self.last_solution.shape == q.shape:
+                    self.x.value = self.last_solution[i].numpy()
+                self.q.value = q[i].numpy()
+                self.problem.solve(warm_start=True)
+                x[i] = torch.as_tensor(self.x.value)
+        self.last_solution = x
+        return x
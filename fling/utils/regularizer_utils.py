@@ -0,0 +1,118 @@
+from typing import List, Tuple, Union
+
+import torch
+
+
+def _sum_norms(norms: Tuple[torch.Tensor], power: int = 1) -> torch.Tensor:
+    # Sum of the ``power``-th powers of the per-tensor norms returned by ``torch._foreach_norm``.
+    return torch.stack(norms).pow(power).sum()
+
+
+def regularizer_loss(kind: str, coef: float, params: List[torch.Tensor],
+                     params_past: List[torch.Tensor]) -> Tuple[Union[torch.Tensor, float], Union[torch.Tensor, float]]:
+    r"""
+    Overview:
+        The differentiable form of the regularizers of ``ParamRegularizer``, for callers that need autograd, e.g. \
+    ``BatchedAdapter`` under ``torch.func.vmap``.
+    Arguments:
+        kind: the kind of the regularizer, see ``ParamRegularizer``.
+        coef: the coefficient of the regularizer.
+        params: the current parameters.
+        params_past: the parameters before adaptation.
+    Returns:
+        reg: the regularization added to the loss.
+        reg_grad: the regularization that is only back-propagated.
+    """
+    if kind == 'proximal':
+        return coef * sum(torch.norm((p - q) ** 2) for p, q in zip(params, params_past)), 0
+    elif kind == 'l2_squared':
+        return (coef / 2) * sum(torch.norm(p - q) ** 2 for p, q in zip(params, params_past)), 0
+    elif kind == 'cosine':
+        dot = sum((p * q).sum() for p, q in zip(params, params_past))
+        norm = torch.sqrt(sum((p * p).sum() for p in params))
+        norm_past = torch.sqrt(sum((q * q).sum() for q in params_past))
+        return 0, coef * dot / torch.clamp(norm * norm_past, min=1e-8)
+    raise ValueError(f'Unrecognized regularizer: {kind}')
+
+
+class ParamRegularizer:
+    r"""
+    Overview:
+        Regularizer of the adaptation loss by the distance between the parameters of a model and their values before \
+    adaptation, i.e. ``params_past``. One of:
+            ``proximal``: ``coef * sum_t ||(p_t - q_t) ** 2||`` over all parameter tensors ``t``, used by FedAMP.
+            ``l2_squared``: ``(coef / 2) * ||p - q|| ** 2``, used by FedProx.
+            ``cosine``: ``coef * cos(p, q)`` of the flattened models, used by FedGraph. As in the original \
+    implementation, it is only back-propagated and not added to the reported loss.
+        The value and the gradient are computed in closed form, with ``torch._foreach_*`` ops over all tensors at \
+    once, and the gradient is added to ``p.grad`` of the trainable parameters. So no flat copy of the model and no \
+    extra autograd graph are built in each step.
+    """
+
+    def __init__(self, kind: str, coef: float, params: List[torch.Tensor], params_past: List[torch.Tensor]):
+        r"""
+        Overview:
+            Initialization for the regularizer.
+        Arguments:
+            kind: one of ``proximal``, ``l2_squared`` and ``cosine``.
+            coef: the coefficient of the regularizer.
+            params: the parameters of the model, in the same order as ``params_past``.
+            params_past: the parameters before adaptation, e.g. the views returned by \
+        ``ClientTemplate.snapshot_past``.
+        """
+        if kind not in ['proximal', 'l2_squared', 'cosine']:
+            raise ValueError(f'Unrecognized regularizer: {kind}')
+        self.kind = kind
+        self.coef = coef
+        self.params = list(params)
+        self.params_past = list(params_past)
+        # The squared norm of the flattened past model, which does not change during adaptation.
+        self.sq_norm_past = _sum_norms(torch._foreach_norm(self.params_past), 2) if kind == 'cosine' else None
+
+    def _add_grad(self, grads: List[torch.Tensor]) -> None:
+        # Add ``grads`` to the gradients of the trainable parameters.
+        pairs = [(p, g) for p, g in zip(self.params, grads) if p.requires_grad]
+        accumulate = [(p.grad, g) for p, g in pairs if p.grad is not None]
+        if len(accumulate) > 0:
+            torch._foreach_add_([a for a, _ in accumulate], [g for _, g in accumulate])
+        for p, g in pairs:
+            if p.grad is None:
+                p.grad = g
+
+    def apply(self) -> torch.Tensor:
+        r"""
+        Overview:
+            Compute the regularizer for the current parameters, and add its gradient to the parameters. Call it \
+        after the backward of the loss and before the step of the optimizer.
+        Returns:
+            reg: the value added to the reported loss, which is ``0`` for ``cosine``.
+        """
+        with torch.no_grad():
+            params = [p.detach() for p in self.params]
+            if self.kind != 'cosine':
+                diff = torch._foreach_sub(params, self.params_past)
+            if self.kind == 'l2_squared':
+                reg = (self.coef / 2) * _sum_norms(torch._foreach_norm(diff), 2)
+                torch._foreach_mul_(diff, self.coef)
+                self._add_grad(diff)
+                return reg
+            if self.kind == 'proximal':
+                sq = torch._foreach_mul(diff, diff)
+                norms = torch.stack(torch._foreach_norm(sq))
+                reg = self.coef * norms.sum()
+                # d ||d ** 2|| / d d = 2 * d ** 3 / ||d ** 2||, which is 0 where d is 0.
+                torch._foreach_mul_(sq, diff)
+                torch._foreach_mul_(sq, list((2 * self.coef / norms.clamp(min=torch.finfo(norms.dtype).tiny)).unbind()))
+                self._add_grad(sq)
+                return reg
+            # The dot product is computed directly: deriving it from ||p - q|| cancels catastrophically when p is
+            # close to q, which is the usual case during adaptation.
+            sq_norm = _sum_norms(torch._foreach_norm(params), 2)
+            dot = sum(t.sum() for t in torch._foreach_mul(params, self.params_past))
+            denom = torch.clamp(torch.sqrt(sq_norm * self.sq_norm_past), min=1e-8)
+            cos = dot / denom
+            # d cos / d p = q / (||p|| ||q||) - cos * p / ||p||^2.
+            grads = torch._foreach_mul(self.params_past, self.coef / denom)
+            torch._foreach_add_(grads, torch._foreach_mul(params, -self.coef * cos / sq_norm.clamp(min=1e-16)))
+            self._add_grad(grads)
+            return torch.zeros((), device=cos.device)
@@ -0,0 +1,142 @@
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+
+def model_nbytes(model: nn.Module) -> int:
+    r"""
+    Overview:
+        Number of bytes taken by the parameters and buffers of ``model``.
+    """
+    return sum(t.numel() * t.element_size() for t in model.state_dict().values())
+
+
+class ResidencyManager:
+    r"""
+    Overview:
+        Decide where client models are kept between two calls of a client.
+        Clients call ``acquire`` before using a model and ``release`` after it, instead of moving the model to the
+    device and back to CPU in every method. The placement depends on ``policy``:
+
+        - ``pin``: every model stays on the device once it is acquired.
+        - ``lru``: models stay on the device while their total size is within ``budget`` bytes. When the budget is \
+    exceeded, the least recently used models are moved to CPU.
+        - ``pressure``: models stay on the device until the memory allocated on it exceeds ``budget`` bytes. Then the \
+    least recently used models are moved to CPU until the usage is within the budget.
+        - ``offload``: the model is moved to CPU on every ``release``. This is the original behavior.
+
+        With ``lru`` and ``pressure``, the models of different clients may be on different devices.
+    """
+
+    def __init__(self, device: str, policy: str = 'pressure', budget: Optional[int] = None):
+        r"""
+        Overview:
+            Initialization for the residency manager.
+        Arguments:
+            device: the device on which models are used.
+            policy: placement policy, one of ``pin``, ``lru``, ``pressure`` and ``offload``.
+            budget: the byte budget. For ``lru``, ``None`` means no limit. For ``pressure``, ``None`` means 80% of \
+        the memory of the device.
+        """
+        if policy not in ['pin', 'lru', 'pressure', 'offload']:
+            raise ValueError(f'Unrecognized residency policy: {policy}')
+        self.device = device
+        self.policy = policy
+        self.budget = budget
+        # A device such as ``'0'`` refers to a cuda device.
+        self.torch_device = torch.device(int(device)) if str(device).isdigit() else torch.device(device)
+        if self.policy == 'pressure' and self.budget is None and self._is_cuda():
+            self.budget = int(0.8 * torch.cuda.get_device_properties(self.torch_device).total_memory)
+        # Models on the device in the least recently used order: id(model) -> (weakref of model, size in bytes).
+        self.resident = OrderedDict()
+        # Clients may be run by several threads, e.g. by ``ThreadLauncher``.
+        # The model acquired last by each thread is in use until it is released: thread id -> id(model).
+        self.lock = threading.RLock()
+        self.in_use = {}
+
+    def _is_cuda(self) -> bool:
+        return self.torch_device.type == 'cuda'
+
+    def resident_bytes(self) -> int:
+        r"""
+        Overview:
+            Total size of the models currently kept on the device by this manager.
+        """
+        return sum(nbytes for _, nbytes in self.resident.values())
+
+    def acquire(self, model: nn.Module, device: Optional[str] = None) -> nn.Module:
+        r"""
+        Overview:
+            Make sure ``model`` is on the device before it is used, and mark it as the most recently used one.
+        Arguments:
+            model: the model to be used.
+            device: the device to be used. If set to ``None``, the device of this manager is used.
+        Returns:
+            model: the same model, which is now on the device.
+        """
+        if self.policy == 'offload':
+            return model.to(self.device if device is None else device)
+        key = id(model)
+        with self.lock:
+            model.to(self.device if device is None else device)
+            # The id of a model that has been garbage collected may be reused by a new model.
+            if key not in self.resident or self.resident[key][0]() is not model:
+                self.resident[key] = (weakref.ref(model), model_nbytes(model))
+            self.resident.move_to_end(key)
+            self.in_use[threading.get_ident()] = key
+            self._evict()
+        return model
+
+    def release(self, model: nn.Module) -> None:
+        r"""
+        Overview:
+            Called when a client has finished using ``model``. Only ``offload`` moves it off the device here.
+        """
+        if self.policy == 'offload':
+            model.to('cpu')
+            return
+        with self.lock:
+            if self.in_use.get(threading.get_ident()) == id(model):
+                del self.in_use[threading.get_ident()]
+
+    def _over_budget(self) -> bool:
+        if self.policy == 'lru':
+            return self.budget is not None and self.resident_bytes() > self.budget
+        elif self.policy == 'pressure':
+            return self._is_cuda() and torch.cuda.memory_allocated(self.torch_device) > self.budget
+        return False
+
+    def _evict(self) -> None:
+        # Move the least recently used models to CPU until the budget is met. Models in use are never evicted.
+        in_use = set(self.in_use.values())
+        for key in [k for k in self.resident if k not in in_use]:
+            if not self._over_budget():
+                break
+            ref, _ = self.resident.pop(key)
+            model = ref()
+            if model is not None:
+                model.to('cpu')
+
+
+# One manager for each (device, policy, budget) in this process.
+_residency_managers: Dict[Tuple, ResidencyManager] = {}
+
+
+def get_residency_manager(args: dict) -> ResidencyManager:
+    r"""
+    Overview:
+        Get the residency manager of this process for the configuration in ``args.learn``. All clients with the same \
+    configuration share one manager, so the budget covers all of them.
+    Arguments:
+        args: the arguments of the experiment.
+    Returns:
+        manager: the shared residency manager.
+    """
+    key = (str(args.learn.device), args.learn.residency.policy, args.learn.residency.budget)
+    if key not in _residency_managers:
+        _residency_managers[key] = ResidencyManager(*key)
+    return _residency_managers[key]
@@ -0,0 +1,91 @@
+from typing import Iterable, Optional
+
+import torch
+import torch.nn.functional as F
+
+
+def pairwise_similarity(x: torch.Tensor, y: Optional[torch.Tensor] = None, metric: str = 'cosine',
+                        eps: float = 1e-8) -> torch.Tensor:
+    r"""
+    Overview:
+        Compute the similarity (or distance) between every row of ``x`` and every row of ``y`` in one batched call.
+    Arguments:
+        x: tensor with shape ``[N, D]``.
+        y: tensor with shape ``[M, D]``. If set to ``None``, ``x`` is used.
+        metric: one of the followings:
+            ``cosine``: cosine similarity, computed as a matmul of the normalized rows.
+            ``euclidean``: L2 distance, computed by ``torch.cdist``.
+            ``kl``: ``KL(softmax(x_i) || softmax(y_j))``, where rows are treated as logits.
+        eps: small value to avoid division by zero in ``cosine``.
+    Returns:
+        matrix: tensor with shape ``[N, M]``.
+    """
+    if y is None:
+        y = x
+    x, y = x.reshape(x.shape[0], -1).float(), y.reshape(y.shape[0], -1).float()
+    if metric == 'cosine':
+        x = x / x.norm(dim=1, keepdim=True).clamp_min(eps)
+        y = y / y.norm(dim=1, keepdim=True).clamp_min(eps)
+        return x @ y.t()
+    elif metric == 'euclidean':
+        # The matmul based algorithm of ``cdist`` is not exact, which gives non-zero distance for identical rows.
+        return torch.cdist(x.unsqueeze(0), y.unsqueeze(0), compute_mode='donot_use_mm_for_euclid_dist').squeeze(0)
+    elif metric == 'kl':
+        log_p, log_q = F.log_softmax(x, dim=1), F.log_softmax(y, dim=1)
+        p = log_p.exp()
+        return (p * log_p).sum(dim=1, keepdim=True) - p @ log_q.t()
+    else:
+        raise ValueError(f'Unrecognized similarity metric: {metric}')
+
+
+class SimilarityMatrix:
+    r"""
+    Overview:
+        An ``N x N`` pairwise similarity matrix of the indicators of ``N`` clients, kept across rounds.
+        In each call of ``update``, only the rows and columns of the clients whose indicators have changed are
+    computed again. When all clients have changed, the whole matrix is computed in one batched call.
+    """
+
+    def __init__(self, metric: str = 'cosine'):
+        r"""
+        Overview:
+            Initialization for the similarity matrix.
+        Arguments:
+            metric: the metric used in ``pairwise_similarity``.
+        """
+        if metric not in ['cosine', 'euclidean', 'kl']:
+            raise ValueError(f'Unrecognized similarity metric: {metric}')
+        self.metric = metric
+        self.features = None
+        self.matrix = None
+
+    def update(self, features: torch.Tensor, changed: Optional[Iterable[int]] = None) -> torch.Tensor:
+        r"""
+        Overview:
+            Update the matrix with the new indicators of all clients.
+        Arguments:
+            features: the stacked indicators with shape ``[N, D]``.
+            changed: indexes of clients whose indicators have changed. If set to ``None``, they are found by comparing \
+        ``features`` with the indicators of the last call.
+        Returns:
+            matrix: the similarity matrix with shape ``[N, N]``. It is over-written in the next call.
+        """
+        features = features.detach().reshape(features.shape[0], -1)
+        if self.features is None or self.features.shape != features.shape or \
+                self.features.device != features.device:
+            self.matrix = pairwise_similarity(features, metric=self.metric)
+        else:
+            if changed is None:
+                changed = torch.nonzero((features != self.features).any(dim=1)).flatten()
+            else:
+                changed = torch.as_tensor(list(changed), dtype=torch.long, device=features.device)
+            if changed.numel() == features.shape[0]:
+                self.matrix = pairwise_similarity(features, metric=self.metric)
+            elif changed.numel() > 0:
+                self.matrix[changed] = pairwise_similarity(features[changed], features, metric=self.metric)
+                if self.metric == 'kl':
+                    self.matrix[:, changed] = pairwise_similarity(features, features[changed], metric=self.metric)
+                else:
+                    self.matrix[:, changed] = self.matrix[changed].t()
+        self.features = features.clone()
+        return self.matrix
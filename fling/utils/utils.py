@@ -1,16 +1,20 @@
 import numpy as np
 import os
 import time
-from typing import Iterable, Dict, List
+from typing import Iterable, Dict, List, Optional
 from prettytable import PrettyTable
 
 from torch.utils.tensorboard import SummaryWriter
 import torch
 
-def client_sampling(client_ids: Iterable, sample_rate: float) -> List:
+def client_sampling(
+        client_ids: Iterable, sample_rate: float, random_state: Optional[np.random.RandomState] = None
+) -> List:
+    # Clients are drawn from ``random_state`` if it is given, or from the global numpy random state.
+    rng = np.random if random_state is None else random_state
     participated_clients = np.array(client_ids)
     participated_clients = sorted(
-        list(np.random.choice(participated_clients, int(sample_rate * participated_clients.shape[0]), replace=False))
+        list(rng.choice(participated_clients, int(sample_rate * participated_clients.shape[0]), replace=False))
     )
     return participated_clients
 
@@ -20,9 +24,20 @@ class Logger(SummaryWriter):
     def __init__(self, path: str):
         super(Logger, self).__init__(path)
         self.txt_logger_path = os.path.join(path, 'txt_logger_output.txt')
+        # The ``MetricsSink`` to which the messages are sent, see ``set_sink``.
+        self.sink = None
+
+    def set_sink(self, sink: object) -> None:
+        # Send the messages to ``sink`` instead of appending them to the text file one by one. The text file is then
+        # written by the ``text`` backend of the sink, or here if the sink has no such backend.
+        self.sink = sink
 
     def logging(self, s: str) -> None:
         print(s)
+        if self.sink is not None:
+            self.sink.log_text(s)
+            if self.sink.writes_text:
+                return
         with open(self.txt_logger_path, mode='a') as f:
             f.write('[' + time.asctime(time.localtime(time.time())) + ']    ' + s + '\n')
 
@@ -46,21 +61,79 @@ class Logger(SummaryWriter):
 
 
 class VariableMonitor:
+    r"""
+    Overview:
+        Weighted averages of the variables of each batch, e.g. the accuracy and the loss.
+        Values can be Python numbers or 0-dim tensors. Tensors are accumulated on their device, in float64, so \
+    ``append`` never waits for the device. The averages are only copied to the host when they are read by \
+    ``variable_mean``, or by ``VariableMonitor.reduce`` for many monitors at once.
+    """
 
     def __init__(self):
         self.length = {}
+        # The weighted sum of each variable, a Python number or a 0-dim tensor.
         self.dic = {}
 
     def append(self, item: dict, weight: float = 1) -> None:
         for k in item.keys():
+            value = item[k]
+            if isinstance(value, torch.Tensor):
+                value = value.detach().to(torch.float64)
             if k not in self.dic.keys():
-                self.dic[k] = []
+                self.dic[k] = 0
                 self.length[k] = 0
-            self.dic[k].append(weight * item[k])
+            self.dic[k] = self.dic[k] + weight * value
             self.length[k] += weight
 
-    def variable_mean(self) -> Dict:
-        return {k: sum(self.dic[k]) / self.length[k] for k in self.dic.keys()}
+    def variable_mean(self, materialize: bool = True) -> Dict:
+        r"""
+        Overview:
+            The weighted average of each variable.
+        Arguments:
+            materialize: whether the averages are returned as Python floats. Otherwise, the averages of tensors are \
+        returned as 0-dim tensors on their devices, which can be appended to another monitor without a sync.
+        """
+        if materialize:
+            return VariableMonitor.reduce([self])[0]
+        return {k: self.dic[k] / self.length[k] for k in self.dic.keys()}
+
+    @staticmethod
+    def reduce(monitors: List['VariableMonitor']) -> List[Dict]:
+        r"""
+        Overview:
+            The weighted averages of many monitors, e.g. of all clients in a round, with one copy to the host per \
+        device instead of one for each variable.
+        Arguments:
+            monitors: the monitors to be read.
+        Returns:
+            means: the averages of each monitor as Python floats, in the order of ``monitors``.
+        """
+        means = [monitor.variable_mean(materialize=False) for monitor in monitors]
+        tensors = {}
+        for mean in means:
+            for k, v in mean.items():
+                if isinstance(v, torch.Tensor):
+                    tensors.setdefault(v.device, []).append((mean, k, v))
+        for items in tensors.values():
+            values = torch.stack([v for _, _, v in items]).tolist()
+            for (mean, k, _), value in zip(items, values):
+                mean[k] = value
+        return means
+
+
+def materialize_metrics(result: object) -> object:
+    r"""
+    Overview:
+        Convert the lazy averages returned by ``VariableMonitor.variable_mean(materialize=False)`` in the result of a \
+    client to Python floats, e.g. before it is sent to another process. The 0-dim tensors in dicts are converted, \
+    and tuples and lists are searched recursively. Other objects are returned as they are.
+    """
+    if isinstance(result, dict):
+        return {k: v.item() if isinstance(v, torch.Tensor) and v.dim() == 0 else v for k, v in result.items()}
+    if isinstance(result, (tuple, list)):
+        return type(result)(materialize_metrics(r) for r in result)
+    return result
+
 
 class SaveEmb:
     def __init__(self):
@@ -50,6 +50,17 @@ default_exp_args = dict(
             # For default case, every parameter should be fine-tuned.
             name='all'
         ),
+        # Where client models are kept between two calls of a client. See ``ResidencyManager``.
+        residency=dict(
+            # Options: 'pin', 'lru', 'pressure', 'offload'.
+            # 'pin' keeps all models on the device. 'lru' keeps the most recently used models on the device within
+            # ``budget``. 'pressure' moves models to CPU only when the memory allocated on the device exceeds
+            # ``budget``. 'offload' moves every model to CPU after each call, which is the original behavior.
+            policy='pressure',
+            # Byte budget of the policy. If set to ``None``, 'lru' is not limited and 'pressure' uses 80% of the
+            # device memory.
+            budget=None,
+        ),
     ),
     # Configurations about models.
     model=dict(
@@ -85,6 +96,17 @@ default_exp_args = dict(
         name='base_group',
         # How parameters in each client aggregate. Default to be "avg", which means a simple average.
         aggregation_method='avg',
+        # Engine used by personalized aggregation (e.g. ``adapt_group``). Options: 'flat', 'state_dict'.
+        # 'flat' packs all client models into one ``[N, P]`` buffer and aggregates them with a single matmul.
+        # 'state_dict' is the original implementation, which loops over clients and keys of copied state dicts.
+        aggregation_engine='flat',
+        # How ``fed_avg`` computes the weighted average. Options: 'foreach', 'reduce'.
+        # 'foreach' accumulates each client into preallocated buffers in place with foreach ops, which is
+        # bit-identical to 'reduce', the original implementation.
+        fed_avg_engine='foreach',
+        # Whether to store the weights of all clients as rows of one preallocated ``[N, P]`` tensor.
+        # If ``True``, synchronization and aggregation read and write this tensor instead of state dicts.
+        parameter_arena=False,
         # What parameters in each client should be aggregated.
         aggregation_parameters=dict(
             # For default case, every parameter should be aggregated.
@@ -99,6 +121,10 @@ default_exp_args = dict(
         # name='multiprocessing',
         # num_proc=2
         # ``num_proc`` refers to the number of processes used in your program.
+        # Set ``start_method='spawn'`` if CUDA is used in the main process before the workers are started.
+        # Clients can also run in a pool of threads, which share the torch threads of this process equally.
+        # name='thread',
+        # num_threads=4
         # For the default setting, if your os is linux, the multiprocessing mode is enabled.
         # You can overwrite the default settings by yourself.
     ) if platform.system().lower() != 'linux' else dict(name='multiprocessing', num_proc=2),
@@ -115,5 +141,57 @@ default_exp_args = dict(
         resume_path=None,
         # Whether to print config is the command line.
         print_config=False,
+        # Where the TTA pipeline writes its messages and metrics, through a background writer thread. Options:
+        # 'text' (txt_logger_output.txt), 'tensorboard', 'jsonl' (metrics.jsonl), 'parquet' (metrics.parquet, requires
+        # pyarrow) and 'wandb' (credentials are read by wandb, e.g. from ``WANDB_API_KEY``).
+        metrics_backends=['text', 'tensorboard', 'jsonl'],
+        # Whether to adapt the participated TTA clients in one pass with batched weights (``torch.func.vmap``).
+        # Clients that do not support it are adapted one by one as before.
+        batched_adapt=False,
+        # Whether to read the test batches of each TTA round from a ``RoundBatchLoader``, which gathers the collated
+        # batches of all participating clients from pre-decoded tensors and prefetches the next round in a background
+        # thread.
+        # If ``False``, each round builds a ``NaiveDataset`` which is loaded sample by sample by a ``DataLoader``.
+        corruption_stream=True,
+        # Root directory of the files cached by the TTA pipeline. Relative paths of the caches below are resolved under
+        # this directory by ``get_cache_path``, absolute paths are kept.
+        cache_root='./cache',
+        # Whether to cache the features and logits of the frozen source model on the test splits, which are then read
+        # by the clients instead of running ``model_anchor``. Only used with ``corruption_stream``.
+        anchor_cache=True,
+        # Directory of the cached outputs, in a sub-directory named by the hash of the checkpoint and of the data
+        # config, so they are reused across seeds and methods. If set to ``None``, the outputs are only kept in memory.
+        anchor_cache_path='anchor_outputs',
+        # Whether to save the client partitions of the test sets of the TTA pipeline under ``partition_cache_path``, so
+        # later runs with the same sampler, seed and labels load them instead of sampling again. In one run, all
+        # corruption splits share one partition whether or not it is saved.
+        partition_cache=True,
+        partition_cache_path='partitions',
+        # Path of a round schedule saved by a previous run (``schedule.npy`` in its logging path), to replay the same
+        # participating clients, corruptions and batches. If set to ``None``, the schedule is compiled from the config.
+        schedule_path=None,
+        # Whether to read CIFAR-10-C and CIFAR-100-C from arrays with the layout of ``ToTensor`` (``[N, C, H, W]``
+        # uint8) under ``tensor_store_path``, which are converted from the original arrays on first use. Then batches
+        # are gathered with one ``index_select`` and normalized in one vectorized op, see ``TensorCorruptionSplit``.
+        tensor_store=True,
+        tensor_store_path='tensor_store',
+        # Whether to load these arrays into shared memory, so that the workers of a launcher use them without a copy.
+        tensor_store_shared=False,
+        # Whether to read Tiny-ImageNet-C and ImageNet-C from the packed shards written by ``fling pack`` under
+        # ``<data_path>/Tiny-ImageNet-C-packed`` or ``<data_path>/ImageNet-C-packed``, if they exist.
+        packed_store=True,
+        # Whether to run the shared frozen anchor model once for the test batches of all participating clients in each
+        # round, instead of once for each client. Only used with ``corruption_stream``.
+        shared_anchor=True,
+        # How ``adapt_group`` trains the spatial-temporal attention model (``ST_block``) in each round.
+        # 'cached' keeps the model and its optimizer state across rounds and continues training it.
+        # 'scratch' is the original implementation, which trains a new model from the identity initialization.
+        st_mode='cached',
+        # For 'cached', the model is built again every ``st_refresh_interval`` rounds. 0 means never.
+        st_refresh_interval=20,
+        # For 'cached', training of a round stops early if the loss is not improved by a relative amount of
+        # ``st_tol`` for ``st_patience`` consecutive epochs. 0 means training for all ``st_epoch`` epochs.
+        st_patience=5,
+        st_tol=1e-2,
     ),
 )